@@ -169,6 +169,19 @@ def create_predict_config(base_dir,
     config.set('Predict', 'fmap_inc', ", ".join(str(v) for v in train_config_dict["fmap_inc"]))
     config.set('Predict', 'n_convolutions', ", ".join(str(v) for v in train_config_dict["n_convolutions"]))
     config.set('Predict', 'network_appendix', train_config_dict["network_appendix"])
+    config.set('Predict', 'quantized', str(False))
+    config.set('Predict', 'multi_model', str(False))
+    config.set('Predict', 'queue_size', str(16))
+    config.set('Predict', 'write_buffer_size', str(256))
+    config.set('Predict', 'write_interval', str(10.0))
+    config.set('Predict', 'chunk_size', str(256))
+    config.set('Predict', 'lease_time', str(600))
+    config.set('Predict', 'max_wait', str(3600))
+    config.set('Predict', 'crop_cache', str(None))
+    config.set('Predict', 'prediction_store', str(None))
+    config.set('Predict', 'num_reader_workers', str(0))
+    config.set('Predict', 'timing_dir', "timing")
+    config.set('Predict', 'timing_interval', str(60.0))
     
     return config
  
@@ -110,6 +110,20 @@ def create_train_config():
     config.set('Training', 'fmap_inc', "2, 2, 2, 2")
     config.set('Training', 'n_convolutions', "2, 2, 2, 2")
     config.set('Training', 'network_appendix', "None")
+    config.set('Training', 'point_table', "None")
+    config.set('Training', 'crop_store', "None")
+    config.set('Training', 'direct_sampling', "False")
+    config.set('Training', 'snapshot_keep_last', "None")
+    config.set('Training', 'elastic_pool_size', "None")
+    config.set('Training', 'data_loader', "False")
+    config.set('Training', 'num_workers', "10")
+    config.set('Training', 'cache_size', "40")
+    config.set('Training', 'validation_crop_store', "None")
+    config.set('Training', 'validate_every', "1000")
+    config.set('Training', 'patience', "None")
+    config.set('Training', 'checkpoint_every', "1000")
+    config.set('Training', 'checkpoint_keep_last', "None")
+    config.set('Training', 'checkpoint_keep_every', "None")
  
     return config
 
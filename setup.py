@@ -8,4 +8,9 @@ setup(
     author='Funkelab',
     packages=[
         'synister',
+        ],
+    install_requires=[
+        # synister.gp.CachedElasticAugment overrides a private method of
+        # ElasticAugment in this version
+        'gunpowder @ git+https://github.com/funkey/gunpowder@754607abcd3c84ec28c0d2ea257b969934ce986d',
         ])
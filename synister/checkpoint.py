@@ -0,0 +1,271 @@
+import argparse
+import glob
+import logging
+import numpy as np
+import os
+import random
+import re
+import threading
+import torch
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--train_dir', '-d',
+    type=str,
+    required=True,
+    help="Train setup directory, e.g. <experiment>/02_train/setup_t0")
+parser.add_argument(
+    '--iterations', '-i',
+    type=int,
+    nargs='+',
+    required=True,
+    help="Iterations of the checkpoints to export")
+
+
+def get_slim_checkpoint(train_checkpoint):
+    return train_checkpoint + "_slim"
+
+
+def export_slim_checkpoint(train_checkpoint):
+    '''Write the model weights of ``train_checkpoint`` without the optimizer
+    state to ``<train_checkpoint>_slim``, in the same format (a dict with
+    ``model_state_dict``).'''
+
+    checkpoint = torch.load(train_checkpoint, map_location="cpu")
+    slim_checkpoint = get_slim_checkpoint(train_checkpoint)
+
+    # write to a temporary file first, other processes might be loading it
+    tmp_checkpoint = slim_checkpoint + ".tmp{}".format(os.getpid())
+    torch.save({"model_state_dict": checkpoint["model_state_dict"]}, tmp_checkpoint)
+    os.replace(tmp_checkpoint, slim_checkpoint)
+
+    logger.info("Exported {}".format(slim_checkpoint))
+    return slim_checkpoint
+
+
+# state dicts loaded by this process, by path and modification time
+_state_dicts = {}
+
+
+def load_state_dict(train_checkpoint):
+    '''Load the model state dict of ``train_checkpoint`` on the CPU.
+
+    The slim checkpoint written by ``export_slim_checkpoint`` is used if it
+    is at least as recent as ``train_checkpoint``. It is memory mapped where
+    ``torch.load`` supports it, so that the weights are read lazily and
+    their pages are shared between all processes on a node. State dicts are
+    cached per process, workers forked after the first load share them.'''
+
+    slim_checkpoint = get_slim_checkpoint(train_checkpoint)
+    mtime = os.path.getmtime(train_checkpoint)
+    slim = os.path.exists(slim_checkpoint) and os.path.getmtime(slim_checkpoint) >= mtime
+    path = slim_checkpoint if slim else train_checkpoint
+
+    key = (os.path.realpath(path), os.path.getmtime(path))
+    if key in _state_dicts:
+        return _state_dicts[key]
+
+    if slim:
+        try:
+            checkpoint = torch.load(path, map_location="cpu", mmap=True)
+        except TypeError:
+            # torch < 2.1
+            checkpoint = torch.load(path, map_location="cpu")
+    else:
+        checkpoint = torch.load(path, map_location="cpu")
+
+    state_dict = checkpoint["model_state_dict"]
+    del checkpoint
+
+    # drop cached versions of the same file
+    for cached in [k for k in _state_dicts if k[0] == key[0]]:
+        del _state_dicts[cached]
+    _state_dicts[key] = state_dict
+
+    return state_dict
+
+
+def load_weights(model, train_checkpoint, device):
+    '''Load the weights of ``train_checkpoint`` into ``model`` on
+    ``device``. On the CPU, the parameters are assigned the (memory mapped)
+    loaded tensors instead of copying them, where supported.'''
+
+    state_dict = load_state_dict(train_checkpoint)
+
+    if torch.device(device).type == "cpu":
+        try:
+            model.load_state_dict(state_dict, assign=True)
+            return model
+        except TypeError:
+            # torch < 2.1
+            pass
+
+    model.load_state_dict(state_dict)
+    return model
+
+
+def get_checkpoint_iterations(basename="model"):
+    '''Sorted iterations of all training checkpoints
+    ``<basename>_checkpoint_<iteration>``. Derived files (slim, quantized,
+    best checkpoints) are ignored.'''
+
+    directory = os.path.dirname(basename) or "."
+    pattern = re.compile(re.escape(os.path.basename(basename)) + r"_checkpoint_(\d+)$")
+    if not os.path.exists(directory):
+        return []
+    return sorted(int(m.group(1))
+                  for m in (pattern.match(f) for f in os.listdir(directory))
+                  if m is not None)
+
+
+def get_latest_checkpoint(basename="model"):
+    '''The latest training checkpoint and its iteration, ``(None, 0)`` if
+    there is none.'''
+
+    iterations = get_checkpoint_iterations(basename)
+    if not iterations:
+        return None, 0
+    return "{}_checkpoint_{}".format(basename, iterations[-1]), iterations[-1]
+
+
+def get_rng_state():
+
+    state = {"torch": torch.get_rng_state(),
+             "numpy": np.random.get_state(),
+             "random": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def restore_rng_state(train_checkpoint):
+    '''Restore the random states stored in ``train_checkpoint`` by
+    ``CheckpointManager``, if any.'''
+
+    checkpoint = torch.load(train_checkpoint, map_location="cpu")
+    if "rng_state" in checkpoint:
+        set_rng_state(checkpoint["rng_state"])
+        return True
+    return False
+
+
+def _copy_to_cpu(state):
+
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: _copy_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_copy_to_cpu(v) for v in state)
+    return state
+
+
+class CheckpointManager(object):
+    '''Writes training checkpoints ``<basename>_checkpoint_<iteration>`` in
+    the format of gunpowder's ``Train`` (plus the random states), in a
+    background thread, and prunes old checkpoints.
+
+    Checkpoints are kept if they are among the last ``keep_last``, if their
+    iteration is a multiple of ``keep_every``, or if they are passed in
+    ``keep``. Files derived from a pruned
+    checkpoint (slim, quantized) are removed with it. All checkpoints are
+    kept if ``keep_last`` is not given.
+
+    Args:
+
+        basename (``string``):
+
+            Checkpoint basename, as in ``Train``.
+
+        keep_last (``int``, optional):
+
+            Number of most recent checkpoints to keep.
+
+        keep_every (``int``, optional):
+
+            Keep all checkpoints at multiples of this iteration.
+    '''
+
+    def __init__(self, basename="model", keep_last=None, keep_every=None):
+
+        self.basename = basename
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.writer = None
+
+    def save(self, iteration, model, optimizer, keep=()):
+        '''Save a checkpoint of ``model`` and ``optimizer`` at
+        ``iteration``. The state is copied to the CPU before this returns,
+        writing it waits only for the previous write.'''
+
+        self.wait()
+
+        checkpoint = {
+            "model_state_dict": _copy_to_cpu(model.state_dict()),
+            "optimizer_state_dict": _copy_to_cpu(optimizer.state_dict()),
+            "rng_state": get_rng_state(),
+            "iteration": iteration
+        }
+        train_checkpoint = "{}_checkpoint_{}".format(self.basename, iteration)
+
+        self.writer = threading.Thread(target=self.__write,
+                                       args=(checkpoint, train_checkpoint, keep))
+        self.writer.start()
+
+    def wait(self):
+        '''Wait for the pending checkpoint write, if any.'''
+
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+    def __write(self, checkpoint, train_checkpoint, keep):
+
+        # write to a temporary file first, a preempted job leaves the
+        # previous checkpoint as the latest one
+        tmp_checkpoint = train_checkpoint + ".tmp"
+        torch.save(checkpoint, tmp_checkpoint)
+        os.replace(tmp_checkpoint, train_checkpoint)
+        logger.info("Saved {}".format(train_checkpoint))
+
+        self.prune(keep)
+
+    def prune(self, keep=()):
+        '''Remove all checkpoints not kept by the retention policy.'''
+
+        if self.keep_last is None:
+            return
+
+        iterations = get_checkpoint_iterations(self.basename)
+        kept = set(iterations[-self.keep_last:]) if self.keep_last > 0 else set()
+        kept |= set(i for i in keep if i is not None)
+        if self.keep_every is not None:
+            kept |= set(i for i in iterations if i % self.keep_every == 0)
+
+        for iteration in iterations:
+            if iteration in kept:
+                continue
+            train_checkpoint = "{}_checkpoint_{}".format(self.basename, iteration)
+            for f in [train_checkpoint] + glob.glob(glob.escape(train_checkpoint) + "_*"):
+                os.remove(f)
+            logger.info("Removed {}".format(train_checkpoint))
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    for iteration in args.iterations:
+        export_slim_checkpoint(os.path.join(args.train_dir,
+                                            "model_checkpoint_{}".format(iteration)))
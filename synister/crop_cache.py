@@ -0,0 +1,267 @@
+from synister.point_table import get_point_table
+from synister.read_config import read_train_config
+from synister.utils import get_raw
+import argparse
+import json
+import logging
+import numpy as np
+import os
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--train_config', '-t',
+    type=str,
+    required=True,
+    help="Train config of the setup, defines db, split and raw data")
+parser.add_argument(
+    '--split_part', '-p',
+    type=str,
+    default="test",
+    help="Split part to cache, one of train, test or validation")
+parser.add_argument(
+    '--out', '-o',
+    type=str,
+    required=True,
+    help="Output directory of the crop cache")
+parser.add_argument(
+    '--margin', '-m',
+    type=int,
+    nargs=3,
+    default=(0, 0, 0),
+    help="Additional context (in voxels) on each side of the crops")
+parser.add_argument(
+    '--labels', '-l',
+    action='store_true',
+    help="Cache only synapses of the synapse types of the train config and "
+         "store their labels, e.g. to train from the cache")
+
+
+def write_crop_cache(out_dir,
+                     synapse_ids,
+                     locations,
+                     input_shape,
+                     voxel_size,
+                     raw_container,
+                     raw_dataset,
+                     margin=(0,0,0),
+                     batch_size=64,
+                     attrs=None,
+                     labels=None):
+    """Read a uint8 crop around each of the given locations and store them in
+    ``out_dir``, indexed by synapse id.
+
+    The cache is a directory of ``.npy`` files that can be memory mapped:
+    ``crops.npy`` (one ``input_shape + 2*margin`` crop per synapse),
+    ``synapse_ids.npy``, ``locations.npy`` (``z``, ``y``, ``x`` in world
+    units) and optionally ``labels.npy``.
+
+    Args:
+
+        margin (``tuple of int``):
+
+            Additional context in voxels on each side of the crops.
+
+        attrs (``dict``, optional):
+
+            Additional attributes to store in ``attrs.json``.
+
+        labels (``ndarray``, optional):
+
+            An integer label per synapse.
+    """
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    margin = np.array(margin, dtype=np.int64)
+    crop_shape = tuple(int(s) for s in np.array(input_shape) + 2*margin)
+    locations = np.array(locations, dtype=np.int64).reshape(-1, 3)
+
+    cache_attrs = {
+        "input_shape": [int(s) for s in input_shape],
+        "margin": [int(m) for m in margin],
+        "voxel_size": [int(v) for v in voxel_size],
+        "raw_container": raw_container,
+        "raw_dataset": raw_dataset,
+        "complete": False,
+    }
+    if attrs is not None:
+        cache_attrs.update(attrs)
+
+    with open(os.path.join(out_dir, "attrs.json"), "w") as f:
+        json.dump(cache_attrs, f, indent=2)
+
+    np.save(os.path.join(out_dir, "synapse_ids.npy"),
+            np.array(synapse_ids, dtype=np.int64))
+    np.save(os.path.join(out_dir, "locations.npy"), locations)
+    if labels is not None:
+        np.save(os.path.join(out_dir, "labels.npy"),
+                np.array(labels, dtype=np.int64))
+
+    crops = np.lib.format.open_memmap(os.path.join(out_dir, "crops.npy"),
+                                      mode="w+",
+                                      dtype=np.uint8,
+                                      shape=(len(locations),) + crop_shape)
+
+    for i in range(0, len(locations), batch_size):
+        logger.info("Cache crop {}/{}".format(i, len(locations)))
+        crops[i:i+batch_size] = get_raw(locations[i:i+batch_size],
+                                        crop_shape,
+                                        voxel_size,
+                                        raw_container,
+                                        raw_dataset)
+
+    crops.flush()
+    del crops
+
+    cache_attrs["complete"] = True
+    with open(os.path.join(out_dir, "attrs.json"), "w") as f:
+        json.dump(cache_attrs, f, indent=2)
+
+
+def build_crop_cache(out_dir,
+                     db_credentials,
+                     db_name_data,
+                     split_name,
+                     split_part,
+                     input_shape,
+                     voxel_size,
+                     raw_container,
+                     raw_dataset,
+                     margin=(0,0,0),
+                     batch_size=64,
+                     synapse_types=None,
+                     point_table=None,
+                     **kwargs):
+    """Cache all crops of the given split part, see ``write_crop_cache``.
+
+    If ``synapse_types`` is given, only synapses of these types are cached,
+    labelled with the index of their type as in training.
+    """
+
+    table = get_point_table(db_credentials,
+                            db_name_data,
+                            split_name,
+                            snapshot_file=point_table)
+
+    if synapse_types is None:
+        mask = table.get_mask(split_part=split_part)
+        labels = None
+    else:
+        mask = np.zeros(len(table), dtype=bool)
+        labels = np.full(len(table), -1, dtype=np.int64)
+        for i, synapse_type in enumerate(synapse_types):
+            type_mask = table.get_mask(neurotransmitters=(synapse_type,),
+                                       split_part=split_part)
+            mask |= type_mask
+            labels[type_mask] = i
+        labels = labels[mask]
+
+    logger.info("Cache {} crops of split {}, part {}".format(int(mask.sum()),
+                                                               split_name,
+                                                               split_part))
+    write_crop_cache(out_dir,
+                     table.synapse_ids[mask],
+                     table.locations[mask],
+                     input_shape,
+                     voxel_size,
+                     raw_container,
+                     raw_dataset,
+                     margin=margin,
+                     batch_size=batch_size,
+                     attrs={"db_name_data": db_name_data,
+                            "split_name": split_name,
+                            "split_part": split_part,
+                            "synapse_types": synapse_types},
+                     labels=labels)
+
+
+class CropCache(object):
+    """Memory mapped read access to a crop cache written by
+    ``write_crop_cache``.
+
+    If given, ``voxel_size`` and ``synapse_types`` are checked against the
+    ones the cache was built with, labels are indices into the latter."""
+
+    def __init__(self, cache_dir, voxel_size=None, synapse_types=None):
+
+        with open(os.path.join(cache_dir, "attrs.json"), "r") as f:
+            self.attrs = json.load(f)
+
+        if not self.attrs["complete"]:
+            raise ValueError("Crop cache {} is incomplete".format(cache_dir))
+
+        self.cache_dir = cache_dir
+        self.input_shape = tuple(self.attrs["input_shape"])
+        self.margin = tuple(self.attrs["margin"])
+        self.voxel_size = tuple(self.attrs["voxel_size"])
+        self.synapse_types = self.attrs.get("synapse_types")
+
+        if voxel_size is not None and tuple(voxel_size) != self.voxel_size:
+            raise ValueError("Crop cache {} has voxel size {}, not {}".format(
+                cache_dir, self.voxel_size, tuple(voxel_size)))
+        self.crops = np.load(os.path.join(cache_dir, "crops.npy"), mmap_mode="r")
+        self.synapse_ids = np.load(os.path.join(cache_dir, "synapse_ids.npy"))
+        self.locations = np.load(os.path.join(cache_dir, "locations.npy"))
+
+        labels_file = os.path.join(cache_dir, "labels.npy")
+        self.labels = np.load(labels_file) if os.path.exists(labels_file) else None
+
+        if (synapse_types is not None and self.labels is not None and
+                (self.synapse_types is None or
+                 list(synapse_types) != list(self.synapse_types))):
+            raise ValueError("Crop cache {} is labelled for synapse types {}, not {}".format(
+                cache_dir, self.synapse_types, list(synapse_types)))
+
+        self.index = {int(synapse_id): i for i, synapse_id in enumerate(self.synapse_ids)}
+
+    def __len__(self):
+        return len(self.synapse_ids)
+
+    def __contains__(self, synapse_id):
+        return int(synapse_id) in self.index
+
+    def get_rows(self, rows, margin=(0,0,0)):
+        """Get uint8 crops of shape ``input_shape + 2*margin`` for the given
+        rows of the cache. ``margin`` has to be at most the margin the cache
+        was built with."""
+
+        rows = np.asarray(rows, dtype=np.int64)
+        offset = np.array(self.margin) - np.array(margin)
+        if np.any(offset < 0):
+            raise ValueError("Crop cache {} has a margin of only {}".format(self.cache_dir,
+                                                                          self.margin))
+        shape = np.array(self.input_shape) + 2*np.array(margin)
+        # sort rows to read the memory map sequentially
+        order = np.argsort(rows)
+        crops = self.crops[rows[order]]
+        crops = crops[:,
+                      offset[0]:offset[0] + shape[0],
+                      offset[1]:offset[1] + shape[1],
+                      offset[2]:offset[2] + shape[2]]
+        return np.ascontiguousarray(crops[np.argsort(order)])
+
+    def get(self, synapse_ids, margin=(0,0,0)):
+        """Get uint8 crops for the given synapse ids."""
+
+        missing = [s for s in synapse_ids if int(s) not in self.index]
+        if missing:
+            raise KeyError("Synapses {} not in crop cache {}".format(missing[:10],
+                                                                     self.cache_dir))
+        return self.get_rows([self.index[int(s)] for s in synapse_ids], margin)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    train_config = read_train_config(args.train_config)
+    del train_config["batch_size"]
+    if not args.labels:
+        del train_config["synapse_types"]
+    build_crop_cache(args.out,
+                     split_part=args.split_part,
+                     margin=args.margin,
+                     **train_config)
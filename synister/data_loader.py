@@ -0,0 +1,117 @@
+from gunpowder import *
+import math
+import numpy as np
+import torch
+import torch.utils.data
+
+
+class PipelineDataset(torch.utils.data.IterableDataset):
+    '''Endless stream of training samples, each one a batch of a gunpowder
+    ``pipeline`` (without ``PreCache`` and ``Stack``) for ``request``.
+
+    Each ``DataLoader`` worker builds its own copy of the pipeline and yields
+    ``(raw, label)``, with a channel dimension added to ``raw``.'''
+
+    def __init__(self, pipeline, request, raw, synapse_type):
+
+        self.pipeline = pipeline
+        self.request = request
+        self.raw = raw
+        self.synapse_type = synapse_type
+
+    def __iter__(self):
+
+        with build(self.pipeline) as p:
+            while True:
+                batch = p.request_batch(self.request)
+                yield (
+                    torch.from_numpy(np.ascontiguousarray(batch[self.raw].data[np.newaxis])),
+                    torch.as_tensor(batch[self.synapse_type].data))
+
+
+def seed_worker(worker_id):
+    # DataLoader seeds torch and random per worker, augmentations use numpy
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
+def create_data_loader(pipeline,
+                       request,
+                       raw,
+                       synapse_type,
+                       batch_size,
+                       num_workers=10,
+                       cache_size=40):
+    '''Create a ``DataLoader`` of batches of ``batch_size`` samples of
+    ``pipeline``, produced by ``num_workers`` persistent workers that keep
+    about ``cache_size`` samples ready, like ``PreCache``. Batches are
+    collated in shared memory. With ``num_workers=0``, samples are produced
+    in the training process.
+
+    Batches are not pinned: ``Train`` copies them to the device from numpy
+    arrays, which does not use pinned memory.'''
+
+    if num_workers == 0:
+        return torch.utils.data.DataLoader(
+            PipelineDataset(pipeline, request, raw, synapse_type),
+            batch_size=batch_size)
+
+    prefetch_factor = max(1, int(math.ceil(cache_size/(num_workers*batch_size))))
+
+    return torch.utils.data.DataLoader(
+        PipelineDataset(pipeline, request, raw, synapse_type),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        persistent_workers=True,
+        prefetch_factor=prefetch_factor,
+        worker_init_fn=seed_worker)
+
+
+class DataLoaderSource(BatchProvider):
+    '''Provides the batches of a ``DataLoader`` created by
+    ``create_data_loader`` as stacked gunpowder batches, i.e., ``raw`` with
+    batch and channel dimension and ``synapse_type`` with batch dimension,
+    for ``Train`` and the nodes after it.
+
+    Args:
+
+        data_loader (``DataLoader``):
+
+            The data loader to draw batches from.
+
+        raw (``ArrayKey``):
+
+            Key of the raw batch.
+
+        synapse_type (``ArrayKey``):
+
+            Key of the (nonspatial) labels.
+
+        raw_spec (``ArraySpec``):
+
+            Spec of the raw samples, the ROI is taken from the request.
+    '''
+
+    def __init__(self, data_loader, raw, synapse_type, raw_spec):
+
+        self.data_loader = data_loader
+        self.raw = raw
+        self.synapse_type = synapse_type
+        self.raw_spec = raw_spec
+
+    def setup(self):
+
+        self.provides(self.raw, self.raw_spec)
+        self.provides(self.synapse_type, ArraySpec(nonspatial=True))
+        self.batches = iter(self.data_loader)
+
+    def provide(self, request):
+
+        raw, labels = next(self.batches)
+
+        raw_spec = self.raw_spec.copy()
+        raw_spec.roi = request[self.raw].roi
+
+        batch = Batch()
+        batch.arrays[self.raw] = Array(raw.numpy(), raw_spec)
+        batch.arrays[self.synapse_type] = Array(labels.numpy(), ArraySpec(nonspatial=True))
+        return batch
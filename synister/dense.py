@@ -0,0 +1,307 @@
+from synister.utils import to_model_input
+import daisy
+import itertools
+import logging
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+
+class DenseVgg3D(torch.nn.Module):
+    '''Fully convolutional version of a trained ``Vgg3D``.
+
+    The classifier is converted into an equivalent convolutional head: the
+    first ``Linear`` layer becomes a convolution with a kernel of the size of
+    the feature map of one crop, the following ones become 1x1x1
+    convolutions. Dropout is dropped, the model is meant for inference only.
+
+    Applied to a raw block of shape ``input_shape + (n - 1)*stride``, the
+    model returns the class scores of all ``n`` crops of ``input_shape`` in
+    the block whose offsets are multiples of ``stride`` (the product of the
+    downsample factors), in one forward pass and sharing the convolutions of
+    overlapping crops.
+
+    The scores are exactly those of the single crops only if no convolution
+    of ``model`` is padded. ``Vgg3D`` pads its convolutions: on a single
+    crop they see zeros at the crop boundary, in a block they see the
+    neighbouring raw data instead. For an input shape of only a few
+    sections in z this changes most of a crop's receptive field, so
+    converting a padded model requires ``approximate=True``.
+
+    Args:
+
+        model (``Vgg3D``):
+
+            The trained model, has to be a float (not quantized) model.
+
+        input_shape (``tuple of int``):
+
+            The input shape ``model`` was trained with.
+
+        approximate (``bool``):
+
+            Allow padded convolutions, accepting scores that differ from
+            those of single crops.
+    '''
+
+    def __init__(self, model, input_shape, approximate=False):
+        super(DenseVgg3D, self).__init__()
+
+        self.input_shape = tuple(int(s) for s in input_shape)
+        self.features = model.features
+
+        stride = np.ones(3, dtype=np.int64)
+        shape = np.array(self.input_shape, dtype=np.int64)
+        padded = False
+        fmaps = None
+        for module in self.features:
+            if isinstance(module, torch.nn.MaxPool3d):
+                kernel_size = np.array(_to_3d(module.kernel_size), dtype=np.int64)
+                if np.any(shape % kernel_size != 0):
+                    raise ValueError("Input shape {} is not divisible by the downsampling "
+                                     "{} at features of shape {}".format(self.input_shape,
+                                                                         tuple(kernel_size),
+                                                                         tuple(shape)))
+                stride *= kernel_size
+                shape //= kernel_size
+            elif isinstance(module, torch.nn.Conv3d):
+                if _to_3d(module.stride) != (1, 1, 1):
+                    raise ValueError("Can not convert strided convolution {}".format(module))
+                padding = np.array(_to_3d(module.padding), dtype=np.int64)
+                extent = (np.array(_to_3d(module.kernel_size), dtype=np.int64) - 1)*\
+                    np.array(_to_3d(module.dilation), dtype=np.int64)
+                padded = padded or bool(np.any(padding > 0))
+                shape += 2*padding - extent
+                fmaps = module.out_channels
+
+        if padded and not approximate:
+            raise ValueError("Model has padded convolutions, dense scores would "
+                             "differ from those of single crops, pass "
+                             "approximate=True to accept this")
+
+        self.exact = not padded
+        self.stride = tuple(int(s) for s in stride)
+        self.feature_shape = tuple(int(s) for s in shape)
+
+        head = []
+        in_channels = fmaps
+        kernel_size = self.feature_shape
+        for module in model.classifier:
+            if isinstance(module, torch.nn.Linear):
+                if module.in_features != in_channels*int(np.prod(kernel_size)):
+                    raise ValueError("Classifier input size {} does not match the "
+                                     "features of shape {}x{}".format(module.in_features,
+                                                                     in_channels,
+                                                                     kernel_size))
+                conv = torch.nn.Conv3d(in_channels,
+                                       module.out_features,
+                                       kernel_size=kernel_size)
+                # Vgg3D flattens features in (c, z, y, x) order
+                conv.weight.data.copy_(
+                    module.weight.data.view(module.out_features, in_channels, *kernel_size))
+                conv.bias.data.copy_(module.bias.data)
+                head.append(conv)
+                in_channels = module.out_features
+                kernel_size = (1, 1, 1)
+            elif isinstance(module, torch.nn.ReLU):
+                head.append(torch.nn.ReLU(inplace=True))
+            elif isinstance(module, torch.nn.Dropout):
+                continue
+            else:
+                raise ValueError("Can not convert classifier layer {}".format(module))
+
+        self.head = torch.nn.Sequential(*head)
+        self.to(next(model.parameters()).device)
+        self.eval()
+
+    def forward(self, raw):
+        '''Class scores of shape ``(b, classes, n_z, n_y, n_x)`` for raw of
+        shape ``(b, 1, z, y, x)``.'''
+
+        return self.head(self.features(raw))
+
+    def get_output_shape(self, raw_shape):
+        return tuple(
+            (r - i)//s + 1
+            for r, i, s in zip(raw_shape, self.input_shape, self.stride))
+
+
+def _to_3d(size):
+    if isinstance(size, int):
+        return (size,)*3
+    return tuple(size)
+
+
+def predict_dense(raw,
+                  model,
+                  step,
+                  device=None,
+                  chunk_shape=(4, 32, 32)):
+    '''Class probabilities of all crops in ``raw`` with offsets on a grid of
+    ``step`` voxels.
+
+    ``step`` has to be a multiple or a divisor of the stride of ``model`` in
+    each dimension. Steps larger than the stride subsample the dense output,
+    smaller steps are predicted by shifting the input and interleaving the
+    outputs (shift and stitch).
+
+    Args:
+
+        raw (``ndarray``):
+
+            uint8 raw data of shape ``(z, y, x)``.
+
+        model (``DenseVgg3D``):
+
+            The model to use.
+
+        step (``tuple of int``):
+
+            Distance of neighbouring crops in voxels.
+
+        chunk_shape (``tuple of int``):
+
+            Maximal number of crops per forward pass in each dimension, to
+            bound the memory of the intermediate feature maps. Chunks do not
+            change the result of an exact model, for an approximate one
+            they put zero padding at chunk boundaries.
+
+    Returns:
+
+        ``ndarray`` of shape ``(classes, n_z, n_y, n_x)``, where entry ``(c,
+        i, j, k)`` is the probability of class ``c`` for the crop starting at
+        voxel ``(i, j, k)*step`` of ``raw``.
+    '''
+
+    if device is None:
+        device = next(model.parameters()).device
+
+    step = np.array(step, dtype=np.int64)
+    stride = np.array(model.stride, dtype=np.int64)
+    input_shape = np.array(model.input_shape, dtype=np.int64)
+
+    if np.any((step % stride != 0) & (stride % step != 0)):
+        raise ValueError("Step {} has to be a multiple or divisor of the network "
+                         "stride {}".format(tuple(step), tuple(stride)))
+
+    # number of shifted passes and subsampling of their output per dimension
+    shifts = np.maximum(stride//step, 1)
+    subsample = np.maximum(step//stride, 1)
+
+    output_shape = (np.array(raw.shape) - input_shape)//step + 1
+    if np.any(output_shape < 1):
+        raise ValueError("Raw of shape {} is smaller than the network input "
+                         "{}".format(raw.shape, tuple(input_shape)))
+
+    probabilities = None
+    for shift in itertools.product(*[range(s) for s in shifts]):
+
+        offset = np.array(shift)*step
+        shifted = raw[offset[0]:, offset[1]:, offset[2]:]
+        # crop to a multiple of the stride beyond the input shape
+        n = (np.array(shifted.shape) - input_shape)//stride + 1
+        if np.any(n < 1):
+            continue
+
+        output = None
+        for begin in itertools.product(*[range(0, m, c) for m, c in zip(n, chunk_shape)]):
+
+            begin = np.array(begin, dtype=np.int64)
+            size = np.minimum(n - begin, chunk_shape)
+            start = begin*stride
+            stop = start + input_shape + (size - 1)*stride
+            chunk = shifted[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+
+            with torch.no_grad():
+                raw_tensor = to_model_input(np.ascontiguousarray(chunk[np.newaxis]), device)
+                scores = F.softmax(model(raw_tensor), dim=1)[0].cpu().numpy()
+
+            if output is None:
+                output = np.zeros((scores.shape[0],) + tuple(n), dtype=np.float32)
+            output[:,
+                   begin[0]:begin[0] + size[0],
+                   begin[1]:begin[1] + size[1],
+                   begin[2]:begin[2] + size[2]] = scores
+
+        output = output[:,
+                        ::subsample[0],
+                        ::subsample[1],
+                        ::subsample[2]]
+
+        if probabilities is None:
+            probabilities = np.zeros((output.shape[0],) + tuple(output_shape),
+                                     dtype=np.float32)
+
+        target = probabilities[:,
+                               shift[0]::shifts[0],
+                               shift[1]::shifts[1],
+                               shift[2]::shifts[2]]
+        target[:] = output[:,
+                           :target.shape[1],
+                           :target.shape[2],
+                           :target.shape[3]]
+
+    return probabilities
+
+
+def predict_dense_in_roi(model,
+                         dataset,
+                         begin,
+                         end,
+                         step,
+                         voxel_size,
+                         device=None,
+                         chunk_shape=(4, 32, 32)):
+    '''Class probabilities for crops centered at ``range(begin, end, step)``
+    (world units) in each dimension, as ``predict_in_roi`` computes them
+    location by location (up to border effects if ``model`` is not exact,
+    see ``DenseVgg3D``).
+
+    Args:
+
+        model (``DenseVgg3D``):
+
+            The model to use.
+
+        dataset (``daisy.Array``):
+
+            The raw data, see ``synister.utils.open_raw_dataset``. Areas
+            outside of it are filled with zeros.
+
+        begin, end, step (``tuple of int``):
+
+            The grid of crop centers in world units. ``step`` has to be a
+            multiple of ``voxel_size``.
+
+    Returns:
+
+        ``ndarray`` of shape ``(classes, n_z, n_y, n_x)``.
+    '''
+
+    begin = np.array(begin, dtype=np.int64)
+    end = np.array(end, dtype=np.int64)
+    step = np.array(step, dtype=np.int64)
+    voxel_size = np.array(voxel_size, dtype=np.int64)
+    input_shape = np.array(model.input_shape, dtype=np.int64)
+
+    if np.any(step % voxel_size != 0):
+        raise ValueError("Step {} is not a multiple of the voxel size "
+                         "{}".format(tuple(step), tuple(voxel_size)))
+
+    grid_shape = -((begin - end)//step)
+    size = input_shape + (grid_shape - 1)*(step//voxel_size)
+
+    # crops are centered at their location, as in get_raw
+    offset = begin - input_shape//2*voxel_size
+    roi = daisy.Roi(daisy.Coordinate(offset),
+                    daisy.Coordinate(size*voxel_size)).snap_to_grid(
+                        daisy.Coordinate(voxel_size), mode='closest')
+    raw = dataset.to_ndarray(roi=roi, fill_value=0).astype(np.uint8, copy=False)
+
+    logger.info("Predict {} locations densely in {}".format(int(np.prod(grid_shape)), roi))
+    probabilities = predict_dense(raw, model, step//voxel_size, device=device,
+                                  chunk_shape=chunk_shape)
+
+    return probabilities[:, :grid_shape[0], :grid_shape[1], :grid_shape[2]]
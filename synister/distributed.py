@@ -0,0 +1,99 @@
+import logging
+import os
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+
+def init_distributed(backend="gloo"):
+    '''Join the process group described by the ``RANK``, ``WORLD_SIZE``,
+    ``MASTER_ADDR`` and ``MASTER_PORT`` environment variables, if
+    ``WORLD_SIZE`` is larger than one.
+
+    Returns:
+
+        ``(rank, world_size)``, ``(0, 1)`` if not distributed.
+    '''
+
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size <= 1:
+        return 0, 1
+
+    if not dist.is_initialized():
+        dist.init_process_group(backend, init_method="env://")
+
+    rank = dist.get_rank()
+    logger.info("Rank {} of {} joined process group".format(rank, world_size))
+    return rank, world_size
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def broadcast_parameters(model, src=0):
+    '''Copy parameters and buffers of ``model`` on rank ``src`` to all
+    ranks.'''
+
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, src)
+
+
+def broadcast_flag(flag, src=0):
+    '''The value of ``flag`` on rank ``src``, on all ranks.'''
+
+    tensor = torch.tensor([int(flag)])
+    dist.broadcast(tensor, src)
+    return bool(tensor.item())
+
+
+def all_ranks_equal(value):
+    '''Whether the integer ``value`` is the same on all ranks.'''
+
+    tensor = torch.tensor([int(value), -int(value)])
+    dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+    return tensor[0].item() == -tensor[1].item()
+
+
+class AllReduceOptimizer(object):
+    '''Wraps an optimizer to average the gradients over all ranks before each
+    step, with one all-reduce of all gradients flattened into a single
+    buffer.
+
+    All other attributes (``zero_grad``, ``state_dict``, ``param_groups``,
+    ...) are those of the wrapped optimizer, so that the model and its
+    checkpoints look the same as without distribution.
+    '''
+
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+
+    def __getattr__(self, name):
+        return getattr(self.optimizer, name)
+
+    def step(self, closure=None):
+
+        grads = [
+            p.grad.data
+            for group in self.optimizer.param_groups
+            for p in group["params"]
+            if p.grad is not None
+        ]
+
+        if grads:
+            flat = torch.cat([g.reshape(-1) for g in grads])
+            dist.all_reduce(flat)
+            flat /= dist.get_world_size()
+
+            offset = 0
+            for g in grads:
+                g.copy_(flat[offset:offset + g.numel()].view_as(g))
+                offset += g.numel()
+
+        return self.optimizer.step(closure)
@@ -1,26 +1,56 @@
 from gunpowder import *
-from synister.synister_db import SynisterDb
-import random
+from gunpowder.profiling import ProfilingStats
+from gunpowder.torch import Train
+from synister.checkpoint import get_latest_checkpoint, restore_rng_state
+from synister.crop_cache import CropCache
+from synister.distributed import get_rank, get_world_size, broadcast_parameters, \
+    all_ranks_equal
+from synister.point_table import get_point_table, get_unknown_locations
+import collections
+import h5py
+import json
+import logging
+import multiprocessing
 import numpy as np
+import os
+import queue
+import time
+
+logger = logging.getLogger(__name__)
 
 class SynapseSourceMongo(CsvPointsSource):
+    """Provides the train synapses of ``synapse_type`` in ``split_name``.
+
+    All sources of a process read their points from the same
+    ``PointTable``, which is queried once (or loaded from
+    ``point_table_snapshot``, if given and existing).
+    """
+
     def __init__(self, db_credentials, 
                        db_name, 
                        split_name, 
                        synapse_type, 
                        points,
                        points_spec=None, 
-                       scale=None):
+                       scale=None,
+                       point_table_snapshot=None):
 
-        self.db = SynisterDb(db_credentials, db_name)
+        self.db_credentials = db_credentials
         self.split_name = split_name
         self.db_name = db_name
         self.synapse_type = synapse_type
+        self.point_table_snapshot = point_table_snapshot
         super(SynapseSourceMongo, self).__init__(filename=None,
                                                  points=points,
                                                  points_spec=points_spec,
                                                  scale=scale)
 
+    def get_point_table(self):
+        return get_point_table(self.db_credentials,
+                               self.db_name,
+                               self.split_name,
+                               snapshot_file=self.point_table_snapshot)
+
     def _read_points(self):
         print("Reading split {} type {} from db {}".format(self.split_name, 
                                                                self.synapse_type,
@@ -28,19 +58,8 @@ class SynapseSourceMongo(CsvPointsSource):
         if self.synapse_type[0] == "unknown":
             points = self.get_unknown_synapse_type()
         else:
-            synapses = self.db.get_synapses(neurotransmitters=self.synapse_type,
-                                            split_name=self.split_name)
-
-            points = np.array([
-                                [
-                                    int(synapse["z"]),
-                                    int(synapse["y"]),
-                                    int(synapse["x"])
-                                    
-                                ]
-                            for synapse in synapses.values()
-                            if synapse["splits"][self.split_name] == "train"
-                            ])
+            points = self.get_point_table().get_locations(neurotransmitters=self.synapse_type,
+                                                          split_part="train")
 
         print(self.synapse_type, np.shape(points))
         self.data = points
@@ -50,56 +69,9 @@ class SynapseSourceMongo(CsvPointsSource):
         """
         Samples points around known synaptic locations
         and offsets by a randomly chosen offset vector on
-        the sphere.
+        the sphere, rejecting points close to any synapse.
         """
-        nt_types_all = ["gaba", "acetylcholine", "glutamate", 
-                        "serotonin", "octopamine", "dopamine"]
-        n_type = 5000
-
-        synapse_locs = []
-        for nt in nt_types_all:
-            synapses_nt = self.db.get_synapses(neurotransmitters=(nt,), 
-                                               split_name=self.split_name)
-            points_nt = [
-                            [
-                                int(synapse["z"]),
-                                int(synapse["y"]),
-                                int(synapse["x"])
-                                
-                            ]
-                        for synapse in synapses_nt.values()
-                        if synapse["splits"][self.split_name] == "train"
-                            ]
-
-            random.shuffle(points_nt)
-            n = min(len(points_nt), n_type)
-            synapse_locs.extend(points_nt[:n])
-
-        
-        random_offsets = self.get_random_offsets(len(synapse_locs))
-        synapse_locs = np.array(synapse_locs, dtype=np.int64)
-        print("Syn locs", np.shape(synapse_locs))
-        print("Rand offsets", np.shape(random_offsets))
-
-        synapse_locs += random_offsets.astype(np.int64)
-        return synapse_locs
-
-    def sample_trig(self, npoints):
-        theta = 2*np.pi*np.random.rand(npoints)
-        phi = np.arccos(2*np.random.rand(npoints)-1)
-        x = np.cos(theta) * np.sin(phi)
-        y = np.sin(theta) * np.sin(phi)
-        z = np.cos(phi)
-        return np.array([z,y,x])
-
-    def sample_radii(self, npoints, d_min=2000, d_max=4000):
-        return np.random.randint(d_min, high=d_max, size=npoints)
-
-    def get_random_offsets(self, npoints):
-        direction_samples = self.sample_trig(npoints)
-        radii_samples = self.sample_radii(npoints)
-        offset_samples = np.array(direction_samples * radii_samples, dtype=np.int64)
-        return offset_samples.T
+        return get_unknown_locations(self.get_point_table())
 
 class SynapseTypeSource(BatchProvider):
     def __init__(self, synapse_types, synapse_type, array):
@@ -128,6 +100,193 @@ class SynapseTypeSource(BatchProvider):
         return batch
 
 
+class CropCacheSource(BatchProvider):
+    """Provides random crops of a local crop cache (see
+    ``synister.crop_cache``) and their labels.
+
+    Crops are provided in a coordinate frame centered on their synapse, i.e.,
+    requests for ``raw`` should be centered at the origin. Parts of the
+    request outside of the cached crop (including its margin) are filled
+    with zeros.
+
+    Args:
+
+        cache_dir (``string``):
+
+            Crop cache built with labels.
+
+        raw (``ArrayKey``):
+
+            Key to provide the uint8 crops with.
+
+        voxel_size (``Coordinate``):
+
+            Voxel size of the cached crops, has to match the one the cache
+            was built with.
+
+        label (``int``, optional):
+
+            Only provide crops with this label.
+
+        synapse_type (``ArrayKey``, optional):
+
+            Key to provide the label of the crop with.
+
+        synapse_types (``list of string``, optional):
+
+            The synapse types the labels are indices of, has to match the
+            ones the cache was built with.
+    """
+
+    def __init__(self, cache_dir, raw, voxel_size, label=None, synapse_type=None,
+                 synapse_types=None):
+        self.cache_dir = cache_dir
+        self.raw = raw
+        self.voxel_size = Coordinate(voxel_size)
+        self.label = label
+        self.synapse_type = synapse_type
+        self.synapse_types = synapse_types
+
+    def setup(self):
+        self.cache = CropCache(self.cache_dir,
+                               voxel_size=self.voxel_size,
+                               synapse_types=self.synapse_types)
+
+        if self.cache.labels is None and (self.label is not None or self.synapse_type is not None):
+            raise ValueError("Crop cache {} has no labels".format(self.cache_dir))
+
+        if self.label is None:
+            self.rows = np.arange(len(self.cache))
+        else:
+            self.rows = np.flatnonzero(self.cache.labels == self.label)
+        if len(self.rows) == 0:
+            raise ValueError("No crops with label {} in {}".format(self.label, self.cache_dir))
+
+        crop_shape = Coordinate(self.cache.crops.shape[1:])
+        self.crop_roi = Roi(-(crop_shape//2)*self.voxel_size, crop_shape*self.voxel_size)
+
+        self.provides(
+            self.raw,
+            ArraySpec(
+                roi=self.crop_roi,
+                voxel_size=self.voxel_size,
+                interpolatable=True,
+                dtype=np.uint8))
+
+        if self.synapse_type is not None:
+            self.provides(
+                self.synapse_type,
+                ArraySpec(
+                    nonspatial=True,
+                    dtype=np.int64))
+
+    def provide(self, request):
+        batch = Batch()
+        row = np.random.choice(self.rows)
+
+        if self.raw in request:
+            roi = request[self.raw].roi
+            data = np.zeros(roi.get_shape()/self.voxel_size, dtype=np.uint8)
+
+            intersection = roi.intersect(self.crop_roi)
+            if not intersection.empty():
+                source = (intersection - self.crop_roi.get_begin())/self.voxel_size
+                target = (intersection - roi.get_begin())/self.voxel_size
+                data[target.to_slices()] = self.cache.crops[(row,) + source.to_slices()]
+
+            spec = self.spec[self.raw].copy()
+            spec.roi = roi
+            batch.arrays[self.raw] = Array(data, spec)
+
+        if self.synapse_type is not None and self.synapse_type in request:
+            batch.arrays[self.synapse_type] = Array(
+                np.int64(self.cache.labels[row]),
+                self.spec[self.synapse_type].copy())
+
+        return batch
+
+
+class RandomSynapseLocation(BatchFilter):
+    """Centers each request on a randomly chosen synapse, without rejection
+    sampling.
+
+    A point is drawn from the points read by ``point_source`` (uniformly,
+    or proportional to ``weights``), jittered by a uniform random offset of
+    at most ``jitter`` in each dimension, and the request is shifted such
+    that its center is at this location. The cost of a sample does not
+    depend on the density of the points.
+
+    Args:
+
+        point_source (``SynapseSourceMongo``):
+
+            Upstream source of the points, its points are used once it is
+            set up.
+
+        voxel_size (``Coordinate``):
+
+            The request is shifted by multiples of the voxel size.
+
+        jitter (``Coordinate``, optional):
+
+            Maximal offset of the request center from the chosen point, in
+            world units.
+
+        weights (``ndarray``, optional):
+
+            A non-negative weight per point.
+    """
+
+    def __init__(self, point_source, voxel_size, jitter=None, weights=None):
+        self.point_source = point_source
+        self.voxel_size = Coordinate(voxel_size)
+        self.jitter = jitter
+        self.weights = weights
+
+    def setup(self):
+        self.locations = np.asarray(self.point_source.data, dtype=np.int64).reshape(-1, 3)
+        if len(self.locations) == 0:
+            raise ValueError("No points to sample from for {}".format(
+                self.point_source.synapse_type))
+
+        self.probabilities = None
+        if self.weights is not None:
+            weights = np.asarray(self.weights, dtype=np.float64)
+            if len(weights) != len(self.locations):
+                raise ValueError("Got {} weights for {} points".format(len(weights),
+                                                                       len(self.locations)))
+            self.probabilities = weights/weights.sum()
+
+    def prepare(self, request):
+
+        i = np.random.choice(len(self.locations), p=self.probabilities)
+        center = self.locations[i].astype(np.float64)
+        if self.jitter is not None:
+            jitter = np.array(self.jitter, dtype=np.float64)
+            center += np.random.uniform(-jitter, jitter)
+
+        request_center = np.array(request.get_total_roi().get_center(), dtype=np.float64)
+        voxel_size = np.array(self.voxel_size)
+        self.shift = Coordinate(
+            np.round((center - request_center)/voxel_size).astype(np.int64)*voxel_size)
+
+        for specs in [request.array_specs, request.points_specs]:
+            for key, spec in specs.items():
+                if spec.roi is not None:
+                    specs[key].roi = spec.roi.shift(self.shift)
+
+    def process(self, batch, request):
+
+        for array in batch.arrays.values():
+            if array.spec.roi is not None:
+                array.spec.roi = array.spec.roi.shift(-self.shift)
+
+        for points in batch.points.values():
+            for point in points.data.values():
+                point.location -= self.shift
+            points.spec.roi = points.spec.roi.shift(-self.shift)
+
+
 class InspectLabels(BatchFilter):
     def __init__(self, synapse_type, pred_synapse_type):
         self.synapse_type = synapse_type
@@ -138,6 +297,413 @@ class InspectLabels(BatchFilter):
         print("prediction:", batch[self.pred_synapse_type].data)
 
 
+class TrainingMetrics(BatchFilter):
+    """Records training throughput and quality every ``every`` iterations,
+    as json lines in ``log_file`` and as scalars in the tensorboard
+    ``log_dir``.
+
+    Recorded are samples and batches per second, the mean time spent in
+    each node (from the profiling stats of the batches), the fraction of
+    time spent waiting for input batches, the mean loss and the accuracy
+    per class over the last ``every`` iterations. A high input wait means
+    that training is starved by data loading.
+
+    Args:
+
+        synapse_type (``ArrayKey``):
+
+            The labels.
+
+        pred_synapse_type (``ArrayKey``):
+
+            The class scores predicted by ``Train``.
+
+        class_names (``list of string``):
+
+            Names of the classes, in label order.
+
+        input_wait (``InputWait``, optional):
+
+            The node measuring the time spent waiting for input batches.
+    """
+
+    def __init__(self,
+                 synapse_type,
+                 pred_synapse_type,
+                 class_names,
+                 log_file="metrics.jsonl",
+                 log_dir="log",
+                 every=10,
+                 input_wait=None):
+
+        self.synapse_type = synapse_type
+        self.pred_synapse_type = pred_synapse_type
+        self.class_names = list(class_names)
+        self.log_file = log_file
+        self.log_dir = log_dir
+        self.every = every
+        self.input_wait = input_wait
+
+    def setup(self):
+
+        self.summary_writer = None
+        if self.log_dir is not None:
+            try:
+                from torch.utils.tensorboard import SummaryWriter
+            except ImportError:
+                try:
+                    from tensorboardX import SummaryWriter
+                except ImportError:
+                    SummaryWriter = None
+                    logger.warning("No tensorboard available, metrics are only written to %s",
+                                   self.log_file)
+            if SummaryWriter is not None:
+                self.summary_writer = SummaryWriter(self.log_dir)
+
+        if self.log_file is not None:
+            log_dir = os.path.dirname(self.log_file)
+            if log_dir and not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+
+        self.__reset()
+
+    def teardown(self):
+        if self.summary_writer is not None:
+            self.summary_writer.close()
+
+    def __reset(self):
+        self.start = time.time()
+        self.num_batches = 0
+        self.num_samples = 0
+        self.losses = []
+        self.correct = np.zeros(len(self.class_names), dtype=np.int64)
+        self.total = np.zeros(len(self.class_names), dtype=np.int64)
+        self.profiling_stats = ProfilingStats()
+
+    def process(self, batch, request):
+
+        labels = np.asarray(batch[self.synapse_type].data).reshape(-1).astype(np.int64)
+        predicted = np.argmax(np.asarray(batch[self.pred_synapse_type].data).reshape(
+            len(labels), -1), axis=1)
+
+        self.num_batches += 1
+        self.num_samples += len(labels)
+        if batch.loss is not None:
+            self.losses.append(float(batch.loss))
+        np.add.at(self.total, labels, 1)
+        np.add.at(self.correct, labels, predicted == labels)
+        self.profiling_stats.merge_with(batch.profiling_stats)
+
+        if batch.iteration is not None and batch.iteration % self.every == 0:
+            self.__emit(batch.iteration)
+            self.__reset()
+
+    def __emit(self, iteration):
+
+        elapsed = max(time.time() - self.start, 1e-9)
+        record = {
+            "iteration": int(iteration),
+            "time": time.time(),
+            "samples_per_second": self.num_samples/elapsed,
+            "batches_per_second": self.num_batches/elapsed,
+            "loss": float(np.mean(self.losses)) if self.losses else None,
+            "accuracy": {
+                name: float(self.correct[i]/self.total[i]) if self.total[i] > 0 else None
+                for i, name in enumerate(self.class_names)
+            },
+            "accuracy_total": float(self.correct.sum()/max(self.total.sum(), 1)),
+            "input_wait": (self.input_wait.pop_wait_time()/elapsed
+                           if self.input_wait is not None else None),
+            "nodes": {
+                "{}.{}".format(node_name, method_name): summary.mean()
+                for (node_name, method_name), summary
+                in self.profiling_stats.get_timing_summaries().items()
+            }
+        }
+
+        logger.info("Iteration %d: %.1f samples/s, loss %s, accuracy %.3f, input wait %s",
+                    iteration, record["samples_per_second"], record["loss"],
+                    record["accuracy_total"], record["input_wait"])
+
+        if self.log_file is not None:
+            with open(self.log_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+        if self.summary_writer is not None:
+            scalars = {
+                "metrics/samples_per_second": record["samples_per_second"],
+                "metrics/loss": record["loss"],
+                "metrics/accuracy": record["accuracy_total"],
+                "metrics/input_wait": record["input_wait"]
+            }
+            scalars.update({"accuracy/" + name: accuracy
+                            for name, accuracy in record["accuracy"].items()})
+            scalars.update({"timing/" + node: seconds
+                            for node, seconds in record["nodes"].items()})
+            for tag, value in scalars.items():
+                if value is not None:
+                    self.summary_writer.add_scalar(tag, value, iteration)
+
+
+class InputWait(BatchFilter):
+    """Measures the time spent waiting for batches from upstream, e.g., for
+    a ``PreCache`` to deliver the next batch.
+
+    The accumulated time is read (and reset) by ``TrainingMetrics``.
+    """
+
+    def setup(self):
+        self.wait_time = 0.0
+        self.request_time = None
+
+    def prepare(self, request):
+        self.request_time = time.time()
+
+    def process(self, batch, request):
+        self.wait_time += time.time() - self.request_time
+
+    def pop_wait_time(self):
+        wait_time = self.wait_time
+        self.wait_time = 0.0
+        return wait_time
+
+
+class AsyncSnapshot(BatchFilter):
+    """Writes arrays of every ``every``-th batch to compressed HDF files in a
+    background process, like ``Snapshot`` but off the training path.
+
+    Batches are handed to the writer through a queue of ``queue_size``
+    snapshots. If the writer falls behind, snapshots are dropped instead of
+    blocking training.
+
+    Args:
+
+        dataset_names (``dict``, ``ArrayKey`` -> ``string``):
+
+            The arrays to store and their dataset names.
+
+        keep_last (``int``, optional):
+
+            If given, only the last ``keep_last`` snapshot files written by
+            this node are kept.
+    """
+
+    def __init__(self,
+                 dataset_names,
+                 output_dir="snapshots",
+                 output_filename="batch_{iteration}.hdf",
+                 every=100,
+                 compression="gzip",
+                 queue_size=2,
+                 keep_last=None):
+
+        self.dataset_names = dataset_names
+        self.output_dir = output_dir
+        self.output_filename = output_filename
+        self.every = every
+        self.compression = compression
+        self.queue_size = queue_size
+        self.keep_last = keep_last
+
+    def setup(self):
+
+        self.num_dropped = 0
+        self.snapshot_queue = multiprocessing.Queue(maxsize=self.queue_size)
+        self.writer = multiprocessing.Process(target=snapshot_writer,
+                                              args=(self.snapshot_queue,
+                                                    self.output_dir,
+                                                    self.compression,
+                                                    self.keep_last))
+        self.writer.daemon = True
+        self.writer.start()
+
+    def teardown(self):
+
+        self.snapshot_queue.put(None)
+        self.writer.join()
+        if self.num_dropped > 0:
+            logger.info("Dropped %d snapshots", self.num_dropped)
+
+    def process(self, batch, request):
+
+        if batch.iteration is None or batch.iteration % self.every != 0:
+            return
+
+        datasets = {}
+        for key, name in self.dataset_names.items():
+            if key not in batch.arrays:
+                continue
+            array = batch.arrays[key]
+            attrs = {}
+            if array.spec.roi is not None:
+                attrs["offset"] = tuple(array.spec.roi.get_offset())
+                attrs["resolution"] = tuple(array.spec.voxel_size)
+            # copy, later nodes might change the batch before it is sent
+            datasets[name] = (np.array(array.data, copy=True), attrs)
+
+        filename = self.output_filename.format(iteration=batch.iteration, id=batch.id)
+
+        try:
+            self.snapshot_queue.put_nowait((filename, datasets))
+        except queue.Full:
+            self.num_dropped += 1
+            logger.warning("Snapshot writer is busy, dropped snapshot of iteration %d",
+                           batch.iteration)
+
+
+def snapshot_writer(snapshot_queue, output_dir, compression, keep_last):
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    written = collections.deque()
+    while True:
+        item = snapshot_queue.get()
+        if item is None:
+            break
+
+        filename, datasets = item
+        snapshot_file = os.path.join(output_dir, filename)
+        tmp_file = snapshot_file + ".tmp"
+
+        with h5py.File(tmp_file, "w") as f:
+            for name, (data, attrs) in datasets.items():
+                dataset = f.create_dataset(name,
+                                           data=data,
+                                           compression=compression if data.ndim > 0 else None)
+                for k, v in attrs.items():
+                    dataset.attrs[k] = v
+        os.replace(tmp_file, snapshot_file)
+
+        written.append(snapshot_file)
+        while keep_last is not None and len(written) > keep_last:
+            old_file = written.popleft()
+            if os.path.exists(old_file):
+                os.remove(old_file)
+
+
+class CachedElasticAugment(ElasticAugment):
+    """``ElasticAugment`` that draws its transformations from a pool instead
+    of creating a new one for each batch.
+
+    Creating the elastic deformation, rotation and misalignment and
+    upscaling them to the full resolution dominates the cost of
+    ``ElasticAugment``. For a fixed request shape, this node creates up to
+    ``pool_size`` transformations per shape once, then reuses a random one
+    for each batch, and replaces a random one with a fresh transformation
+    with probability ``refresh_prob``. Warping is done by ``ElasticAugment``
+    as before.
+
+    The pool is created lazily in each process (e.g., each ``PreCache``
+    worker) and holds ``pool_size`` float32 fields of three times the size of
+    the requested raw array.
+
+    ``ElasticAugment`` has no public hook for creating transformations, this
+    node overrides its private ``__create_transformation`` of the gunpowder
+    version pinned in ``requirements.txt`` and ``setup.py`` (commit
+    ``754607a``) and refuses to work with a gunpowder that does not have it.
+
+    Args:
+
+        pool_size (``int``):
+
+            Number of transformations to keep per request shape.
+
+        refresh_prob (``float``):
+
+            Probability to replace a transformation of the pool with a new
+            one, per batch.
+
+        All other arguments are passed on to ``ElasticAugment``.
+    """
+
+    def __init__(self, *args, pool_size=50, refresh_prob=0.05, **kwargs):
+
+        if not hasattr(ElasticAugment, "_ElasticAugment__create_transformation"):
+            raise RuntimeError("CachedElasticAugment requires the gunpowder version "
+                               "pinned in requirements.txt, this ElasticAugment has "
+                               "no __create_transformation to override")
+
+        super(CachedElasticAugment, self).__init__(*args, **kwargs)
+        self.pool_size = pool_size
+        self.refresh_prob = refresh_prob
+        self.pools = {}
+        self.pool_pid = None
+
+    def _ElasticAugment__create_transformation(self, target_shape):
+
+        # workers are forked with a copy of this node, give each its own
+        # pool and random state
+        if self.pool_pid != os.getpid():
+            self.pools = {}
+            self.pool_pid = os.getpid()
+            self.pool_random = np.random.RandomState()
+
+        key = tuple(target_shape)
+        pool = self.pools.setdefault(key, [])
+
+        if len(pool) < self.pool_size:
+            transformation = self.__create_new_transformation(target_shape)
+            pool.append(transformation)
+        else:
+            i = self.pool_random.randint(len(pool))
+            if self.pool_random.rand() < self.refresh_prob:
+                pool[i] = self.__create_new_transformation(target_shape)
+            transformation = pool[i]
+
+        # ElasticAugment modifies the transformation in place
+        return transformation.copy()
+
+    def __create_new_transformation(self, target_shape):
+        return super(CachedElasticAugment, self)._ElasticAugment__create_transformation(
+            target_shape)
+
+
+class ResumableTrain(Train):
+    """``Train`` that resumes from the latest checkpoint
+    ``<checkpoint_basename>_checkpoint_<iteration>``, ignoring derived files
+    with the same prefix (slim, quantized and best checkpoints), and restores
+    the random states of checkpoints written by ``CheckpointManager``.
+
+    Only the random states of the training process are restored. Workers
+    that sample and augment (``PreCache``, ``DataLoader``) seed themselves
+    anew, so the batches after resuming differ from those of an
+    uninterrupted run.
+
+    In data parallel training, all ranks have to resume from the same
+    iteration, otherwise they would disagree on when to validate and stop.
+    The parameters of rank 0 are broadcast to all ranks once the checkpoint
+    is loaded.
+    """
+
+    def _get_latest_checkpoint(self, basename):
+
+        checkpoint, iteration = get_latest_checkpoint(basename)
+        self.resumed_checkpoint = checkpoint
+        self.resumed_iteration = iteration
+        return checkpoint, iteration
+
+    def start(self):
+
+        self.resumed_checkpoint = None
+        self.resumed_iteration = 0
+        super(ResumableTrain, self).start()
+
+        if get_world_size() > 1 and not all_ranks_equal(self.resumed_iteration):
+            raise RuntimeError("Rank {} resumed from iteration {}, other ranks from other "
+                               "iterations. Checkpoints have to be on a file system "
+                               "shared by all ranks.".format(get_rank(),
+                                                             self.resumed_iteration))
+
+        if self.resumed_checkpoint is not None:
+            logger.info("Resumed from %s", self.resumed_checkpoint)
+            if not restore_rng_state(self.resumed_checkpoint):
+                logger.info("%s has no random states", self.resumed_checkpoint)
+
+        if get_world_size() > 1:
+            broadcast_parameters(self.model)
+
+
 class AddChannelDim(BatchFilter):
 
     def __init__(self, array):
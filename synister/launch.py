@@ -0,0 +1,105 @@
+import logging
+import os
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+
+def get_cpu_groups(num_workers, num_cpus):
+    '''Split the CPUs available to this process into ``num_workers`` groups
+    of ``num_cpus`` CPUs. Groups wrap around (and overlap) if there are not
+    enough CPUs for all workers.'''
+
+    available = sorted(os.sched_getaffinity(0))
+
+    if num_workers*num_cpus > len(available):
+        logger.warning("{} workers with {} CPUs each exceed the {} available CPUs, "
+                       "CPU groups will overlap".format(num_workers, num_cpus, len(available)))
+
+    return [
+        sorted(set(available[(i*num_cpus + j) % len(available)] for j in range(num_cpus)))
+        for i in range(num_workers)
+    ]
+
+
+def run_local(cmds,
+              num_cpus,
+              log_dir=None,
+              envs=None):
+    '''Run the given shell commands concurrently as local subprocesses and
+    wait for all of them to finish.
+
+    Each process is pinned to its own group of ``num_cpus`` CPUs and its
+    thread pools (OpenMP, MKL, torch) are limited to ``num_cpus`` threads.
+
+    Args:
+
+        cmds (``list of string``):
+
+            The commands to run, one per worker.
+
+        num_cpus (``int``):
+
+            Number of CPUs (and threads) per worker.
+
+        log_dir (``string``, optional):
+
+            If given, stdout and stderr of worker ``i`` are written to
+            ``<log_dir>/worker_<i>.log``.
+
+        envs (``list of dict``, optional):
+
+            Additional environment variables per worker.
+
+    Returns:
+
+        List of exit codes, one per command. Raises a ``RuntimeError`` if
+        any of the commands failed.
+    '''
+
+    if log_dir is not None and not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    cpu_groups = get_cpu_groups(len(cmds), num_cpus)
+
+    processes = []
+    log_files = []
+    for i, cmd in enumerate(cmds):
+
+        env = dict(os.environ)
+        for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+            env[var] = str(num_cpus)
+        if envs is not None:
+            env.update({k: str(v) for k, v in envs[i].items()})
+
+        if log_dir is not None:
+            log_file = os.path.join(log_dir, "worker_{}.log".format(i))
+            log = open(log_file, "w")
+        else:
+            log_file = None
+            log = None
+
+        logger.info("Start worker {} on CPUs {}: {}".format(i, cpu_groups[i], cmd))
+        processes.append(subprocess.Popen(
+            cmd,
+            shell=True,
+            stdout=log,
+            stderr=subprocess.STDOUT if log is not None else None,
+            env=env,
+            preexec_fn=lambda cpus=cpu_groups[i]: os.sched_setaffinity(0, cpus)))
+        log_files.append((log_file, log))
+
+    exit_codes = [process.wait() for process in processes]
+
+    for log_file, log in log_files:
+        if log is not None:
+            log.close()
+
+    failed = [i for i, code in enumerate(exit_codes) if code != 0]
+    if failed:
+        raise RuntimeError("Workers {} failed with exit codes {}{}".format(
+            failed,
+            [exit_codes[i] for i in failed],
+            ", see logs in {}".format(log_dir) if log_dir is not None else ""))
+
+    return exit_codes
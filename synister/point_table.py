@@ -0,0 +1,232 @@
+from scipy.spatial import cKDTree
+from synister.synister_db import SynisterDb
+import logging
+import numpy as np
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class PointTable(object):
+    '''Locations, split parts and known neurotransmitters of all synapses of
+    a split, loaded once from the DB (or a local snapshot) and partitioned in
+    numpy.
+
+    Args:
+
+        synapse_ids (``ndarray``):
+
+            The synapse ids.
+
+        locations (``ndarray``):
+
+            ``z``, ``y``, ``x`` of each synapse in world units.
+
+        split_parts (``ndarray``):
+
+            Split part of each synapse (``train``, ``test`` or
+            ``validation``).
+
+        neurotransmitters (``ndarray``):
+
+            Known neurotransmitters of the skeleton of each synapse, as a
+            sorted, comma separated string (empty if unknown).
+    '''
+
+    def __init__(self,
+                 synapse_ids,
+                 locations,
+                 split_parts,
+                 neurotransmitters,
+                 split_name=None):
+
+        self.synapse_ids = np.asarray(synapse_ids, dtype=np.int64)
+        self.locations = np.asarray(locations, dtype=np.int64).reshape(-1, 3)
+        self.split_parts = np.asarray(split_parts, dtype=str)
+        self.neurotransmitters = np.asarray(neurotransmitters, dtype=str)
+        self.split_name = split_name
+
+    def __len__(self):
+        return len(self.synapse_ids)
+
+    def get_mask(self, neurotransmitters=None, split_part=None):
+        '''Boolean mask of the synapses with the given combination of
+        neurotransmitters (tuple of string) and split part.'''
+
+        mask = np.ones(len(self), dtype=bool)
+        if neurotransmitters is not None:
+            if not isinstance(neurotransmitters, tuple):
+                raise TypeError("Neurotransmitters must be a tuple of strings")
+            mask &= self.neurotransmitters == get_neurotransmitters_key(neurotransmitters)
+        if split_part is not None:
+            mask &= self.split_parts == split_part
+        return mask
+
+    def get_locations(self, neurotransmitters=None, split_part=None):
+        return self.locations[self.get_mask(neurotransmitters, split_part)]
+
+    def get_synapse_ids(self, neurotransmitters=None, split_part=None):
+        return self.synapse_ids[self.get_mask(neurotransmitters, split_part)]
+
+    @staticmethod
+    def from_db(db_credentials, db_name, split_name):
+        '''Read the point table of ``split_name`` with two queries.'''
+
+        db = SynisterDb(db_credentials, db_name)
+        synapses = db.get_synapses(split_name=split_name)
+        skeletons = db.get_skeletons()
+
+        synapse_ids = sorted(synapses.keys())
+        logger.info("Read {} synapses of split {} from db {}".format(len(synapse_ids),
+                                                                     split_name,
+                                                                     db_name))
+
+        def nt_key(skeleton_id):
+            skeleton = skeletons.get(skeleton_id)
+            if skeleton is None or skeleton["nt_known"] is None:
+                return ""
+            return get_neurotransmitters_key(skeleton["nt_known"])
+
+        return PointTable(
+            synapse_ids,
+            [(int(synapses[s]["z"]), int(synapses[s]["y"]), int(synapses[s]["x"]))
+             for s in synapse_ids],
+            [synapses[s]["splits"][split_name] for s in synapse_ids],
+            [nt_key(synapses[s]["skeleton_id"]) for s in synapse_ids],
+            split_name=split_name)
+
+    def save(self, snapshot_file):
+
+        snapshot_dir = os.path.dirname(snapshot_file)
+        if snapshot_dir and not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir, exist_ok=True)
+
+        # write to a temporary file first, other jobs might be reading it
+        tmp_file = snapshot_file + ".tmp{}.npz".format(os.getpid())
+        np.savez(tmp_file,
+                 synapse_ids=self.synapse_ids,
+                 locations=self.locations,
+                 split_parts=self.split_parts,
+                 neurotransmitters=self.neurotransmitters,
+                 split_name=np.array(self.split_name if self.split_name is not None else ""))
+        os.replace(tmp_file, snapshot_file)
+
+    @staticmethod
+    def load(snapshot_file):
+
+        with np.load(snapshot_file) as snapshot:
+            return PointTable(snapshot["synapse_ids"],
+                              snapshot["locations"],
+                              snapshot["split_parts"],
+                              snapshot["neurotransmitters"],
+                              split_name=str(snapshot["split_name"]) or None)
+
+
+def get_neurotransmitters_key(neurotransmitters):
+    return ",".join(sorted(neurotransmitters))
+
+
+# point tables loaded by this process
+_point_tables = {}
+
+
+def get_point_table(db_credentials, db_name, split_name, snapshot_file=None):
+    '''Get the point table of the given split, shared by all callers in this
+    process.
+
+    If ``snapshot_file`` is given, the table is loaded from there if it
+    exists, otherwise it is read from the DB and saved there.'''
+
+    key = (db_credentials, db_name, split_name, snapshot_file)
+    if key in _point_tables:
+        return _point_tables[key]
+
+    if snapshot_file is not None and os.path.exists(snapshot_file):
+        logger.info("Load point table from {}".format(snapshot_file))
+        table = PointTable.load(snapshot_file)
+        if table.split_name != split_name:
+            raise ValueError("Point table {} is of split {}, not {}".format(snapshot_file,
+                                                                            table.split_name,
+                                                                            split_name))
+    else:
+        table = PointTable.from_db(db_credentials, db_name, split_name)
+        if snapshot_file is not None:
+            table.save(snapshot_file)
+
+    _point_tables[key] = table
+    return table
+
+
+def sample_unknown_locations(point_table,
+                             neurotransmitters=("gaba", "acetylcholine", "glutamate",
+                                                "serotonin", "octopamine", "dopamine"),
+                             n_per_type=5000,
+                             d_min=2000,
+                             d_max=4000,
+                             min_distance=1000,
+                             max_rounds=10,
+                             seed=None):
+    """Sample locations near, but not on, known synapses.
+
+    Up to ``n_per_type`` train synapses of each of the given neurotransmitters
+    are offset by a random vector of length in ``[d_min, d_max)`` (world
+    units) in a uniformly random direction. Candidates closer than
+    ``min_distance`` to any synapse of the table are redrawn, for at most
+    ``max_rounds`` rounds, and dropped if still too close.
+
+    Returns:
+
+        ``ndarray`` of shape ``(n, 3)``, ``z``, ``y``, ``x`` in world units.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    base = []
+    for nt in neurotransmitters:
+        locations = point_table.get_locations(neurotransmitters=(nt,), split_part="train")
+        n = min(len(locations), n_per_type)
+        base.append(locations[rng.choice(len(locations), n, replace=False)])
+    base = np.concatenate(base) if base else np.zeros((0, 3), dtype=np.int64)
+
+    tree = cKDTree(point_table.locations)
+
+    samples = np.zeros((0, 3), dtype=np.int64)
+    for _ in range(max_rounds):
+        if len(base) == 0:
+            break
+
+        # uniform directions on the sphere, (z, y, x)
+        theta = 2*np.pi*rng.rand(len(base))
+        phi = np.arccos(2*rng.rand(len(base)) - 1)
+        directions = np.stack([np.cos(phi),
+                               np.sin(theta)*np.sin(phi),
+                               np.cos(theta)*np.sin(phi)], axis=1)
+        radii = rng.randint(d_min, d_max, size=len(base))
+        candidates = base + (directions*radii[:, np.newaxis]).astype(np.int64)
+
+        # distance is inf if there is no synapse within min_distance
+        distances, _ = tree.query(candidates, k=1, distance_upper_bound=min_distance)
+        accepted = np.isinf(distances)
+
+        samples = np.concatenate([samples, candidates[accepted]])
+        base = base[~accepted]
+
+    if len(base) > 0:
+        logger.info("Dropped {} unknown locations within {} of a synapse".format(len(base),
+                                                                                 min_distance))
+
+    return samples
+
+
+# unknown locations sampled by this process, by point table
+_unknown_locations = {}
+
+
+def get_unknown_locations(point_table, **kwargs):
+    """``sample_unknown_locations`` of ``point_table``, cached per point table
+    (i.e., per split) and arguments in this process."""
+
+    key = (id(point_table), tuple(sorted(kwargs.items())))
+    if key not in _unknown_locations:
+        _unknown_locations[key] = sample_unknown_locations(point_table, **kwargs)
+    return _unknown_locations[key]
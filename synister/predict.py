@@ -1,6 +1,6 @@
 from funlib.run import run, run_singularity
-from subprocess import check_call
 import os
+from synister.launch import run_local
 from synister.read_config import \
     read_worker_config, \
     read_predict_config, \
@@ -53,19 +53,30 @@ def monitor_prediction(
         time.sleep(interval)
 
 
-def predict(predict_config, worker_config):
+def predict(predict_configs, worker_config, base_cmd):
+    """Initialize the prediction runs given by ``predict_configs`` and start
+    ``base_cmd`` on the block workers. Several runs are only passed if the
+    workers predict all of them in one pass (``multi_model``)."""
 
-    db = SynisterDb(
-        predict_config["db_credentials"],
-        predict_config["db_name_data"])
+    for predict_config in predict_configs:
+        db = SynisterDb(
+            predict_config["db_credentials"],
+            predict_config["db_name_data"])
 
-    db.initialize_prediction(
-        predict_config["split_name"],
-        predict_config["experiment"],
-        predict_config["train_number"],
-        predict_config["predict_number"],
-        overwrite=predict_config["overwrite"],
-        validation=predict_config["split_part"] == "validation")
+        db.initialize_prediction(
+            predict_config["split_name"],
+            predict_config["experiment"],
+            predict_config["train_number"],
+            predict_config["predict_number"],
+            overwrite=predict_config["overwrite"],
+            validation=predict_config["split_part"] == "validation")
+
+    for predict_config in predict_configs:
+        thread = threading.Thread(
+            target=monitor_prediction,
+            args=(predict_config, 60))
+        thread.daemon = True
+        thread.start()
 
     num_block_workers = worker_config["num_block_workers"]
     singularity = worker_config["singularity_container"]
@@ -117,18 +128,13 @@ def predict(predict_config, worker_config):
 
     else:
 
-        # run locally without singularity
+        # run locally without singularity, all workers concurrently
         assert(singularity is None)
-        for worker_id in range(num_block_workers):
-            check_call(
-                base_cmd + " {} {}".format(worker_id, num_block_workers),
-                shell=True)
-
-    thread = threading.Thread(
-        target=monitor_prediction,
-        args=(predict_config, 60))
-    thread.daemon = True
-    thread.start()
+        run_local(
+            [base_cmd + " {} {}".format(worker_id, num_block_workers)
+             for worker_id in range(num_block_workers)],
+            num_cpus=worker_config["num_cpus"],
+            log_dir="worker_logs")
 
 
 if __name__ == '__main__':
@@ -149,16 +155,30 @@ if __name__ == '__main__':
 
     predict_config_template.update(train_config)
 
+    predict_configs = []
     for iteration in predict_config_template['iterations']:
-
-        base_cmd = "python {} {}".format(
-            os.path.join(self_path, "predict_pipeline.py"),
-            iteration)
-
         predict_config = dict(predict_config_template)
         predict_config['train_checkpoint'] = os.path.join(
             setup_dir,
             f'model_checkpoint_{iteration}')
         predict_config['predict_number'] = iteration
+        predict_configs.append(predict_config)
+
+    if predict_config_template['multi_model']:
+
+        # read each crop once and run all checkpoints on it
+        base_cmd = "python {} {}".format(
+            os.path.join(self_path, "predict_pipeline.py"),
+            ",".join(str(cfg['predict_number']) for cfg in predict_configs))
+
+        predict(predict_configs, worker_config, base_cmd)
+
+    else:
+
+        for predict_config in predict_configs:
+
+            base_cmd = "python {} {}".format(
+                os.path.join(self_path, "predict_pipeline.py"),
+                predict_config['predict_number'])
 
-        predict(predict_config, worker_config)
+            predict([predict_config], worker_config, base_cmd)
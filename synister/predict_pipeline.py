@@ -3,15 +3,23 @@ from synister.read_config import \
     read_worker_config, \
     read_predict_config, \
     read_train_config
+from synister.checkpoint import load_weights
+from synister.crop_cache import CropCache
+from synister.prediction_store import PredictionStoreWriter, get_run_name
+from synister.quantize import load_quantized_vgg, get_quantized_checkpoint
 from synister.synister_db import SynisterDb
-from synister.utils import init_vgg, predict, get_raw
+from synister.timing import StageTimer
+from synister.utils import init_vgg, predict, get_raw, RawReaderPool
 import json
 import logging
 import multiprocessing
 import numpy as np
 import os
+import queue
 import sys
+import time
 import torch
+import traceback
 
 
 logger = logging.getLogger(__name__)
@@ -20,6 +28,40 @@ self_path = os.path.realpath(os.path.dirname(__file__))
 torch.backends.cudnn.enabled = True
 torch.backends.cudnn.benchmark = True
 
+def load_model(train_checkpoint,
+               input_shape,
+               fmaps,
+               downsample_factors,
+               synapse_types,
+               neither_class,
+               network="VGG",
+               fmap_inc=(2,2,2,2),
+               n_convolutions=(2,2,2,2),
+               quantized=False):
+
+    if quantized:
+        device = torch.device("cpu")
+        model = load_quantized_vgg(get_quantized_checkpoint(train_checkpoint))
+    elif network == "VGG":
+        output_classes = len(synapse_types)
+        if neither_class:
+            output_classes +=1
+        model = Vgg3D(input_size=input_shape,
+                      fmaps=fmaps,
+                      downsample_factors=downsample_factors,
+                      fmap_inc=fmap_inc,
+                      n_convolutions=n_convolutions,
+                      output_classes=output_classes)
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        model.to(device)
+        load_weights(model, train_checkpoint, device)
+    else:
+        raise NotImplementedError("Only VGG network accesible.")
+
+    model.eval()
+    return model, device
+
+
 def test(worker_id,
          train_checkpoint,
          db_credentials,
@@ -45,145 +87,365 @@ def test(worker_id,
          fmap_inc=(2,2,2,2),
          n_convolutions=(2,2,2,2),
          network_appendix=None,
+         quantized=False,
+         queue_size=16,
+         write_buffer_size=256,
+         write_interval=10.0,
+         chunk_size=256,
+         lease_time=600,
+         max_wait=3600,
+         crop_cache=None,
+         timing_dir="timing",
+         timing_interval=60.0,
+         num_reader_workers=0,
+         prediction_store=None,
          **kwargs):
+    """Predict all synapses of the run(s) given by ``predict_number``.
+
+    ``train_checkpoint`` and ``predict_number`` can also be lists of the same
+    length, to predict with several checkpoints of the same train setup in
+    one pass over the raw data. Each crop is then read once, passed through
+    all models, and written to the prediction collection of each run. Leases
+    are held in the first run, synapses are claimed until every run has their
+    prediction. All runs have to be initialized together.
+
+    If ``crop_cache`` is given, crops are read from this local crop cache
+    (see ``synister.crop_cache``) instead of ``raw_container``.
+
+    With ``num_reader_workers > 0``, crops are read in parallel by a
+    persistent ``RawReaderPool``.
+
+    Timings of all stages are written as json lines to ``timing_dir`` every
+    ``timing_interval`` seconds, one file per worker and prediction writer.
+
+    If ``prediction_store`` is given, predictions are also written to this
+    directory, see ``synister.prediction_store``.
+
+    Synapses leased by other workers are waited for, until no prediction
+    of the run(s) was written for ``max_wait`` seconds.
+    """
 
     if not split_part in ["validation", "test"]:
         raise ValueError("'split_part' must be either 'test' or 'validation'")
 
-    print("Network: ", network)
-    if network == "VGG":
-        output_classes = len(synapse_types)
-        if neither_class:
-            output_classes +=1
-        model = Vgg3D(input_size=input_shape,
-                      fmaps=fmaps,
-                      downsample_factors=downsample_factors,
-                      fmap_inc=fmap_inc,
-                      n_convolutions=n_convolutions,
-                      output_classes=output_classes)
+    if isinstance(predict_number, (list, tuple)):
+        train_checkpoints = list(train_checkpoint)
+        predict_numbers = list(predict_number)
     else:
-        raise NotImplementedError("Only VGG network accesible.")
-
+        train_checkpoints = [train_checkpoint]
+        predict_numbers = [predict_number]
+    assert len(train_checkpoints) == len(predict_numbers)
+
+    timer = StageTimer("worker_{}".format(worker_id),
+                       log_file=get_timing_file(timing_dir, predict_numbers[0], worker_id),
+                       emit_interval=timing_interval)
+
+    reader_pool = None
+    if num_reader_workers > 0 and crop_cache is None:
+        # start the readers before the models are on the device
+        reader_pool = RawReaderPool(input_shape,
+                                    voxel_size,
+                                    raw_container,
+                                    raw_dataset,
+                                    num_workers=num_reader_workers,
+                                    max_batch_size=batch_size)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
-    checkpoint = torch.load(train_checkpoint, map_location=device)
-    model.load_state_dict(checkpoint['model_state_dict'])
-
-    model.eval()
+    print("Network: ", network)
+    models = []
+    for checkpoint in train_checkpoints:
+        logger.info("Load model {}...".format(checkpoint))
+        models.append(load_model(checkpoint,
+                                 input_shape,
+                                 fmaps,
+                                 downsample_factors,
+                                 synapse_types,
+                                 neither_class,
+                                 network=network,
+                                 fmap_inc=fmap_inc,
+                                 n_convolutions=n_convolutions,
+                                 quantized=quantized))
 
     logger.info('Load test sample locations from db {} and split {}...'.format(db_name_data, split_name))
     db = SynisterDb(db_credentials, db_name_data)
 
     logger.info('Initialize prediction writers...')
-    prediction_queue = multiprocessing.JoinableQueue()
+    # bounded queue, blocks the model loop if the writers fall behind
+    prediction_queue = multiprocessing.JoinableQueue(maxsize=queue_size)
+    # exceptions of the writers, raised here
+    error_queue = multiprocessing.Queue()
 
+    writers = []
     for i in range(num_cache_workers):
-        worker = multiprocessing.Process(target=prediction_writer,
-                                         args=(prediction_queue,
+        worker = multiprocessing.Process(target=run_prediction_writer,
+                                         args=(error_queue,
+                                               prediction_queue,
                                                db_credentials,
                                                db_name_data,
                                                split_name,
                                                experiment,
                                                train_number,
-                                               predict_number))
+                                               write_buffer_size,
+                                               write_interval,
+                                               get_timing_file(timing_dir,
+                                                               predict_numbers[0],
+                                                               worker_id,
+                                                               writer_id=i),
+                                               timing_interval,
+                                               prediction_store))
         #worker.daemon = True
         worker.start()
+        writers.append(worker)
 
 
     logger.info('Start prediction...')
 
-    locations = []
-    synapses = db.get_synapses(split_name=split_name)
-    predict_synapses = db.get_predictions(split_name,
-                                          experiment,
-                                          train_number,
-                                          predict_number)
-
-    locations = [(int(synapse["z"]), 
-                  int(synapse["y"]),
-                  int(synapse["x"]))
-                  for synapse_id, synapse in synapses.items()
-                  if synapse["splits"][split_name]==split_part and
-                  predict_synapses[synapse_id]["prediction"] == None]
-
-    loc_start = int(float(worker_id)/num_block_workers * len(locations)) 
-    loc_end = int(float(worker_id + 1)/num_block_workers * len(locations))
-    my_locations = locations[loc_start:loc_end]
-
-    logger.info(f"Predicting {len(my_locations)} locations...")
-    for i in range(0, len(my_locations), batch_size):
-        logger.info('Predict location {}/{}'.format(i, len(my_locations)))
-        locs = my_locations[i:i+batch_size]
-        raw, raw_normalized = get_raw(locs,
-                                      input_shape,
-                                      voxel_size,
-                                      raw_container,
-                                      raw_dataset)
-        
-        shape = tuple(raw_normalized.shape)
-        raw_normalized = raw_normalized.reshape([len(locs), 1, shape[1], shape[2], shape[3]]).astype(np.float32)
-        output = predict(raw_normalized, model)
-
-        for k in range(np.shape(output)[0]):
-            loc_k = locs[k]
-            out_k = output[k,:]
-            loc_k_list = loc_k
-
-            data_synapse = {"prediction": out_k.tolist(),
-                            "z": loc_k_list[0],
-                            "y": loc_k_list[1],
-                            "x": loc_k_list[2]}
-
-            prediction_queue.put(data_synapse)
+    with timer.time("load_locations"):
+        synapses = db.get_synapses(split_name=split_name)
+
+        if crop_cache is not None:
+            logger.info("Read crops from cache {}".format(crop_cache))
+            crop_cache = CropCache(crop_cache, voxel_size=voxel_size)
+
+    num_predicted = 0
+    last_done = None
+    last_progress = time.time()
+    while True:
+        # claim the next chunk, synapses of crashed or slow workers are
+        # handed out again once their lease expired, until all runs have
+        # their prediction
+        with timer.time("claim"):
+            chunk_ids = db.claim_predictions(split_name,
+                                             experiment,
+                                             train_number,
+                                             predict_numbers,
+                                             chunk_size,
+                                             lease_time)
+
+        if not chunk_ids:
+            done, total = db.count_predictions(split_name,
+                                               experiment,
+                                               train_number,
+                                               predict_numbers)
+            if done == total:
+                break
+            if done != last_done:
+                last_done = done
+                last_progress = time.time()
+            elif time.time() - last_progress > max_wait:
+                logger.error(f"No predictions written for {max_wait}s, giving up on "
+                             f"{total - done} locations leased by other workers")
+                break
+            logger.info(f"{total - done} locations leased by other workers, wait...")
+            with timer.time("wait"):
+                time.sleep(min(lease_time, 30))
+            continue
+        last_progress = time.time()
+
+        # runs are initialized with the synapses of one split part
+        wrong_part = [synapse_id for synapse_id in chunk_ids
+                      if synapses[synapse_id]["splits"][split_name] != split_part]
+        if wrong_part:
+            raise ValueError(f"Synapses {wrong_part[:10]} of the prediction run are not "
+                             f"in split part '{split_part}' of split {split_name}")
+
+        chunk_locations = [(int(synapses[synapse_id]["z"]),
+                            int(synapses[synapse_id]["y"]),
+                            int(synapses[synapse_id]["x"]))
+                           for synapse_id in chunk_ids]
+
+        logger.info(f"Worker {worker_id} claimed {len(chunk_ids)} locations, "
+                    f"{num_predicted} predicted so far")
+        for i in range(0, len(chunk_locations), batch_size):
+            locs = chunk_locations[i:i+batch_size]
+            batch_ids = np.array(chunk_ids[i:i+batch_size], dtype=np.int64)
+            # uint8 crops, normalized on the device
+            with timer.time("read"):
+                if crop_cache is not None:
+                    raw = crop_cache.get(batch_ids)
+                elif reader_pool is not None:
+                    raw = reader_pool.read(locs)
+                else:
+                    raw = get_raw(locs,
+                                  input_shape,
+                                  voxel_size,
+                                  raw_container,
+                                  raw_dataset)
+
+            for run_number, (model, device) in zip(predict_numbers, models):
+                output = predict(raw, model, device=device, timer=timer)
+                output = output.detach().cpu().numpy()
+
+                # one queue item per batch and run
+                with timer.time("queue"):
+                    put_prediction(prediction_queue,
+                                   (run_number, batch_ids, locs, output),
+                                   writers,
+                                   error_queue)
+
+        num_predicted += len(chunk_ids)
+
+    if reader_pool is not None:
+        reader_pool.close()
 
     # signal end of data
     logger.info("Signalling end of data to prediction writers")
     for _ in range(num_cache_workers):
-        prediction_queue.put(None)
+        put_prediction(prediction_queue, None, writers, error_queue)
 
     logger.info("Wait for write...")
-    prediction_queue.join()
+    with timer.time("wait_for_write"):
+        # writers exit once they wrote everything before the end signal
+        for writer in writers:
+            while writer.is_alive():
+                writer.join(timeout=10.0)
+                check_writers(writers, error_queue)
+        check_writers(writers, error_queue)
+    timer.close()
     logger.info("Done.")
 
 
+def get_timing_file(timing_dir, predict_number, worker_id, writer_id=None):
+
+    if timing_dir is None:
+        return None
+    if writer_id is None:
+        name = "timing_p{}_w{}.jsonl".format(predict_number, worker_id)
+    else:
+        name = "timing_p{}_w{}_writer{}.jsonl".format(predict_number, worker_id, writer_id)
+    return os.path.join(timing_dir, name)
+
+
+def put_prediction(prediction_queue, item, writers, error_queue, timeout=10.0):
+    """Put ``item`` into the bounded ``prediction_queue``, raise if a writer
+    died before or while waiting for space."""
+
+    check_writers(writers, error_queue)
+    while True:
+        try:
+            prediction_queue.put(item, timeout=timeout)
+            return
+        except queue.Full:
+            check_writers(writers, error_queue)
+
+
+def check_writers(writers, error_queue):
+    """Raise the exception of a failed prediction writer, if any. The other
+    writers are stopped."""
+
+    for writer in writers:
+        if writer.exitcode is not None and writer.exitcode != 0:
+            try:
+                error = error_queue.get(timeout=1.0)
+            except queue.Empty:
+                error = "exit code {}".format(writer.exitcode)
+            for other in writers:
+                if other.is_alive():
+                    other.terminate()
+            raise RuntimeError("Prediction writer {} failed: {}".format(writer.pid, error))
+
+
+def run_prediction_writer(error_queue, *args):
+    """Run ``prediction_writer``, pass its exception on to ``error_queue``."""
+
+    try:
+        prediction_writer(*args)
+    except Exception:
+        error_queue.put(traceback.format_exc())
+        raise
+
+
 def prediction_writer(prediction_queue,
                       db_credentials,
                       db_name_data,
                       split_name,
                       experiment,
                       train_number,
-                      predict_number):
+                      write_buffer_size=256,
+                      write_interval=10.0,
+                      timing_file=None,
+                      timing_interval=60.0,
+                      prediction_store=None):
+    """Collects predicted batches from ``prediction_queue`` and writes them
+    to the DB in bulk, whenever ``write_buffer_size`` predictions are
+    buffered or ``write_interval`` seconds passed since the last write.
+    Each flush is also written to ``prediction_store``, if given.
+    """
 
     logger.info("Starting prediction writer thread")
 
     db = SynisterDb(db_credentials, db_name_data)
+    timer = StageTimer("writer_{}".format(os.getpid()),
+                       log_file=timing_file,
+                       emit_interval=timing_interval)
+
+    # predict_number -> ([synapse_ids], [locations], [predictions])
+    buffers = {}
+    # predict_number -> PredictionStoreWriter
+    store_writers = {}
+    last_write = time.time()
+
+    def flush():
+        for run_number, (buffered_ids, buffered_locations, buffered_predictions) in buffers.items():
+            synapse_ids = np.concatenate(buffered_ids)
+            predictions = np.concatenate(buffered_predictions)
+            with timer.time("write"):
+                db.write_predictions(split_name,
+                                     experiment,
+                                     train_number,
+                                     run_number,
+                                     synapse_ids,
+                                     predictions)
+            if prediction_store is not None:
+                if run_number not in store_writers:
+                    store_writers[run_number] = PredictionStoreWriter(
+                        prediction_store,
+                        get_run_name(split_name, experiment, train_number, run_number))
+                with timer.time("write_store"):
+                    store_writers[run_number].write(synapse_ids,
+                                                    np.concatenate(buffered_locations),
+                                                    predictions)
+        buffers.clear()
+
+    def num_buffered():
+        return sum(len(ids) for buffered_ids, _, _ in buffers.values() for ids in buffered_ids)
     
     while True:
-        data_synapse = prediction_queue.get()
+        timeout = max(0, write_interval - (time.time() - last_write))
+        try:
+            item = prediction_queue.get(timeout=timeout)
+        except queue.Empty:
+            item = False
 
-        if data_synapse is None:
+        if item is None:
             logger.info("No more locations to predict, stopping prediction writer")
+            flush()
+            timer.close()
             prediction_queue.task_done()
             break
 
-        db.write_prediction(split_name,
-                            data_synapse["prediction"],
-                            experiment,
-                            train_number,
-                            predict_number,
-                            data_synapse["x"],
-                            data_synapse["y"],
-                            data_synapse["z"])
+        if item is not False:
+            run_number, synapse_ids, locations, predictions = item
+            buffered_ids, buffered_locations, buffered_predictions = \
+                buffers.setdefault(run_number, ([], [], []))
+            buffered_ids.append(synapse_ids)
+            buffered_locations.append(np.array(locations, dtype=np.int64).reshape(-1, 3))
+            buffered_predictions.append(predictions)
+
+        if num_buffered() >= write_buffer_size or \
+                time.time() - last_write >= write_interval:
+            flush()
+            last_write = time.time()
 
-        prediction_queue.task_done()
+        if item is not False:
+            prediction_queue.task_done()
 
     logger.info("Prediction writer thread stopped")
 
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.INFO)
-    iteration = int(sys.argv[1])
+    # a comma separated list of iterations predicts several checkpoints at once
+    iterations = [int(i) for i in sys.argv[1].split(',')]
     worker_id = int(sys.argv[2])
     num_block_workers = int(sys.argv[3])
 
@@ -197,10 +459,10 @@ if __name__ == "__main__":
         os.path.join(setup_dir, 'train_config.ini'))
     del train_config['batch_size']  # don't overwrite prediction batch size
     predict_config.update(train_config)
-    predict_config['train_checkpoint'] = os.path.join(
-        setup_dir,
-        f'model_checkpoint_{iteration}')
-    predict_config['predict_number'] = iteration
+    predict_config['train_checkpoint'] = [
+        os.path.join(setup_dir, f'model_checkpoint_{iteration}')
+        for iteration in iterations]
+    predict_config['predict_number'] = iterations
 
     worker_config = read_worker_config(os.path.join(self_path, "worker_config.ini"))
     worker_config["worker_id"] = worker_id
@@ -0,0 +1,361 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from synister.predict_pipeline import load_model
+from synister.read_config import read_train_config
+from synister.utils import predict, get_raw, RawReaderPool
+import argparse
+import http.client
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import torch
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--train_dir', '-d',
+    type=str,
+    required=True,
+    help="Train setup directory, e.g. <experiment>/02_train/setup_t0")
+parser.add_argument(
+    '--iterations', '-i',
+    type=int,
+    nargs='+',
+    required=True,
+    help="Iterations of the checkpoints to serve")
+parser.add_argument(
+    '--host',
+    type=str,
+    default="127.0.0.1",
+    help="Address to bind to")
+parser.add_argument(
+    '--port', '-p',
+    type=int,
+    default=8123,
+    help="Port to listen on")
+parser.add_argument(
+    '--max_batch_size', '-b',
+    type=int,
+    default=32,
+    help="Maximal number of locations per batch")
+parser.add_argument(
+    '--max_latency', '-l',
+    type=float,
+    default=0.05,
+    help="Maximal time in seconds to wait for more locations to fill a batch")
+parser.add_argument(
+    '--num_reader_workers', '-r',
+    type=int,
+    default=4,
+    help="Number of processes reading crops, 0 reads serially")
+parser.add_argument(
+    '--quantized', '-q',
+    action='store_true',
+    help="Serve the int8 quantized checkpoints")
+
+
+class _Request(object):
+
+    def __init__(self, locations):
+        self.locations = locations
+        self.results = queue.Queue()
+
+
+class ModelBatcher(object):
+    '''Collects locations of concurrent requests for one model into batches
+    of at most ``max_batch_size`` locations, waiting at most ``max_latency``
+    seconds for a batch to fill up.'''
+
+    def __init__(self,
+                 name,
+                 model,
+                 device,
+                 read_crops,
+                 max_batch_size,
+                 max_latency):
+
+        self.name = name
+        self.model = model
+        self.device = device
+        self.read_crops = read_crops
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        # pieces of requests: (request, first index, locations)
+        self.pieces = queue.Queue()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, locations):
+
+        request = _Request(locations)
+        for i in range(0, len(locations), self.max_batch_size):
+            self.pieces.put((request, i, locations[i:i + self.max_batch_size]))
+        return request
+
+    def __next_batch(self):
+
+        pieces = [self.pieces.get()]
+        size = len(pieces[0][2])
+        deadline = time.time() + self.max_latency
+
+        while size < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                piece = self.pieces.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + len(piece[2]) > self.max_batch_size:
+                # split, the rest goes into the next batch
+                request, start, locations = piece
+                n = self.max_batch_size - size
+                self.pieces.put((request, start + n, locations[n:]))
+                piece = (request, start, locations[:n])
+            pieces.append(piece)
+            size += len(piece[2])
+
+        return pieces
+
+    def __run(self):
+
+        while True:
+            pieces = self.__next_batch()
+            locations = [loc for _, _, piece_locations in pieces for loc in piece_locations]
+
+            try:
+                with torch.no_grad():
+                    raw = self.read_crops(locations)
+                    probabilities = predict(raw, self.model, device=self.device).cpu().numpy()
+            except Exception as e:
+                logger.exception("Prediction failed")
+                for request, start, piece_locations in pieces:
+                    request.results.put((start, e))
+                continue
+
+            i = 0
+            for request, start, piece_locations in pieces:
+                request.results.put((start, probabilities[i:i + len(piece_locations)]))
+                i += len(piece_locations)
+
+
+class PredictionServer(ThreadingMixIn, HTTPServer):
+    '''Local HTTP server keeping ``Vgg3D`` checkpoints in memory.
+
+    ``POST /predict`` with a json body ``{"model": <name>, "locations":
+    [[z, y, x], ...]}`` (locations in world units) streams back one json line
+    ``{"index": i, "location": [z, y, x], "probabilities": [...]}`` per
+    location, in the order they are predicted. ``model`` can be omitted if
+    only one model is served. ``GET /models`` lists the served models.
+
+    Args:
+
+        models (``dict``):
+
+            Model name to ``(model, device)``.
+
+        read_crops (``callable``):
+
+            Returns a batch of uint8 crops for a list of locations.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self,
+                 address,
+                 models,
+                 read_crops,
+                 max_batch_size=32,
+                 max_latency=0.05):
+
+        HTTPServer.__init__(self, address, PredictionRequestHandler)
+        self.batchers = {
+            name: ModelBatcher(name,
+                               model,
+                               device,
+                               read_crops,
+                               max_batch_size,
+                               max_latency)
+            for name, (model, device) in models.items()
+        }
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path != "/models":
+            self.__send_error(404, "Unknown path {}".format(self.path))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(sorted(self.server.batchers.keys())).encode())
+
+    def do_POST(self):
+
+        if self.path != "/predict":
+            self.__send_error(404, "Unknown path {}".format(self.path))
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            locations = [tuple(int(c) for c in loc) for loc in body["locations"]]
+        except (ValueError, KeyError, TypeError) as e:
+            self.__send_error(400, "Invalid request: {}".format(e))
+            return
+
+        name = body.get("model")
+        if name is None and len(self.server.batchers) == 1:
+            name = list(self.server.batchers.keys())[0]
+        if name not in self.server.batchers:
+            self.__send_error(404, "Unknown model {}".format(name))
+            return
+
+        request = self.server.batchers[name].submit(locations)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+        remaining = len(locations)
+        while remaining > 0:
+            start, probabilities = request.results.get()
+            if isinstance(probabilities, Exception):
+                self.wfile.write((json.dumps({"error": str(probabilities)}) + "\n").encode())
+                return
+            lines = [
+                json.dumps({"index": start + k,
+                            "location": locations[start + k],
+                            "probabilities": p.tolist()})
+                for k, p in enumerate(probabilities)
+            ]
+            self.wfile.write(("\n".join(lines) + "\n").encode())
+            self.wfile.flush()
+            remaining -= len(probabilities)
+
+    def __send_error(self, code, message):
+
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps({"error": message}).encode())
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def request_predictions(locations,
+                        model=None,
+                        host="127.0.0.1",
+                        port=8123):
+    '''Request predictions from a running ``PredictionServer``.
+
+    Yields ``(index, location, probabilities)`` for each of the given
+    locations as soon as they are streamed back by the server.'''
+
+    body = {"locations": [[int(c) for c in loc] for loc in locations]}
+    if model is not None:
+        body["model"] = str(model)
+
+    connection = http.client.HTTPConnection(host, port)
+    connection.request("POST",
+                       "/predict",
+                       body=json.dumps(body),
+                       headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+
+    if response.status != 200:
+        raise RuntimeError("Prediction request failed: {}".format(response.read().decode()))
+
+    try:
+        for line in response:
+            result = json.loads(line)
+            if "error" in result:
+                raise RuntimeError("Prediction failed: {}".format(result["error"]))
+            yield result["index"], tuple(result["location"]), result["probabilities"]
+    finally:
+        connection.close()
+
+
+def serve(train_dir,
+          iterations,
+          host="127.0.0.1",
+          port=8123,
+          max_batch_size=32,
+          max_latency=0.05,
+          num_reader_workers=4,
+          quantized=False):
+
+    train_config = read_train_config(os.path.join(train_dir, "train_config.ini"))
+
+    if num_reader_workers > 0:
+        reader_pool = RawReaderPool(train_config["input_shape"],
+                                    train_config["voxel_size"],
+                                    train_config["raw_container"],
+                                    train_config["raw_dataset"],
+                                    num_workers=num_reader_workers,
+                                    max_batch_size=max_batch_size)
+        # the pool has a single shared buffer, batchers take turns
+        read_lock = threading.Lock()
+
+        def read_crops(locations):
+            with read_lock:
+                return reader_pool.read(locations)
+    else:
+        def read_crops(locations):
+            return get_raw(locations,
+                           train_config["input_shape"],
+                           train_config["voxel_size"],
+                           train_config["raw_container"],
+                           train_config["raw_dataset"])
+
+    models = {}
+    for iteration in iterations:
+        train_checkpoint = os.path.join(train_dir, "model_checkpoint_{}".format(iteration))
+        logger.info("Load model {}...".format(train_checkpoint))
+        models[str(iteration)] = load_model(train_checkpoint,
+                                            train_config["input_shape"],
+                                            train_config["fmaps"],
+                                            train_config["downsample_factors"],
+                                            train_config["synapse_types"],
+                                            train_config["neither_class"],
+                                            network=train_config.get("network", "VGG"),
+                                            fmap_inc=train_config["fmap_inc"],
+                                            n_convolutions=train_config["n_convolutions"],
+                                            quantized=quantized)
+
+    server = PredictionServer((host, port),
+                              models,
+                              read_crops,
+                              max_batch_size=max_batch_size,
+                              max_latency=max_latency)
+
+    logger.info("Serving models {} on {}:{}".format(sorted(models.keys()), host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if num_reader_workers > 0:
+            reader_pool.close()
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    serve(args.train_dir,
+          args.iterations,
+          host=args.host,
+          port=args.port,
+          max_batch_size=args.max_batch_size,
+          max_latency=args.max_latency,
+          num_reader_workers=args.num_reader_workers,
+          quantized=args.quantized)
@@ -0,0 +1,228 @@
+from synister.synister_db import SynisterDb
+import argparse
+import glob
+import json
+import logging
+import numpy as np
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--db_credentials', '-c',
+    type=str,
+    required=True,
+    help="DB credentials file")
+parser.add_argument(
+    '--db_name_data', '-d',
+    type=str,
+    required=True,
+    help="Name of the synister DB")
+parser.add_argument(
+    '--split_name', '-s',
+    type=str,
+    required=True,
+    help="Split of the prediction run")
+parser.add_argument(
+    '--experiment', '-e',
+    type=str,
+    required=True,
+    help="Experiment of the prediction run")
+parser.add_argument(
+    '--train_number', '-t',
+    type=int,
+    required=True,
+    help="Train number of the prediction run")
+parser.add_argument(
+    '--predict_number', '-p',
+    type=int,
+    required=True,
+    help="Predict number of the prediction run")
+parser.add_argument(
+    '--out', '-o',
+    type=str,
+    required=True,
+    help="Prediction store directory, the run is written to a sub directory")
+
+
+def get_run_name(split_name, experiment, train_number, predict_number):
+    # same as the name of the prediction collection
+    return "{}_{}_t{}_p{}".format(split_name, experiment, train_number, predict_number)
+
+
+class PredictionStoreWriter(object):
+    '''Appends predictions of one run to ``<store_dir>/<run_name>``.
+
+    Each call of ``write`` adds a part file, several writers (processes or
+    hosts) can write to the same run. Parts are merged by
+    ``consolidate_predictions``.'''
+
+    def __init__(self, store_dir, run_name):
+
+        self.run_dir = os.path.join(store_dir, run_name)
+        self.parts_dir = os.path.join(self.run_dir, "parts")
+        os.makedirs(self.parts_dir, exist_ok=True)
+        self.prefix = "part_{}_{}".format(socket.gethostname(), os.getpid())
+        self.num_parts = 0
+
+    def write(self, synapse_ids, locations, predictions):
+
+        if len(synapse_ids) == 0:
+            return
+
+        part_file = os.path.join(self.parts_dir,
+                                 "{}_{:06d}.npz".format(self.prefix, self.num_parts))
+        # write to a temporary file first, parts are only read when complete
+        tmp_file = part_file + ".tmp.npz"
+        np.savez(tmp_file,
+                 synapse_ids=np.asarray(synapse_ids, dtype=np.int64),
+                 locations=np.asarray(locations, dtype=np.int64).reshape(-1, 3),
+                 predictions=np.asarray(predictions, dtype=np.float32))
+        os.replace(tmp_file, part_file)
+        self.num_parts += 1
+
+
+def write_predictions(run_dir,
+                      synapse_ids,
+                      locations,
+                      predictions,
+                      attrs=None):
+    '''Write a consolidated run: ``synapse_ids.npy``, ``locations.npy``
+    (``z``, ``y``, ``x`` in world units) and ``predictions.npy`` (one row
+    of class probabilities per synapse), sorted by synapse id.'''
+
+    os.makedirs(run_dir, exist_ok=True)
+
+    synapse_ids = np.asarray(synapse_ids, dtype=np.int64)
+    order = np.argsort(synapse_ids)
+
+    # replace files instead of overwriting them, runs may be memory mapped
+    for name, data in [
+            ("synapse_ids", synapse_ids[order]),
+            ("locations", np.asarray(locations, dtype=np.int64).reshape(-1, 3)[order]),
+            ("predictions", np.asarray(predictions, dtype=np.float32)[order])]:
+        tmp_file = os.path.join(run_dir, name + ".tmp.npy")
+        np.save(tmp_file, data)
+        os.replace(tmp_file, os.path.join(run_dir, name + ".npy"))
+
+    run_attrs = {"num_predictions": int(len(synapse_ids))}
+    if attrs is not None:
+        run_attrs.update(attrs)
+    tmp_file = os.path.join(run_dir, "attrs.json.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(run_attrs, f, indent=2)
+    os.replace(tmp_file, os.path.join(run_dir, "attrs.json"))
+
+
+def consolidate_predictions(run_dir, attrs=None):
+    '''Merge the part files written by ``PredictionStoreWriter`` into a
+    consolidated run, see ``write_predictions``. Synapses predicted more
+    than once (e.g. after an expired lease) are kept once, with the
+    prediction of the newest part.'''
+
+    part_files = get_part_files(run_dir)
+    if not part_files:
+        raise ValueError("No predictions in {}".format(run_dir))
+
+    # newest parts first, np.unique keeps the first occurrence
+    parts = [np.load(part_file) for part_file in reversed(part_files)]
+    synapse_ids = np.concatenate([p["synapse_ids"] for p in parts])
+    locations = np.concatenate([p["locations"] for p in parts])
+    predictions = np.concatenate([p["predictions"] for p in parts])
+
+    synapse_ids, unique = np.unique(synapse_ids, return_index=True)
+    logger.info("Consolidate {} predictions from {} parts in {}".format(len(synapse_ids),
+                                                                       len(part_files),
+                                                                       run_dir))
+    run_attrs = dict(attrs) if attrs is not None else {}
+    run_attrs["parts"] = [os.path.basename(part_file) for part_file in part_files]
+    write_predictions(run_dir,
+                      synapse_ids,
+                      locations[unique],
+                      predictions[unique],
+                      attrs=run_attrs)
+
+
+def get_part_files(run_dir):
+    '''Part files of a run, oldest first.'''
+
+    part_files = glob.glob(os.path.join(run_dir, "parts", "part_*[0-9].npz"))
+    return sorted(part_files, key=lambda f: (os.stat(f).st_mtime_ns, f))
+
+
+def load_predictions(run_dir):
+    '''Memory map a consolidated run. Returns a dict with ``synapse_ids``,
+    ``locations`` and ``predictions``, consolidates the run first if it has
+    part files that are not consolidated yet.'''
+
+    attrs_file = os.path.join(run_dir, "attrs.json")
+    if not os.path.exists(attrs_file):
+        consolidate_predictions(run_dir)
+    else:
+        with open(attrs_file, "r") as f:
+            attrs = json.load(f)
+        consolidated = set(attrs.get("parts", []))
+        attrs_time = os.stat(attrs_file).st_mtime_ns
+        part_files = get_part_files(run_dir)
+        if any(os.path.basename(part_file) not in consolidated or
+               os.stat(part_file).st_mtime_ns > attrs_time
+               for part_file in part_files):
+            attrs.pop("num_predictions", None)
+            consolidate_predictions(run_dir, attrs=attrs)
+
+    return {
+        name: np.load(os.path.join(run_dir, name + ".npy"), mmap_mode="r")
+        for name in ["synapse_ids", "locations", "predictions"]
+    }
+
+
+def export_predictions(db_credentials,
+                       db_name_data,
+                       split_name,
+                       experiment,
+                       train_number,
+                       predict_number,
+                       store_dir):
+    '''Export an existing prediction run from the DB to
+    ``<store_dir>/<run_name>``. Synapses without a prediction are
+    skipped.'''
+
+    db = SynisterDb(db_credentials, db_name_data)
+    predictions = db.get_predictions(split_name, experiment, train_number, predict_number)
+    synapses = db.get_synapses(synapse_ids=list(predictions.keys()))
+
+    synapse_ids = [synapse_id for synapse_id, p in predictions.items()
+                   if p["prediction"] is not None]
+    if len(synapse_ids) < len(predictions):
+        logger.warning("{} of {} synapses have no prediction".format(
+            len(predictions) - len(synapse_ids), len(predictions)))
+
+    run_name = get_run_name(split_name, experiment, train_number, predict_number)
+    write_predictions(os.path.join(store_dir, run_name),
+                      synapse_ids,
+                      [(synapses[s]["z"], synapses[s]["y"], synapses[s]["x"])
+                       for s in synapse_ids],
+                      [predictions[s]["prediction"] for s in synapse_ids],
+                      attrs={"db_name_data": db_name_data,
+                             "split_name": split_name,
+                             "experiment": experiment,
+                             "train_number": train_number,
+                             "predict_number": predict_number})
+
+    return os.path.join(store_dir, run_name)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    run_dir = export_predictions(args.db_credentials,
+                                 args.db_name_data,
+                                 args.split_name,
+                                 args.experiment,
+                                 args.train_number,
+                                 args.predict_number,
+                                 args.out)
+    logger.info("Exported predictions to {}".format(run_dir))
@@ -0,0 +1,273 @@
+from synister.evaluate import synaptic_cross_confusion_matrix, get_accuracy
+from synister.read_config import read_train_config
+from synister.synister_db import SynisterDb
+from synister.utils import init_vgg, predict, get_raw, to_model_input
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import torch
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--train_dir', '-d',
+    type=str,
+    required=True,
+    help="Train setup directory, e.g. <experiment>/02_train/setup_t0")
+parser.add_argument(
+    '--iteration', '-i',
+    type=int,
+    required=True,
+    help="Iteration of the checkpoint to quantize")
+parser.add_argument(
+    '--num_calibration', '-c',
+    type=int,
+    default=512,
+    help="Number of training crops used for calibration")
+parser.add_argument(
+    '--num_validation', '-n',
+    type=int,
+    default=512,
+    help="Number of validation crops used to compare with the float model")
+parser.add_argument(
+    '--min_agreement', '-a',
+    type=float,
+    default=0.95,
+    help="Minimal synaptic agreement with the float model")
+parser.add_argument(
+    '--force', '-f',
+    action='store_true',
+    help="Write the quantized model even if the agreement is too low")
+
+
+class QuantizableVgg3D(torch.nn.Module):
+    '''Wraps a ``Vgg3D`` with the quant/dequant stubs needed for eager mode
+    post-training quantization.'''
+
+    def __init__(self, model):
+        super(QuantizableVgg3D, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.model = model
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, raw):
+        raw = self.quant(raw)
+        y = self.model(raw)
+        return self.dequant(y)
+
+
+def get_quantized_checkpoint(train_checkpoint):
+    return train_checkpoint + "_int8"
+
+
+def fuse_vgg(model):
+    '''Fuse consecutive Conv3d, BatchNorm3d and ReLU modules of the
+    ``Vgg3D`` feature extractor (and Linear, ReLU of the classifier) in
+    place. The model has to be in eval mode.'''
+
+    for sequential, patterns in [
+            (model.features, [(torch.nn.Conv3d, torch.nn.BatchNorm3d, torch.nn.ReLU),
+                              (torch.nn.Conv3d, torch.nn.BatchNorm3d),
+                              (torch.nn.Conv3d, torch.nn.ReLU)]),
+            (model.classifier, [(torch.nn.Linear, torch.nn.ReLU)])]:
+
+        modules = list(sequential.named_children())
+        to_fuse = []
+        i = 0
+        while i < len(modules):
+            for pattern in patterns:
+                candidates = modules[i:i + len(pattern)]
+                if len(candidates) == len(pattern) and \
+                        all(isinstance(m, t) for (_, m), t in zip(candidates, pattern)):
+                    to_fuse.append([name for name, _ in candidates])
+                    i += len(pattern)
+                    break
+            else:
+                i += 1
+
+        if to_fuse:
+            torch.quantization.fuse_modules(sequential, to_fuse, inplace=True)
+
+    return model
+
+
+def quantize_vgg(model,
+                 calibration_batches,
+                 backend="fbgemm"):
+    '''Post-training static int8 quantization of a float ``Vgg3D``.
+
+    Args:
+
+        model (``Vgg3D``):
+
+            The float model, will be modified in place.
+
+        calibration_batches (``iterable of ndarray``):
+
+            uint8 input batches of shape ``(b, z, y, x)`` used to calibrate
+            the activation observers.
+
+        backend (``string``):
+
+            Quantized engine to use, ``fbgemm`` for x86 CPUs.
+
+    Returns:
+
+        The quantized model (on the CPU).
+    '''
+
+    torch.backends.quantized.engine = backend
+
+    model.to(torch.device("cpu"))
+    model.eval()
+    fuse_vgg(model)
+
+    quantizable = QuantizableVgg3D(model)
+    quantizable.eval()
+    quantizable.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(quantizable, inplace=True)
+
+    with torch.no_grad():
+        for batch in calibration_batches:
+            quantizable(to_model_input(batch, torch.device("cpu")))
+
+    torch.quantization.convert(quantizable, inplace=True)
+    return quantizable
+
+
+def load_quantized_vgg(quantized_checkpoint, backend="fbgemm"):
+
+    torch.backends.quantized.engine = backend
+    logger.info("Load quantized vgg {}".format(quantized_checkpoint))
+    model = torch.jit.load(quantized_checkpoint, map_location="cpu")
+    model.eval()
+    return model
+
+
+def quantize_checkpoint(train_dir,
+                        iteration,
+                        num_calibration=512,
+                        num_validation=512,
+                        min_agreement=0.95,
+                        batch_size=8,
+                        force=False,
+                        seed=42):
+    '''Quantize ``model_checkpoint_<iteration>`` of the given train setup,
+    calibrated on a random sample of training crops, and compare it with the
+    float model on a sample of validation crops.
+
+    The quantized model is written as TorchScript next to the checkpoint
+    (``model_checkpoint_<iteration>_int8``), together with a json report of
+    the agreement. Raises a ``ValueError`` if the synaptic agreement is below
+    ``min_agreement``, unless ``force`` is set.
+    '''
+
+    train_config = read_train_config(os.path.join(train_dir, "train_config.ini"))
+    train_checkpoint = os.path.join(train_dir, "model_checkpoint_{}".format(iteration))
+
+    synapse_types = list(train_config["synapse_types"])
+    output_classes = len(synapse_types)
+    if train_config["neither_class"]:
+        output_classes += 1
+        synapse_types += ["neither"]
+
+    db = SynisterDb(train_config["db_credentials"], train_config["db_name_data"])
+    split_name = train_config["split_name"]
+    synapses = db.get_synapses(split_name=split_name)
+
+    def sample_part(split_part, n):
+        synapse_ids = sorted([synapse_id for synapse_id, synapse in synapses.items()
+                              if synapse["splits"][split_name] == split_part])
+        n = min(n, len(synapse_ids))
+        return [int(s) for s in rng.choice(synapse_ids, n, replace=False)]
+
+    rng = np.random.RandomState(seed)
+    calibration_ids = sample_part("train", num_calibration)
+    validation_ids = sample_part("validation", num_validation)
+    if not validation_ids:
+        logger.warning("Split {} has no validation part, compare on test part".format(split_name))
+        validation_ids = sample_part("test", num_validation)
+
+    def get_batches(synapse_ids):
+        for i in range(0, len(synapse_ids), batch_size):
+            locs = [(int(synapses[s]["z"]), int(synapses[s]["y"]), int(synapses[s]["x"]))
+                    for s in synapse_ids[i:i + batch_size]]
+            yield get_raw(locs,
+                          train_config["input_shape"],
+                          train_config["voxel_size"],
+                          train_config["raw_container"],
+                          train_config["raw_dataset"])
+
+    def init_float_model():
+        model = init_vgg(train_checkpoint,
+                         train_config["input_shape"],
+                         train_config["fmaps"],
+                         train_config["downsample_factors"],
+                         output_classes=output_classes,
+                         fmap_inc=train_config["fmap_inc"],
+                         n_convolutions=train_config["n_convolutions"],
+                         device=torch.device("cpu"))
+        model.eval()
+        return model
+
+    logger.info("Calibrate on {} training crops...".format(len(calibration_ids)))
+    quantized_model = quantize_vgg(init_float_model(), get_batches(calibration_ids))
+    float_model = init_float_model()
+
+    logger.info("Compare float and quantized model on {} crops...".format(len(validation_ids)))
+    float_predictions = {}
+    quantized_predictions = {}
+    cpu = torch.device("cpu")
+    i = 0
+    with torch.no_grad():
+        for raw_batched in get_batches(validation_ids):
+            float_output = predict(raw_batched, float_model, device=cpu)
+            quantized_output = predict(raw_batched, quantized_model, device=cpu)
+            for k in range(len(raw_batched)):
+                synapse_id = validation_ids[i]
+                float_predictions[synapse_id] = {"prediction": float_output[k].tolist()}
+                quantized_predictions[synapse_id] = {"prediction": quantized_output[k].tolist()}
+                i += 1
+
+    cm = synaptic_cross_confusion_matrix(float_predictions,
+                                         quantized_predictions,
+                                         {"synapse_types": synapse_types})
+    agreement, avg_agreement = get_accuracy(cm)
+    logger.info("Agreement with float model: {} (average per class {})".format(agreement,
+                                                                              avg_agreement))
+
+    report = {"iteration": iteration,
+              "num_calibration": len(calibration_ids),
+              "num_validation": len(validation_ids),
+              "agreement": float(agreement),
+              "avg_agreement": float(avg_agreement),
+              "confusion_matrix": cm.tolist()}
+
+    if agreement < min_agreement and not force:
+        raise ValueError("Quantized model agrees with float model on only {} of "
+                         "synapses, expected at least {}".format(agreement, min_agreement))
+
+    quantized_checkpoint = get_quantized_checkpoint(train_checkpoint)
+    example = next(get_batches(validation_ids[:1]))
+    traced = torch.jit.trace(quantized_model, to_model_input(example, cpu))
+    torch.jit.save(traced, quantized_checkpoint)
+    with open(quantized_checkpoint + ".json", "w") as f:
+        json.dump(report, f, indent=2)
+
+    logger.info("Wrote quantized model to {}".format(quantized_checkpoint))
+    return report
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    quantize_checkpoint(args.train_dir,
+                        args.iteration,
+                        num_calibration=args.num_calibration,
+                        num_validation=args.num_validation,
+                        min_agreement=args.min_agreement,
+                        force=args.force)
@@ -25,6 +25,22 @@ def read_predict_config(predict_config):
         cfg_dict["network"] = config.get("Predict", "network")
     except:
         pass
+    cfg_dict["quantized"] = config.get("Predict", "quantized", fallback="False") == "True"
+    cfg_dict["multi_model"] = config.get("Predict", "multi_model", fallback="False") == "True"
+    cfg_dict["queue_size"] = config.getint("Predict", "queue_size", fallback=16)
+    cfg_dict["write_buffer_size"] = config.getint("Predict", "write_buffer_size", fallback=256)
+    cfg_dict["write_interval"] = config.getfloat("Predict", "write_interval", fallback=10.0)
+    cfg_dict["chunk_size"] = config.getint("Predict", "chunk_size", fallback=256)
+    timing_dir = config.get("Predict", "timing_dir", fallback="timing")
+    cfg_dict["timing_dir"] = timing_dir if timing_dir != "None" else None
+    cfg_dict["timing_interval"] = config.getfloat("Predict", "timing_interval", fallback=60.0)
+    cfg_dict["num_reader_workers"] = config.getint("Predict", "num_reader_workers", fallback=0)
+    crop_cache = config.get("Predict", "crop_cache", fallback="None")
+    cfg_dict["crop_cache"] = crop_cache if crop_cache != "None" else None
+    cfg_dict["lease_time"] = config.getint("Predict", "lease_time", fallback=600)
+    cfg_dict["max_wait"] = config.getint("Predict", "max_wait", fallback=3600)
+    prediction_store = config.get("Predict", "prediction_store", fallback="None")
+    cfg_dict["prediction_store"] = prediction_store if prediction_store != "None" else None
 
     return cfg_dict
 
@@ -75,6 +91,28 @@ def read_train_config(train_config):
         cfg_dict["network_appendix"] = config.get("Training", "network_appendix")
     except:
         pass
+    point_table = config.get("Training", "point_table", fallback="None")
+    cfg_dict["point_table"] = point_table if point_table != "None" else None
+    crop_store = config.get("Training", "crop_store", fallback="None")
+    cfg_dict["crop_store"] = crop_store if crop_store != "None" else None
+    cfg_dict["direct_sampling"] = config.get("Training", "direct_sampling", fallback="False") == "True"
+    snapshot_keep_last = config.get("Training", "snapshot_keep_last", fallback="None")
+    cfg_dict["snapshot_keep_last"] = int(snapshot_keep_last) if snapshot_keep_last != "None" else None
+    elastic_pool_size = config.get("Training", "elastic_pool_size", fallback="None")
+    cfg_dict["elastic_pool_size"] = int(elastic_pool_size) if elastic_pool_size != "None" else None
+    cfg_dict["data_loader"] = config.get("Training", "data_loader", fallback="False") == "True"
+    cfg_dict["num_workers"] = int(config.get("Training", "num_workers", fallback="10"))
+    cfg_dict["cache_size"] = int(config.get("Training", "cache_size", fallback="40"))
+    validation_crop_store = config.get("Training", "validation_crop_store", fallback="None")
+    cfg_dict["validation_crop_store"] = validation_crop_store if validation_crop_store != "None" else None
+    cfg_dict["validate_every"] = int(config.get("Training", "validate_every", fallback="1000"))
+    patience = config.get("Training", "patience", fallback="None")
+    cfg_dict["patience"] = int(patience) if patience != "None" else None
+    cfg_dict["checkpoint_every"] = int(config.get("Training", "checkpoint_every", fallback="1000"))
+    checkpoint_keep_last = config.get("Training", "checkpoint_keep_last", fallback="None")
+    cfg_dict["checkpoint_keep_last"] = int(checkpoint_keep_last) if checkpoint_keep_last != "None" else None
+    checkpoint_keep_every = config.get("Training", "checkpoint_keep_every", fallback="None")
+    cfg_dict["checkpoint_keep_every"] = int(checkpoint_keep_every) if checkpoint_keep_every != "None" else None
 
     return cfg_dict
 
@@ -0,0 +1,101 @@
+from gunpowder import *
+from synister.gp import CachedElasticAugment
+from synister.read_config import read_train_config
+import argparse
+import math
+import numpy as np
+import time
+
+parser = argparse.ArgumentParser(
+    description="Compare the time per batch of ElasticAugment and "
+                "CachedElasticAugment on random data of the train input shape")
+parser.add_argument(
+    '--train_config', '-t',
+    type=str,
+    required=True,
+    help="Train config, for input_shape and voxel_size")
+parser.add_argument(
+    '--pool_size', '-p',
+    type=int,
+    default=50,
+    help="Pool size of CachedElasticAugment")
+parser.add_argument(
+    '--num_batches', '-n',
+    type=int,
+    default=200,
+    help="Number of batches to time per node")
+
+
+class RandomRawSource(BatchProvider):
+
+    def __init__(self, raw, voxel_size):
+        self.raw = raw
+        self.voxel_size = voxel_size
+
+    def setup(self):
+        self.provides(
+            self.raw,
+            ArraySpec(
+                roi=Roi((None,)*3, (None,)*3),
+                voxel_size=self.voxel_size,
+                interpolatable=True,
+                dtype=np.float32))
+
+    def provide(self, request):
+        batch = Batch()
+        spec = self.spec[self.raw].copy()
+        spec.roi = request[self.raw].roi
+        shape = spec.roi.get_shape()/self.voxel_size
+        batch.arrays[self.raw] = Array(
+            np.random.rand(*shape).astype(np.float32),
+            spec)
+        return batch
+
+
+def benchmark(elastic_augment, input_shape, voxel_size, num_batches):
+
+    raw = ArrayKey('RAW')
+    input_size = input_shape*voxel_size
+    request = BatchRequest()
+    request.add(raw, input_size)
+
+    pipeline = RandomRawSource(raw, voxel_size) + elastic_augment
+
+    with build(pipeline) as p:
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            p.request_batch(request)
+        return (time.perf_counter() - start)/num_batches
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    train_config = read_train_config(args.train_config)
+    input_shape = Coordinate(train_config["input_shape"])
+    voxel_size = Coordinate(train_config["voxel_size"])
+
+    elastic_args = dict(
+        control_point_spacing=[4,40,40],
+        jitter_sigma=[0,2,2],
+        rotation_interval=[0,math.pi/2.0],
+        prob_slip=0.05,
+        prob_shift=0.05,
+        max_misalign=10,
+        subsample=8)
+
+    t_elastic = benchmark(
+        ElasticAugment(**elastic_args),
+        input_shape,
+        voxel_size,
+        args.num_batches)
+    t_cached = benchmark(
+        CachedElasticAugment(pool_size=args.pool_size, **elastic_args),
+        input_shape,
+        voxel_size,
+        args.num_batches)
+
+    print("ElasticAugment:       {:.1f}ms per batch".format(t_elastic*1000))
+    print("CachedElasticAugment: {:.1f}ms per batch (pool of {}, including filling it)".format(
+        t_cached*1000, args.pool_size))
+    print("Speed-up: {:.2f}".format(t_elastic/t_cached))
@@ -1,7 +1,13 @@
-from get_neurotransmitter import get_neurotransmitter, init_model
-from synister.utils import get_array
+from synister.dense import DenseVgg3D, predict_dense_in_roi
+from synister.predict_pipeline import load_model
+from synister.read_config import read_train_config
+from synister.utils import get_array, open_raw_dataset
 import argparse
+import itertools
+import multiprocessing
 import numpy as np
+import os
+import torch
 import zarr
 import time
 
@@ -25,15 +31,50 @@ parser.add_argument(
     '--out', '-o',
     type=str,
     help="Name of output zarr container.")
+parser.add_argument(
+    '--dense', '-d',
+    action='store_true',
+    help="Approximate predictions of all locations with a fully "
+         "convolutional version of the network, step has to be a multiple "
+         "or divisor of the network stride (in voxels). Scores are NOT "
+         "those of single crops: the padded convolutions see the "
+         "neighbouring raw data instead of zeros at the crop borders, which "
+         "affects most of a crop that is only a few sections deep in z")
+parser.add_argument(
+    '--train_dir', '-t',
+    type=str,
+    help="Train setup directory of the model for dense prediction")
+parser.add_argument(
+    '--iteration', '-i',
+    type=int,
+    help="Iteration of the checkpoint for dense prediction")
+parser.add_argument(
+    '--block_size', '-b',
+    type=int,
+    nargs='+',
+    help="Predict block-wise, with blocks of this many steps in each "
+         "direction. Blocks are written to the output as they finish and "
+         "finished blocks are skipped when run again.")
+parser.add_argument(
+    '--num_workers', '-w',
+    type=int,
+    default=1,
+    help="Number of processes predicting blocks in parallel")
 
 def predict_in_roi(begin, end, step,
                    net_input_size=(640,640,640),
                    raw_container="/nrs/saalfeld/FAFB00/"+\
                                  "v14_align_tps_20170818_dmg.n5",
-                   raw_dataset="volumes/raw/s0"):
+                   raw_dataset="volumes/raw/s0",
+                   model=None,
+                   model_config=None):
+
+    # crop-wise prediction uses the production model of synistereq
+    from get_neurotransmitter import get_neurotransmitter, init_model
 
     start = time.time()
-    model, model_config = init_model()
+    if model is None:
+        model, model_config = init_model()
 
     z, y, x = np.meshgrid(
         range(begin[0], end[0], step[0]),
@@ -68,6 +109,183 @@ def predict_in_roi(begin, end, step,
 
     return predictions
 
+def load_dense_model(train_dir, iteration):
+
+    train_config = read_train_config(os.path.join(train_dir, "train_config.ini"))
+    model, device = load_model(os.path.join(train_dir, "model_checkpoint_{}".format(iteration)),
+                               train_config["input_shape"],
+                               train_config["fmaps"],
+                               train_config["downsample_factors"],
+                               train_config["synapse_types"],
+                               train_config["neither_class"],
+                               network=train_config.get("network", "VGG"),
+                               fmap_inc=train_config["fmap_inc"],
+                               n_convolutions=train_config["n_convolutions"])
+    model = DenseVgg3D(model, train_config["input_shape"], approximate=True)
+    if not model.exact:
+        print("Dense predictions are approximate, the network pads its convolutions")
+    dataset = open_raw_dataset(train_config["raw_container"],
+                               train_config["raw_dataset"],
+                               train_config["voxel_size"])
+
+    return model, device, dataset, train_config["voxel_size"]
+
+def predict_in_roi_dense(begin, end, step,
+                         train_dir=None,
+                         iteration=None,
+                         dense_model=None):
+
+    start = time.time()
+    if dense_model is None:
+        dense_model = load_dense_model(train_dir, iteration)
+    model, device, dataset, voxel_size = dense_model
+
+    predictions = predict_dense_in_roi(model,
+                                       dataset,
+                                       begin,
+                                       end,
+                                       step,
+                                       voxel_size,
+                                       device=device)
+
+    num_positions = int(np.prod(predictions.shape[1:]))
+    end = time.time()
+    print(f"Prediction of {num_positions} locations took {end - start}s")
+    print(f"{(end-start)/num_positions}s per position")
+
+    return predictions
+
+def get_num_classes(dense, train_dir):
+
+    if dense:
+        train_config = read_train_config(os.path.join(train_dir, "train_config.ini"))
+        return len(train_config["synapse_types"]) + int(train_config["neither_class"])
+
+    from get_neurotransmitter import init_model
+    _, model_config = init_model()
+    return len(model_config["neurotransmitter_list"])
+
+def prepare_blockwise(out, begin, end, step, block_size, num_classes):
+    """Create (or open, to resume) the chunked prediction dataset and the
+    per block ``prediction_done`` flags in ``out``. Returns the grid offsets
+    of all blocks that are not done yet."""
+
+    grid_shape = tuple(int(n) for n in -((np.array(begin) - np.array(end))//step))
+    block_size = tuple(min(int(b), n) for b, n in zip(block_size, grid_shape))
+    blocks_shape = tuple(-(-n//b) for n, b in zip(grid_shape, block_size))
+
+    f = zarr.open(out, mode='a')
+    attrs = {
+        'offset': list(int(x) for x in begin),
+        'resolution': list(int(x) for x in step),
+        'block_size': list(block_size)
+    }
+
+    if 'prediction' in f:
+        for key, value in attrs.items():
+            if f['prediction'].attrs.get(key) != value:
+                raise ValueError(f"Existing prediction in {out} has {key} "
+                                 f"{f['prediction'].attrs.get(key)}, expected {value}")
+    else:
+        # one chunk per block, so that workers never write to the same chunk
+        f.create_dataset('prediction',
+                         shape=(num_classes,) + grid_shape,
+                         chunks=(num_classes,) + block_size,
+                         dtype=np.float32)
+        f['prediction'].attrs.update(attrs)
+        f.create_dataset('prediction_done',
+                         shape=blocks_shape,
+                         chunks=(1, 1, 1),
+                         dtype=np.uint8,
+                         fill_value=0)
+
+    done = f['prediction_done'][:]
+    blocks = [
+        tuple(int(i*b) for i, b in zip(index, block_size))
+        for index in itertools.product(*[range(n) for n in blocks_shape])
+        if not done[index]
+    ]
+    print(f"{int(done.sum())} of {done.size} blocks done")
+
+    return blocks, block_size
+
+# state of a block worker process
+_worker = {}
+
+def init_block_worker(out, begin, end, step, block_size, dense, train_dir, iteration, num_threads):
+
+    torch.set_num_threads(num_threads)
+    _worker.update({
+        'prediction': zarr.open(out, mode='a')['prediction'],
+        'done': zarr.open(out, mode='a')['prediction_done'],
+        'begin': np.array(begin),
+        'end': np.array(end),
+        'step': np.array(step),
+        'block_size': np.array(block_size)
+    })
+    if dense:
+        _worker['dense_model'] = load_dense_model(train_dir, iteration)
+    else:
+        from get_neurotransmitter import init_model
+        _worker['model'] = init_model()
+
+def predict_block(block_offset):
+
+    block_offset = np.array(block_offset)
+    step = _worker['step']
+    block_begin = _worker['begin'] + block_offset*step
+    block_end = np.minimum(block_begin + _worker['block_size']*step, _worker['end'])
+
+    if 'dense_model' in _worker:
+        predictions = predict_in_roi_dense(block_begin,
+                                           block_end,
+                                           step,
+                                           dense_model=_worker['dense_model'])
+    else:
+        model, model_config = _worker['model']
+        predictions = predict_in_roi(block_begin,
+                                     block_end,
+                                     step,
+                                     model=model,
+                                     model_config=model_config)
+
+    slices = tuple(slice(o, o + s) for o, s in zip(block_offset, predictions.shape[1:]))
+    _worker['prediction'][(slice(None),) + slices] = predictions
+    _worker['done'][tuple(block_offset//_worker['block_size'])] = 1
+
+    return tuple(int(o) for o in block_offset)
+
+def predict_in_roi_blockwise(out, begin, end, step, block_size,
+                             num_workers=1,
+                             dense=False,
+                             train_dir=None,
+                             iteration=None):
+    """Predict the ROI block by block in ``num_workers`` processes, each
+    reading only the raw data of its blocks. Predictions are written into
+    ``out`` block by block, blocks finished in a previous run are skipped."""
+
+    start = time.time()
+    num_classes = get_num_classes(dense, train_dir)
+    blocks, block_size = prepare_blockwise(out, begin, end, step, block_size, num_classes)
+
+    initargs = (out, begin, end, step, block_size, dense, train_dir, iteration,
+                max(1, multiprocessing.cpu_count()//max(num_workers, 1)))
+
+    if num_workers <= 1:
+        init_block_worker(*initargs)
+        for i, block in enumerate(map(predict_block, blocks)):
+            print(f"Block {block} done ({i + 1}/{len(blocks)})")
+    else:
+        # spawn, models must not be shared with forked processes
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(num_workers,
+                          initializer=init_block_worker,
+                          initargs=initargs) as pool:
+            for i, block in enumerate(pool.imap_unordered(predict_block, blocks)):
+                print(f"Block {block} done ({i + 1}/{len(blocks)})")
+
+    print(f"Prediction of {len(blocks)} blocks took {time.time() - start}s")
+
 if __name__ == '__main__':
 
     args = parser.parse_args()
@@ -78,12 +296,31 @@ if __name__ == '__main__':
     center = center//step * step
     context = np.array(args.context) * step
 
-    f = zarr.open(args.out)
-    
-    predictions = predict_in_roi(center - context, 
-                                 center + context, 
-                                 step)
+    if args.block_size is not None:
+        block_size = args.block_size*3 if len(args.block_size) == 1 else args.block_size
+        predict_in_roi_blockwise(args.out,
+                                 center - context,
+                                 center + context,
+                                 step,
+                                 block_size,
+                                 num_workers=args.num_workers,
+                                 dense=args.dense,
+                                 train_dir=args.train_dir,
+                                 iteration=args.iteration)
+    else:
+        f = zarr.open(args.out)
+
+        if args.dense:
+            predictions = predict_in_roi_dense(center - context,
+                                               center + context,
+                                               step,
+                                               args.train_dir,
+                                               args.iteration)
+        else:
+            predictions = predict_in_roi(center - context, 
+                                         center + context, 
+                                         step)
 
-    f['prediction'] = predictions
-    f['prediction'].attrs['offset'] = list(int(x) for x in center - context)
-    f['prediction'].attrs['resolution'] = list(int(x) for x in step)
+        f['prediction'] = predictions
+        f['prediction'].attrs['offset'] = list(int(x) for x in center - context)
+        f['prediction'].attrs['resolution'] = list(int(x) for x in step)
@@ -1,10 +1,11 @@
-from pymongo import MongoClient, IndexModel, ASCENDING
+from pymongo import MongoClient, IndexModel, ASCENDING, UpdateOne
 from configparser import ConfigParser
 from copy import deepcopy
 import logging
 import time
 from itertools import permutations
 import os
+import uuid
 from iteration_utilities import duplicates
 
 logger = logging.getLogger(__name__)
@@ -666,6 +667,87 @@ class SynisterDb(object):
 
         predictions.insert_many(prediction_documents)
 
+        predictions.create_index([("synapse_id", ASCENDING)],
+                                 name="synapse_id")
+        predictions.create_index([("prediction", ASCENDING), ("lease", ASCENDING)],
+                                 name="lease")
+
+    def claim_predictions(self,
+                          split_name,
+                          experiment,
+                          train_number,
+                          predict_number,
+                          chunk_size,
+                          lease_time=600):
+        """Claim up to ``chunk_size`` synapses without prediction for
+        ``lease_time`` seconds. Synapses whose lease expired without a
+        prediction being written can be claimed again.
+
+        ``predict_number`` can also be a list of runs that are predicted
+        together. Leases are then held in the collection of the first run,
+        and synapses are claimable while their prediction is missing in any
+        of the runs.
+
+            Returns:
+
+                List of claimed synapse ids, empty only if there is currently
+                nothing left to claim.
+        """
+
+        if not isinstance(predict_number, (list, tuple)):
+            predict_number = [predict_number]
+
+        db = self.__get_db(self.db_name + "_predictions")
+        collection_names = ["{}_{}_t{}_p{}".format(split_name,
+                                                   experiment,
+                                                   train_number,
+                                                   p)
+                            for p in predict_number]
+        predictions = db[collection_names[0]]
+
+        while True:
+            now = time.time()
+            claimable = {"$or": [{"lease": None}, {"lease": {"$lt": now}}]}
+
+            if len(collection_names) == 1:
+                claimable["prediction"] = None
+                candidates = [p["synapse_id"] for p in
+                              predictions.find(claimable,
+                                               projection=["synapse_id"]).limit(chunk_size)]
+            else:
+                # join the predictions of the other runs
+                pipeline = [{"$match": claimable}]
+                missing = [{"prediction": None}]
+                for i, name in enumerate(collection_names[1:]):
+                    pipeline.append({"$lookup": {"from": name,
+                                                 "localField": "synapse_id",
+                                                 "foreignField": "synapse_id",
+                                                 "as": "run_{}".format(i)}})
+                    missing.append({"run_{}.prediction".format(i): None})
+                pipeline += [{"$match": {"$or": missing}},
+                             {"$limit": chunk_size},
+                             {"$project": {"synapse_id": 1}}]
+                candidates = [p["synapse_id"] for p in predictions.aggregate(pipeline)]
+
+            if not candidates:
+                return []
+
+            # each document is updated atomically, so concurrent claims of
+            # the same candidates only succeed for one lease owner
+            owner = uuid.uuid4().hex
+            predictions.update_many({**claimable, "synapse_id": {"$in": candidates}},
+                                    {"$set": {"lease": now + lease_time,
+                                              "lease_owner": owner}})
+
+            claimed = [p["synapse_id"] for p in
+                       predictions.find({"lease_owner": owner},
+                                        projection=["synapse_id"])]
+            if claimed:
+                return claimed
+
+            # all candidates went to other workers, they are not claimable
+            # anymore, try the next ones
+
     def write_prediction(self, 
                          split_name,
                          prediction,
@@ -693,21 +775,74 @@ class SynisterDb(object):
 
         if not (result.matched_count == 1):
             raise ValueError("Error, none or multiple matching synapses in split {}".format(split_name))
+
+    def write_predictions(self,
+                          split_name,
+                          experiment,
+                          train_number,
+                          predict_number,
+                          synapse_ids,
+                          predictions):
+        """Write predictions for many synapses with a single bulk write.
+
+        Args:
+
+            synapse_ids (list of int):
+
+                The ids of the synapses to update.
+
+            predictions (list of list of float):
+
+                The prediction for each synapse in ``synapse_ids``.
+        """
+
+        if len(synapse_ids) == 0:
+            return
+
+        db = self.__get_db(self.db_name + "_predictions")
+        predictions_collection = db["{}_{}_t{}_p{}".format(split_name,
+                                                           experiment,
+                                                           train_number,
+                                                           predict_number)]
+
+        requests = [UpdateOne({"synapse_id": int(synapse_id)},
+                              {"$set": {"prediction": [float(p) for p in prediction]}})
+                    for synapse_id, prediction in zip(synapse_ids, predictions)]
+
+        result = predictions_collection.bulk_write(requests, ordered=False)
+
+        if not (result.matched_count == len(requests)):
+            raise ValueError("Error, {} of {} synapses not found in split {}".format(
+                len(requests) - result.matched_count, len(requests), split_name))
  
     def count_predictions(self,
                           split_name,
                           experiment,
                           train_number,
                           predict_number):
+        """Count the predictions of a run, or of several runs if
+        ``predict_number`` is a list.
+
+            Returns:
+
+                ``(done, total)``, summed over all runs.
+        """
+
+        if not isinstance(predict_number, (list, tuple)):
+            predict_number = [predict_number]
 
         db = self.__get_db(self.db_name + "_predictions")
-        predictions = db["{}_{}_t{}_p{}".format(split_name, 
-                                                experiment,
-                                                train_number,
-                                                predict_number)]
 
-        total = predictions.count_documents({})
-        done = predictions.count_documents({"prediction": {"$ne": None}})
+        done = 0
+        total = 0
+        for p in predict_number:
+            predictions = db["{}_{}_t{}_p{}".format(split_name, 
+                                                    experiment,
+                                                    train_number,
+                                                    p)]
+
+            total += predictions.count_documents({})
+            done += predictions.count_documents({"prediction": {"$ne": None}})
 
         return done, total
 
@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+import json
+import logging
+import numpy as np
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# log spaced histogram bins from 10us to 1000s, four per decade
+default_bin_edges = np.logspace(-5, 3, 33)
+
+
+class StageTimer(object):
+    """Accumulates wall clock durations of named stages into histograms.
+
+    Use ``with timer.time("stage"): ...`` around the code to measure. If
+    ``log_file`` is given, the aggregated statistics of all stages are
+    appended as a json line every ``emit_interval`` seconds and once more by
+    ``close()``.
+
+    Args:
+
+        name (``string``):
+
+            Name of this timer, e.g. the worker it belongs to.
+
+        log_file (``string``, optional):
+
+            Json lines file to append statistics to.
+
+        emit_interval (``float``):
+
+            Seconds between periodically emitted statistics.
+    """
+
+    def __init__(self,
+                 name,
+                 log_file=None,
+                 emit_interval=60.0,
+                 bin_edges=default_bin_edges):
+
+        self.name = name
+        self.log_file = log_file
+        self.emit_interval = emit_interval
+        self.bin_edges = np.asarray(bin_edges)
+        self.stages = {}
+        self.start = time.time()
+        self.last_emit = self.start
+
+        if log_file is not None:
+            log_dir = os.path.dirname(log_file)
+            if log_dir and not os.path.exists(log_dir):
+                os.makedirs(log_dir, exist_ok=True)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+
+        if stage not in self.stages:
+            self.stages[stage] = {
+                "count": 0,
+                "total": 0.0,
+                "min": float("inf"),
+                "max": 0.0,
+                # underflow and overflow bins at both ends
+                "histogram": np.zeros(len(self.bin_edges) + 1, dtype=np.int64)
+            }
+
+        s = self.stages[stage]
+        s["count"] += 1
+        s["total"] += seconds
+        s["min"] = min(s["min"], seconds)
+        s["max"] = max(s["max"], seconds)
+        s["histogram"][np.searchsorted(self.bin_edges, seconds, side="right")] += 1
+
+        self.maybe_emit()
+
+    def __quantile(self, histogram, q):
+        # upper bin edge of the bin containing the q-th quantile
+        cumulative = np.cumsum(histogram)
+        i = int(np.searchsorted(cumulative, q*cumulative[-1]))
+        if i >= len(self.bin_edges):
+            return float("inf")
+        return float(self.bin_edges[i])
+
+    def summary(self):
+
+        summary = {}
+        for stage, s in self.stages.items():
+            summary[stage] = {
+                "count": s["count"],
+                "total": s["total"],
+                "mean": s["total"]/s["count"],
+                "min": s["min"],
+                "max": s["max"],
+                "p50": self.__quantile(s["histogram"], 0.5),
+                "p90": self.__quantile(s["histogram"], 0.9),
+                "p99": self.__quantile(s["histogram"], 0.99),
+                "histogram": s["histogram"].tolist()
+            }
+        return summary
+
+    def emit(self, kind="periodic"):
+
+        self.last_emit = time.time()
+        if self.log_file is None:
+            return
+
+        record = {
+            "name": self.name,
+            "kind": kind,
+            "time": self.last_emit,
+            "elapsed": self.last_emit - self.start,
+            "bin_edges": self.bin_edges.tolist(),
+            "stages": self.summary()
+        }
+        with open(self.log_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def maybe_emit(self):
+        if time.time() - self.last_emit >= self.emit_interval:
+            self.emit()
+
+    def close(self):
+
+        self.emit(kind="summary")
+
+        elapsed = time.time() - self.start
+        for stage, s in sorted(self.summary().items(), key=lambda x: -x[1]["total"]):
+            logger.info("{} {}: {} calls, {:.3f}s total ({:.1f}%), {:.4f}s mean, {:.4f}s p90".format(
+                self.name, stage, s["count"], s["total"], 100*s["total"]/max(elapsed, 1e-9),
+                s["mean"], s["p90"]))
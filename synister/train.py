@@ -2,15 +2,39 @@ import os
 from subprocess import check_call
 from funlib.run import run, run_singularity
 import logging
+from synister.launch import run_local
 from synister.read_config import read_worker_config
 import sys
 
 iteration = int(sys.argv[1])
+# optional number of data parallel ranks, run locally
+num_ranks = int(sys.argv[2]) if len(sys.argv) > 2 else 1
 worker_config = read_worker_config("worker_config.ini")
 
 base_cmd = "python {} {}".format("train_pipeline.py", iteration)
 					  
-if worker_config["singularity_container"] != "None" and worker_config["queue"] == "None":
+if num_ranks > 1:
+    assert(worker_config["queue"] == "None")
+    if worker_config["singularity_container"] != "None":
+        cmd = run_singularity(base_cmd,
+                              singularity_image=worker_config["singularity_container"],
+                              mount_dirs=worker_config["mount_dirs"],
+                              execute=False)
+        cmd = cmd if isinstance(cmd, str) else " ".join(cmd)
+    else:
+        cmd = base_cmd
+
+    master_port = os.environ.get("MASTER_PORT", "29500")
+    run_local([cmd]*num_ranks,
+              num_cpus=worker_config["num_cpus"],
+              log_dir="rank_logs",
+              envs=[{"RANK": rank,
+                     "WORLD_SIZE": num_ranks,
+                     "MASTER_ADDR": "127.0.0.1",
+                     "MASTER_PORT": master_port}
+                    for rank in range(num_ranks)])
+
+elif worker_config["singularity_container"] != "None" and worker_config["queue"] == "None":
     run_singularity(base_cmd,
                     singularity_image=worker_config["singularity_container"],
                     mount_dirs=worker_config["mount_dirs"],
@@ -8,9 +8,18 @@ import numpy as np
 import os
 import sys
 from funlib.learn.torch.models import Vgg3D
-from synister.gp import SynapseSourceMongo, SynapseTypeSource, InspectLabels, AddChannelDim
+from synister.gp import SynapseSourceMongo, SynapseTypeSource, AddChannelDim, \
+    CropCacheSource, RandomSynapseLocation, TrainingMetrics, AsyncSnapshot, CachedElasticAugment, \
+    ResumableTrain, InputWait
+from synister.checkpoint import CheckpointManager, get_latest_checkpoint
+from synister.data_loader import create_data_loader, DataLoaderSource
+from synister.distributed import init_distributed, get_rank, get_world_size, \
+    broadcast_flag, AllReduceOptimizer
+from synister.validation import Validation
 from synister.read_config import read_train_config
 
+logger = logging.getLogger(__name__)
+
 torch.backends.cudnn.enabled = True
 torch.backends.cudnn.benchmark = True
 
@@ -30,7 +39,21 @@ def train_until(max_iteration,
                 network="VGG",
                 fmap_inc=(2,2,2,2),
                 n_convolutions=(2,2,2,2),
-                network_appendix="b0"):
+                network_appendix="b0",
+                point_table=None,
+                crop_store=None,
+                direct_sampling=False,
+                snapshot_keep_last=None,
+                elastic_pool_size=None,
+                data_loader=False,
+                num_workers=10,
+                cache_size=40,
+                validation_crop_store=None,
+                validate_every=1000,
+                patience=None,
+                checkpoint_every=1000,
+                checkpoint_keep_last=None,
+                checkpoint_keep_every=None):
 
     input_shape = Coordinate(input_shape)
 
@@ -57,6 +80,16 @@ def train_until(max_iteration,
         model.parameters(),
         lr=1e-4)
 
+    # data parallel: one pipeline per rank, gradients averaged over ranks,
+    # only rank 0 writes checkpoints, logs and snapshots. All ranks have to
+    # resume from the same checkpoint (on a shared file system), parameters
+    # are broadcast by ResumableTrain, after resuming.
+    rank = get_rank()
+    world_size = get_world_size()
+    if world_size > 1:
+        logger.info("Training rank {} of {}".format(rank, world_size))
+        optimizer = AllReduceOptimizer(optimizer)
+
     raw = ArrayKey('RAW')
     synapses = PointsKey('SYNAPSES')
     synapse_type = ArrayKey('SYNAPSE_TYPE')
@@ -66,9 +99,23 @@ def train_until(max_iteration,
     input_size = input_shape*voxel_size
 
     request = BatchRequest()
-    request.add(raw, input_size)
-    request.add(synapses, input_size/8)
+    if crop_store is None and not direct_sampling:
+        request.add(raw, input_size)
+        request.add(synapses, input_size/8)
+    elif crop_store is None:
+        request.add(raw, input_size)
+    else:
+        # crops of the crop store are centered on their synapse
+        request[raw] = ArraySpec(roi=Roi(-(input_shape//2)*voxel_size, input_size))
     request[synapse_type] = ArraySpec(nonspatial=True)
+
+    if data_loader:
+        # samples are requested by the data loader workers, Train sees only
+        # the stacked batches
+        sample_request = request
+        request = BatchRequest()
+        request[raw] = sample_request[raw].copy()
+        request[synapse_type] = ArraySpec(nonspatial=True)
     request[pred_synapse_type] = ArraySpec(nonspatial=True)
 
     fafb_source = (
@@ -80,22 +127,59 @@ def train_until(max_iteration,
         Pad(raw, None)
     )
 
-    sample_sources = tuple(
-        (
-            fafb_source,
-            SynapseSourceMongo(
+    if crop_store is not None:
+        sample_sources = tuple(
+            CropCacheSource(
+                crop_store,
+                raw,
+                voxel_size,
+                label=synapse_types.index(t),
+                synapse_type=synapse_type,
+                synapse_types=synapse_types) +
+            Normalize(raw) +
+            Pad(raw, None)
+
+            for t in synapse_types
+        )
+    elif direct_sampling:
+        sample_sources = ()
+        for t in synapse_types:
+            synapse_source = SynapseSourceMongo(
                 db_credentials,
                 db_name_data,
                 split_name,
                 tuple([t]),
-                synapses),
-            SynapseTypeSource(synapse_types, t, synapse_type)
-        ) +
-        MergeProvider() +
-        RandomLocation(ensure_nonempty=synapses)
+                synapses,
+                point_table_snapshot=point_table)
+            sample_sources += (
+                (
+                    fafb_source,
+                    synapse_source,
+                    SynapseTypeSource(synapse_types, t, synapse_type)
+                ) +
+                MergeProvider() +
+                # synapse within the central input_size/8, as with
+                # RandomLocation(ensure_nonempty=synapses)
+                RandomSynapseLocation(synapse_source, voxel_size, jitter=input_size/16),
+            )
+    else:
+        sample_sources = tuple(
+            (
+                fafb_source,
+                SynapseSourceMongo(
+                    db_credentials,
+                    db_name_data,
+                    split_name,
+                    tuple([t]),
+                    synapses,
+                    point_table_snapshot=point_table),
+                SynapseTypeSource(synapse_types, t, synapse_type)
+            ) +
+            MergeProvider() +
+            RandomLocation(ensure_nonempty=synapses)
 
-        for t in synapse_types
-    )
+            for t in synapse_types
+        )
     if neither_class:
         neither_sources = (
             (
@@ -106,7 +190,8 @@ def train_until(max_iteration,
                     db_name_data,
                     split_name,
                     ('gaba',),  # doesn't matter
-                    synapses),
+                    synapses,
+                    point_table_snapshot=point_table),
                 SynapseTypeSource(synapse_types, -1, synapse_type)
             ) + 
             MergeProvider() + 
@@ -119,26 +204,57 @@ def train_until(max_iteration,
 
 
 
+    elastic_args = dict(
+        control_point_spacing=[4,40,40],
+        jitter_sigma=[0,2,2],
+        rotation_interval=[0,math.pi/2.0],
+        prob_slip=0.05,
+        prob_shift=0.05,
+        max_misalign=10,
+        subsample=8)
+    if elastic_pool_size is None:
+        elastic_augment = ElasticAugment(**elastic_args)
+    else:
+        elastic_augment = CachedElasticAugment(pool_size=elastic_pool_size, **elastic_args)
+
     pipeline = (
         sources +
         RandomProvider() +
-        ElasticAugment(
-            control_point_spacing=[4,40,40],
-            jitter_sigma=[0,2,2],
-            rotation_interval=[0,math.pi/2.0],
-            prob_slip=0.05,
-            prob_shift=0.05,
-            max_misalign=10,
-            subsample=8) +
+        elastic_augment +
         SimpleAugment(transpose_only=[1, 2]) +
         IntensityAugment(raw, 0.9, 1.1, -0.1, 0.1, z_section_wise=True) +
-        IntensityScaleShift(raw, 2,-1) +
-        PreCache(
-            cache_size=40,
-            num_workers=10) +
-        AddChannelDim(raw) + 
-        Stack(batch_size) +
-        Train(
+        IntensityScaleShift(raw, 2,-1)
+    )
+
+    if data_loader:
+        pipeline = DataLoaderSource(
+            create_data_loader(
+                pipeline,
+                sample_request,
+                raw,
+                synapse_type,
+                batch_size,
+                num_workers=num_workers,
+                cache_size=cache_size),
+            raw,
+            synapse_type,
+            ArraySpec(voxel_size=voxel_size, interpolatable=True, dtype=np.float32))
+    else:
+        pipeline = (
+            pipeline +
+            PreCache(
+                cache_size=cache_size,
+                num_workers=num_workers) +
+            AddChannelDim(raw) + 
+            Stack(batch_size)
+        )
+
+    input_wait = InputWait()
+
+    pipeline = (
+        pipeline +
+        input_wait +
+        ResumableTrain(
             model,
             loss=loss,
             optimizer=optimizer,
@@ -150,28 +266,78 @@ def train_until(max_iteration,
             array_specs={
                 pred_synapse_type: ArraySpec(nonspatial=True)
             },
-            save_every=1000,
-            log_dir='log') +
-        InspectLabels(
+            # checkpoints are written by the CheckpointManager below
+            save_every=sys.maxsize,
+            log_dir='log' if rank == 0 else None) +
+        TrainingMetrics(
             synapse_type,
-            pred_synapse_type) +
-        IntensityScaleShift(raw, 0.5, 0.5) +
-        Snapshot({
-                raw: 'volumes/raw',
-                synapse_type: 'synapse_type',
-                pred_synapse_type: 'pred_synapse_type'
-            },
-            every=100,
-            output_filename='batch_{iteration}.hdf') +
-        PrintProfilingStats(every=10)
+            pred_synapse_type,
+            list(synapse_types) + (["neither"] if neither_class else []),
+            log_file='metrics.jsonl' if rank == 0 else 'metrics_rank{}.jsonl'.format(rank),
+            log_dir='log' if rank == 0 else None,
+            every=10,
+            input_wait=input_wait)
     )
 
+    if rank == 0:
+        pipeline = (
+            pipeline +
+            IntensityScaleShift(raw, 0.5, 0.5) +
+            AsyncSnapshot({
+                    raw: 'volumes/raw',
+                    synapse_type: 'synapse_type',
+                    pred_synapse_type: 'pred_synapse_type'
+                },
+                every=100,
+                output_filename='batch_{iteration}.hdf',
+                keep_last=snapshot_keep_last)
+        )
+
+    validation = None
+    if validation_crop_store is not None and rank == 0:
+        validation = Validation(
+            model,
+            optimizer,
+            validation_crop_store,
+            db_credentials,
+            db_name_data,
+            split_name,
+            synapse_types,
+            neither_class,
+            input_shape,
+            voxel_size,
+            raw_container,
+            raw_dataset,
+            point_table=point_table,
+            patience=patience)
+        # continue the validation history of the checkpoint we resume from
+        validation.restore(get_latest_checkpoint()[1])
+
+    checkpoints = None
+    if rank == 0:
+        checkpoints = CheckpointManager(
+            keep_last=checkpoint_keep_last,
+            keep_every=checkpoint_keep_every)
+
     print("Starting training...")
     with build(pipeline) as p:
         while True:
             batch = p.request_batch(request)
-            if batch.iteration >= max_iteration:
+            stop = batch.iteration >= max_iteration
+            if validation_crop_store is not None and batch.iteration % validate_every == 0:
+                validation_stop = validation(batch.iteration) if validation is not None else False
+                if world_size > 1:
+                    validation_stop = broadcast_flag(validation_stop)
+                stop = stop or validation_stop
+
+            if checkpoints is not None and (batch.iteration % checkpoint_every == 0 or stop):
+                # the best model is kept by the validation as model_checkpoint_best
+                checkpoints.save(batch.iteration, model, optimizer)
+            if stop:
                 break
+
+    if checkpoints is not None:
+        checkpoints.wait()
     print("Training finished")
 
 if __name__ == "__main__":
@@ -179,4 +345,5 @@ if __name__ == "__main__":
     iteration = int(sys.argv[1])
     train_config = read_train_config("./train_config.ini")
     train_config["max_iteration"] = iteration
+    init_distributed()
     train_until(**train_config)
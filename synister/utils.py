@@ -3,49 +3,222 @@ import numpy as np
 import torch.nn.functional as F
 import torch
 from funlib.learn.torch.models import Vgg3D
+from synister.checkpoint import load_weights
+import atexit
 import logging
-from multiprocessing import Pool, TimeoutError
+from contextlib import contextmanager
+from multiprocessing import Pool, RawArray, TimeoutError, cpu_count
 
 logger = logging.getLogger(__name__)
 
+
+@contextmanager
+def nullcontext():
+    yield
+
+
 def predict(raw_batched,
-            model):
+            model,
+            device=None,
+            timer=None):
+    """Class probabilities for a batch of crops.
+
+    Args:
+
+        raw_batched (``ndarray``):
+
+            Batch of uint8 crops of shape ``(b, z, y, x)`` or
+            ``(b, 1, z, y, x)``, see ``to_model_input``.
+    """
+
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    raw_batched_tensor = torch.tensor(raw_batched, device=device)
-    output = model(raw_batched_tensor)
-    output = F.softmax(output, dim=1)
+    raw_batched_tensor = to_model_input(raw_batched, device, timer=timer)
+    with timed(timer, "inference"):
+        output = model(raw_batched_tensor)
+        output = F.softmax(output, dim=1)
+        if timer is not None and device.type == 'cuda':
+            torch.cuda.synchronize(device)
     return output
 
 
+def to_model_input(raw_batched, device, timer=None):
+    """Move a batch of crops to ``device`` and normalize it there.
+
+    uint8 crops are transferred as they are and mapped to [-1, 1] in place
+    on the device, as done in training. Float crops are assumed to be
+    normalized already. A channel dimension is added to batches of shape
+    ``(b, z, y, x)``.
+    """
+
+    with timed(timer, "transfer"):
+        raw_batched_tensor = torch.as_tensor(raw_batched).to(device)
+    with timed(timer, "normalize"):
+        if raw_batched_tensor.dtype == torch.uint8:
+            raw_batched_tensor = raw_batched_tensor.float()
+            raw_batched_tensor.mul_(2.0/255.0).sub_(1.0)
+        if raw_batched_tensor.dim() == 4:
+            raw_batched_tensor = raw_batched_tensor.unsqueeze(1)
+    return raw_batched_tensor
+
+
+def timed(timer, stage):
+    """``timer.time(stage)`` or a no-op context if ``timer`` is None."""
+
+    if timer is None:
+        return nullcontext()
+    return timer.time(stage)
+
+
 def init_vgg(checkpoint_file,
              input_shape,
              fmaps,
              downsample_factors=[(2,2,2), (2,2,2), (2,2,2), (2,2,2)],
-             output_classes=None):
+             output_classes=None,
+             fmap_inc=(2,2,2,2),
+             n_convolutions=(2,2,2,2),
+             device=None):
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     if output_classes is None:
         output_classes = 6
 
     model = Vgg3D(input_size=input_shape, fmaps=fmaps,
                   downsample_factors=downsample_factors,
+                  fmap_inc=fmap_inc,
+                  n_convolutions=n_convolutions,
                   output_classes=output_classes)
     model.to(device)
     logger.info("Init vgg with checkpoint {}".format(checkpoint_file))
-    checkpoint = torch.load(checkpoint_file, map_location=device)
-    model.load_state_dict(checkpoint['model_state_dict'])
+    load_weights(model, checkpoint_file, device)
     return model
 
 
+class RawReaderPool(object):
+    """
+    Long-lived pool of worker processes reading raw crops in parallel.
+
+    Each worker opens the dataset once and writes its crops into a shared
+    memory buffer, so crops are not pickled between processes. Out of
+    bounds crops are padded with zeros, as in ``get_raw``.
+
+    size(``tuple of ints``):
+
+        size of cropout in voxel
+
+    voxel_size(``tuple of ints``):
+
+        size of a voxel
+
+    data_container(``string``):
+
+        path to data container (e.g. zarr file)
+
+    data_set(``string``):
+
+        corresponding data_set name, (e.g. raw)
+
+    num_workers(``int``):
+
+        number of reader processes
+
+    max_batch_size(``int``):
+
+        maximal number of crops read at once, larger requests are split
+    """
+
+    def __init__(self,
+                 size,
+                 voxel_size,
+                 data_container,
+                 data_set,
+                 num_workers,
+                 max_batch_size):
+
+        self.size = tuple(int(s) for s in size)
+        self.max_batch_size = max_batch_size
+        self.buffer = RawArray('B', int(max_batch_size*np.prod(self.size)))
+        self.crops = np.frombuffer(self.buffer, dtype=np.uint8).reshape(
+            (max_batch_size,) + self.size)
+        self.pool = Pool(processes=num_workers,
+                         initializer=_init_raw_reader,
+                         initargs=(self.buffer,
+                                   max_batch_size,
+                                   self.size,
+                                   tuple(voxel_size),
+                                   data_container,
+                                   data_set))
+
+    def read(self, locs, copy=True):
+        """
+        Get uint8 raw crops centered at ``locs``. With ``copy=False``, a
+        view of the shared buffer is returned for batches of at most
+        ``max_batch_size`` crops, which is only valid until the next read.
+        """
+
+        if len(locs) > self.max_batch_size:
+            return np.concatenate([
+                self.read(locs[i:i+self.max_batch_size])
+                for i in range(0, len(locs), self.max_batch_size)])
+
+        self.pool.map(_read_raw_crop,
+                      [(i, tuple(int(c) for c in loc)) for i, loc in enumerate(locs)])
+
+        crops = self.crops[:len(locs)]
+        if copy:
+            crops = crops.copy()
+        return crops
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# state of a RawReaderPool worker process
+_raw_reader = {}
+
+
+def _init_raw_reader(buffer, max_batch_size, size, voxel_size, data_container, data_set):
+
+    _raw_reader["crops"] = np.frombuffer(buffer, dtype=np.uint8).reshape(
+        (max_batch_size,) + tuple(size))
+    _raw_reader["size"] = daisy.Coordinate(size)
+    _raw_reader["voxel_size"] = daisy.Coordinate(voxel_size)
+    _raw_reader["dataset"] = open_raw_dataset(data_container, data_set, voxel_size)
+
+
+def _read_raw_crop(args):
+
+    i, loc = args
+    size = _raw_reader["size"]
+    voxel_size = _raw_reader["voxel_size"]
+    _raw_reader["crops"][i] = fetch_from_ds(_raw_reader["dataset"],
+                                            loc,
+                                            voxel_size,
+                                            size,
+                                            size*voxel_size)
+
+
+# reader pools of get_raw_parallel, by data set and crop size
+_raw_reader_pools = {}
+
+
 def get_raw_parallel(locs,
                     size,
                     voxel_size,
                     data_container,
                     data_set):
     """
-    Get raw crops from the specified
-    dataset.
+    Get uint8 raw crops from the specified
+    dataset, using a ``RawReaderPool`` that is kept alive between calls.
 
     locs(``list of tuple of ints``):
 
@@ -69,26 +242,55 @@ def get_raw_parallel(locs,
 
     """
 
-    pool = Pool(processes=len(locs))
-    raw = []
-    size = daisy.Coordinate(size)
+    if len(locs) == 0:
+        return np.zeros((0,) + tuple(int(s) for s in size), dtype=np.uint8)
+
+    key = (tuple(size), tuple(voxel_size), data_container, data_set)
+    pool = _raw_reader_pools.get(key)
+
+    if pool is None or pool.max_batch_size < len(locs):
+        if pool is not None:
+            pool.close()
+        pool = RawReaderPool(size,
+                             voxel_size,
+                             data_container,
+                             data_set,
+                             num_workers=cpu_count(),
+                             max_batch_size=len(locs))
+        _raw_reader_pools[key] = pool
+
+    return pool.read(locs)
+
+
+@atexit.register
+def close_raw_reader_pools():
+    """Close the reader pools of ``get_raw_parallel``."""
+
+    while _raw_reader_pools:
+        _, pool = _raw_reader_pools.popitem()
+        pool.close()
+
+def open_raw_dataset(data_container,
+                     data_set,
+                     voxel_size):
+    """
+    Open a daisy dataset, overriding its voxel size with ``voxel_size``
+    if they differ.
+    """
+
     voxel_size = daisy.Coordinate(voxel_size)
-    size_nm = (size*voxel_size)
     dataset = daisy.open_ds(data_container,
                             data_set)
 
-    raw_workers = [pool.apply_async(fetch_from_ds, 
-                            (dataset, loc, voxel_size, size, size_nm))
-                            for loc in locs]
-    raw = [w.get(timeout=60) for w in raw_workers]
-    pool.close()
-    pool.join()
+    if tuple(dataset.voxel_size) != tuple(voxel_size):
+        dataset.voxel_size = voxel_size
+        roi_shape = dataset.roi.get_shape()
+        roi_offset = dataset.roi.get_offset()
+        roi_shape_phys = roi_shape * voxel_size[::-1]
+        roi_offset_phys = roi_offset * voxel_size[::-1]
+        dataset.roi = daisy.Roi(roi_offset_phys, roi_shape_phys)
 
-    raw = np.stack(raw)
-    raw = raw.astype(np.float32)
-    raw_normalized = raw/255.0
-    raw_normalized = raw_normalized*2.0 - 1.0
-    return raw, raw_normalized
+    return dataset
 
 def get_raw(locs,
             size,
@@ -96,7 +298,7 @@ def get_raw(locs,
             data_container,
             data_set):
     """
-    Get raw crops from the specified
+    Get uint8 raw crops from the specified
     dataset.
     locs(``list of tuple of ints``):
         list of centers of location of interest
@@ -114,36 +316,14 @@ def get_raw(locs,
     size = daisy.Coordinate(size)
     voxel_size = daisy.Coordinate(voxel_size)
     size_nm = (size*voxel_size)
-    dataset = daisy.open_ds(data_container,
-                            data_set)
-
-    if tuple(dataset.voxel_size) != tuple(voxel_size):
-        dataset.voxel_size = voxel_size
-        roi_shape = dataset.roi.get_shape()
-        roi_offset = dataset.roi.get_offset()
-        roi_shape_phys = roi_shape * voxel_size[::-1]
-        roi_offset_phys = roi_offset * voxel_size[::-1]
-        dataset.roi = daisy.Roi(roi_offset_phys, roi_shape_phys)
+    dataset = open_raw_dataset(data_container,
+                               data_set,
+                               voxel_size)
 
     for loc in locs:
-        loc = daisy.Coordinate(tuple(loc))
-        offset_nm = loc - (size/2*voxel_size)
-        roi = daisy.Roi(offset_nm, size_nm).snap_to_grid(voxel_size, mode='closest')
-
-        if roi.get_shape()[0] != size[0]:
-            roi.set_shape(size_nm)
+        raw.append(fetch_from_ds(dataset, loc, voxel_size, size, size_nm))
 
-        if not dataset.roi.contains(roi):
-            logger.warning(f"Location {loc} is not fully contained in dataset")
-            raw.append(dataset.to_ndarray(roi=roi, fill_value=0))
-        else:
-            raw.append(dataset[roi].to_ndarray())
-
-    raw = np.stack(raw)
-    raw = raw.astype(np.float32)
-    raw_normalized = raw/255.0
-    raw_normalized = raw_normalized*2.0 - 1.0
-    return raw, raw_normalized
+    return np.stack(raw).astype(np.uint8, copy=False)
 
 def get_array(data_container,
               data_set,
@@ -165,7 +345,7 @@ def get_raw_dense(locs,
                   data_array_offset,
                   voxel_size):
     """
-    Get raw crops from the specified
+    Get uint8 raw crops from the specified
     data array.
     locs(``list of tuple of ints``):
         list of centers of location of interest
@@ -180,11 +360,7 @@ def get_raw_dense(locs,
                               int(loc[1] - size[1]/2):int(loc[1] + size[1]/2),
                               int(loc[2] - size[2]/2):int(loc[2] + size[2]/2)])
 
-    raw = np.stack(raw)
-    raw = raw.astype(np.float32)
-    raw_normalized = raw/255.0
-    raw_normalized = raw_normalized*2.0 - 1.0
-    return raw, raw_normalized
+    return np.stack(raw).astype(np.uint8, copy=False)
 
 
 def fetch_from_ds(dataset, loc, voxel_size, size, size_nm):
@@ -198,8 +374,6 @@ def fetch_from_ds(dataset, loc, voxel_size, size, size_nm):
 
     if not dataset.roi.contains(roi):
         logger.warning(f"Location {loc} is not fully contained in dataset")
-        return None
+        return dataset.to_ndarray(roi=roi, fill_value=0)
 
     return dataset[roi].to_ndarray()
-
-    
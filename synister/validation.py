@@ -0,0 +1,256 @@
+from synister.crop_cache import CropCache, build_crop_cache
+from synister.evaluate import synaptic_confusion_matrix, skeleton_confusion_matrix, \
+    get_accuracy
+from synister.synister_db import SynisterDb
+from synister.utils import predict
+import json
+import logging
+import numpy as np
+import os
+import time
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class Validation(object):
+    '''Evaluates the model during training on the validation part of the
+    split, read from a local crop cache, keeps the checkpoint with the best
+    accuracy and decides when to stop.
+
+    The crop cache is built on first use (see ``synister.crop_cache``), with
+    labels for ``synapse_types``. Synaptic and skeleton (majority vote)
+    accuracies are computed with ``synister.evaluate``; the average
+    per-class synaptic accuracy decides which checkpoint is best.
+
+    Args:
+
+        model (``torch.nn.Module``):
+
+            The model being trained.
+
+        optimizer (``torch.optim.Optimizer``):
+
+            Its optimizer, to store in the best checkpoint.
+
+        crop_store (``string``):
+
+            Directory of the validation crop cache.
+
+        patience (``int``, optional):
+
+            Number of validations without improvement after which training
+            stops. Never stops if not given.
+
+        checkpoint (``string``):
+
+            File to save the best model to, in the format of the ``Train``
+            checkpoints, with its ``iteration`` and ``accuracy``.
+
+        log_file (``string``):
+
+            Json lines file to append the results of each validation to.
+    '''
+
+    def __init__(self,
+                 model,
+                 optimizer,
+                 crop_store,
+                 db_credentials,
+                 db_name_data,
+                 split_name,
+                 synapse_types,
+                 neither_class,
+                 input_shape,
+                 voxel_size,
+                 raw_container,
+                 raw_dataset,
+                 point_table=None,
+                 patience=None,
+                 batch_size=32,
+                 checkpoint="model_checkpoint_best",
+                 log_file="validation.jsonl"):
+
+        self.model = model
+        self.optimizer = optimizer
+        self.synapse_types = list(synapse_types)
+        self.neither_class = neither_class
+        self.patience = patience
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.log_file = log_file
+
+        if not os.path.exists(os.path.join(crop_store, "attrs.json")):
+            build_crop_cache(crop_store,
+                             db_credentials,
+                             db_name_data,
+                             split_name,
+                             "validation",
+                             input_shape,
+                             voxel_size,
+                             raw_container,
+                             raw_dataset,
+                             synapse_types=self.synapse_types,
+                             point_table=point_table)
+        self.cache = CropCache(crop_store,
+                               voxel_size=voxel_size,
+                               synapse_types=self.synapse_types)
+
+        if tuple(self.cache.input_shape) != tuple(input_shape):
+            raise ValueError("Crop cache {} has input shape {}, not {}".format(
+                crop_store, self.cache.input_shape, tuple(input_shape)))
+        if self.cache.labels is None:
+            raise ValueError("Crop cache {} has no labels".format(crop_store))
+
+        # skeletons are only needed for the skeleton accuracy, read them once
+        db = SynisterDb(db_credentials, db_name_data)
+        synapses = db.get_synapses(synapse_ids=[int(s) for s in self.cache.synapse_ids])
+        self.skeleton_ids = [synapses[int(s)]["skeleton_id"] for s in self.cache.synapse_ids]
+
+        logger.info("Validating on {} synapses of {}".format(len(self.cache), crop_store))
+
+        self.best_accuracy = None
+        self.best_iteration = None
+        self.num_worse = 0
+
+    def restore(self, iteration):
+        '''Restore the best accuracy and the number of validations without
+        improvement from the results logged up to ``iteration``, e.g. when
+        resuming training from the checkpoint at ``iteration``. Results of
+        later iterations are removed from the log, they will be logged
+        again.
+
+        A best checkpoint saved after ``iteration`` (by the run that is
+        resumed) is kept and stays the best one, until a better model is
+        found.'''
+
+        if not os.path.exists(self.log_file):
+            return
+
+        with open(self.log_file, "r") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        records = sorted([r for r in records if r["iteration"] <= iteration],
+                         key=lambda r: r["iteration"])
+
+        tmp_file = self.log_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        os.replace(tmp_file, self.log_file)
+
+        for record in records:
+            accuracy = record["synaptic_accuracy_average"]
+            if self.best_accuracy is None or accuracy > self.best_accuracy:
+                self.best_accuracy = accuracy
+                self.best_iteration = record["iteration"]
+                self.num_worse = 0
+            else:
+                self.num_worse += 1
+
+        # the best checkpoint on disk is the best model, even if it is ahead
+        # of the resumed iteration
+        if os.path.exists(self.checkpoint):
+            best = torch.load(self.checkpoint, map_location="cpu")
+            if "iteration" in best and best["iteration"] != self.best_iteration:
+                if best["iteration"] > iteration:
+                    logger.info("Keeping best checkpoint of iteration {}, ahead of "
+                                "the resumed iteration {}".format(best["iteration"],
+                                                                  iteration))
+                self.best_accuracy = best["accuracy"]
+                self.best_iteration = best["iteration"]
+                self.num_worse = len([r for r in records
+                                      if r["iteration"] > self.best_iteration])
+
+        if self.best_iteration is not None:
+            logger.info("Restored validation state, best iteration {}".format(
+                self.best_iteration))
+
+    def __call__(self, iteration):
+        '''Validate the current model, save it if it is the best so far.
+        Returns ``True`` if training should stop.'''
+
+        start = time.time()
+        predictions = self.predict()
+
+        predict_config = {"synapse_types": self.synapse_types,
+                          "neither_class": self.neither_class}
+        synapses = {
+            int(synapse_id): {
+                # lists, as stored in the DB, evaluate compares them to "null"
+                "prediction": predictions[i].tolist(),
+                "skeleton_id": self.skeleton_ids[i],
+                "nt_known": [self.synapse_types[self.cache.labels[i]]]
+            }
+            for i, synapse_id in enumerate(self.cache.synapse_ids)
+        }
+        synaptic_accuracy = get_accuracy(synaptic_confusion_matrix(synapses, predict_config))
+
+        # skeletons are voted over the synapse types only
+        for i, synapse in enumerate(synapses.values()):
+            synapse["prediction"] = predictions[i][:len(self.synapse_types)].tolist()
+        skeleton_accuracy = get_accuracy(skeleton_confusion_matrix(synapses, predict_config))
+
+        accuracy = synaptic_accuracy[1]
+        improved = self.best_accuracy is None or accuracy > self.best_accuracy
+        if improved:
+            self.best_accuracy = accuracy
+            self.best_iteration = iteration
+            self.num_worse = 0
+            self.save(iteration, accuracy)
+        else:
+            self.num_worse += 1
+
+        stop = self.patience is not None and self.num_worse >= self.patience
+
+        record = {
+            "iteration": int(iteration),
+            "time": time.time(),
+            "duration": time.time() - start,
+            "synaptic_accuracy": float(synaptic_accuracy[0]),
+            "synaptic_accuracy_average": float(synaptic_accuracy[1]),
+            "skeleton_accuracy": float(skeleton_accuracy[0]),
+            "skeleton_accuracy_average": float(skeleton_accuracy[1]),
+            "best_iteration": int(self.best_iteration),
+            "stop": stop
+        }
+        with open(self.log_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+        logger.info("Validation at iteration {}: synaptic accuracy {:.3f} (average {:.3f}), "
+                    "skeleton accuracy {:.3f} (average {:.3f}), best iteration {}".format(
+                        iteration,
+                        synaptic_accuracy[0],
+                        synaptic_accuracy[1],
+                        skeleton_accuracy[0],
+                        skeleton_accuracy[1],
+                        self.best_iteration))
+        if stop:
+            logger.info("No improvement in {} validations, stopping".format(self.num_worse))
+
+        return stop
+
+    def predict(self):
+
+        device = next(self.model.parameters()).device
+
+        self.model.eval()
+        predictions = []
+        with torch.no_grad():
+            for i in range(0, len(self.cache), self.batch_size):
+                rows = np.arange(i, min(i + self.batch_size, len(self.cache)))
+                output = predict(self.cache.get_rows(rows), self.model, device)
+                predictions.append(output.cpu().numpy())
+        self.model.train()
+
+        return np.concatenate(predictions)
+
+    def save(self, iteration, accuracy):
+
+        # write to a temporary file first, the best checkpoint might be read
+        tmp_checkpoint = self.checkpoint + ".tmp"
+        torch.save({"model_state_dict": self.model.state_dict(),
+                    "optimizer_state_dict": self.optimizer.state_dict(),
+                    "iteration": int(iteration),
+                    "accuracy": float(accuracy)},
+                   tmp_checkpoint)
+        os.replace(tmp_checkpoint, self.checkpoint)
@@ -1,3 +1,17 @@
 from .test_synister_db import *
 from .test_split import *
 from .test_source import *
+from .test_timing import *
+from .test_prediction_store import *
+from .test_point_table import *
+from .test_checkpoint import *
+from .test_imports import *
+from .test_dense import *
+from .test_crop_cache_source import *
+from .test_random_synapse_location import *
+from .test_async_snapshot import *
+from .test_cached_elastic_augment import *
+from .test_raw_reader_pool import *
+from .test_quantize import *
+from .test_predict_in_roi import *
+from .test_predict_server import *
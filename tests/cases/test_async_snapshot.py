@@ -0,0 +1,39 @@
+import unittest
+from synister.gp import AsyncSnapshot
+from gunpowder import *
+import h5py
+import numpy as np
+import os
+import tempfile
+
+class AsyncSnapshotTestCase(unittest.TestCase):
+    def runTest(self):
+        raw = ArrayKey('RAW')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot = AsyncSnapshot({raw: 'volumes/raw'},
+                                     output_dir=tmp_dir,
+                                     every=2,
+                                     queue_size=10,
+                                     keep_last=2)
+            snapshot.setup()
+
+            for iteration in range(1, 9):
+                batch = Batch()
+                batch.iteration = iteration
+                batch.arrays[raw] = Array(
+                    np.full((2, 4, 4), iteration, dtype=np.float32),
+                    ArraySpec(roi=Roi((0, 0, 0), (80, 16, 16)), voxel_size=(40, 4, 4)))
+                snapshot.process(batch, BatchRequest())
+
+            snapshot.teardown()
+
+            # every second iteration written, only the last two kept
+            self.assertTrue(sorted(os.listdir(tmp_dir)) == ["batch_6.hdf", "batch_8.hdf"])
+            with h5py.File(os.path.join(tmp_dir, "batch_8.hdf"), "r") as f:
+                dataset = f["volumes/raw"]
+                self.assertTrue(np.all(dataset[:] == 8))
+                self.assertTrue(dataset.compression == "gzip")
+                self.assertTrue(tuple(dataset.attrs["resolution"]) == (40, 4, 4))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+from synister.gp import CachedElasticAugment
+from gunpowder import ElasticAugment
+import math
+import numpy as np
+
+class CachedElasticAugmentTestCase(unittest.TestCase):
+    def runTest(self):
+        # CachedElasticAugment overrides this private method of the pinned
+        # gunpowder version
+        self.assertTrue(
+            hasattr(ElasticAugment, "_ElasticAugment__create_transformation"),
+            "ElasticAugment.__create_transformation is gone, CachedElasticAugment "
+            "does not work with this gunpowder version")
+
+        augment = CachedElasticAugment(
+            control_point_spacing=[4, 4, 4],
+            jitter_sigma=[0, 2, 2],
+            rotation_interval=[0, math.pi/2.0],
+            pool_size=2,
+            refresh_prob=0.0)
+
+        target_shape = (4, 16, 16)
+        create = augment._ElasticAugment__create_transformation
+
+        first = [create(target_shape) for _ in range(2)]
+        pool = augment.pools[target_shape]
+        self.assertTrue(len(pool) == 2)
+
+        # once full, transformations are reused from the pool
+        for _ in range(10):
+            transformation = create(target_shape)
+            self.assertTrue(any(np.array_equal(transformation, t) for t in pool))
+            # copies are returned, changing them does not change the pool
+            transformation += 1
+            self.assertFalse(any(np.array_equal(transformation, t) for t in pool))
+        self.assertTrue(len(augment.pools[target_shape]) == 2)
+        self.assertTrue(all(np.array_equal(f, t) for f, t in zip(first, pool)))
+
+        # other shapes get their own pool
+        create((4, 8, 8))
+        self.assertTrue(len(augment.pools) == 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+from synister.checkpoint import CheckpointManager, get_checkpoint_iterations, \
+    get_latest_checkpoint
+import os
+import tempfile
+
+class CheckpointRetentionTestCase(unittest.TestCase):
+    def runTest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            basename = os.path.join(tmp_dir, "model")
+            names = ["model_checkpoint_{}".format(i) for i in range(1000, 11000, 1000)]
+            names += ["model_checkpoint_2000_slim", "model_checkpoint_best"]
+            for name in names:
+                open(os.path.join(tmp_dir, name), "w").close()
+
+            self.assertTrue(get_checkpoint_iterations(basename) ==
+                            list(range(1000, 11000, 1000)))
+            self.assertTrue(get_latest_checkpoint(basename) ==
+                            (basename + "_checkpoint_10000", 10000))
+
+            checkpoints = CheckpointManager(basename, keep_last=2, keep_every=5000)
+            checkpoints.prune(keep=[2000])
+
+            self.assertTrue(get_checkpoint_iterations(basename) ==
+                            [2000, 5000, 9000, 10000])
+            self.assertTrue(os.path.exists(basename + "_checkpoint_2000_slim"))
+            self.assertTrue(os.path.exists(basename + "_checkpoint_best"))
+
+            checkpoints.prune()
+            self.assertTrue(get_checkpoint_iterations(basename) == [5000, 9000, 10000])
+            self.assertFalse(os.path.exists(basename + "_checkpoint_2000_slim"))
+
+if __name__ == "__main__":
+    unittest.main()
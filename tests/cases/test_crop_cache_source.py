@@ -0,0 +1,60 @@
+import unittest
+from synister.gp import CropCacheSource
+from gunpowder import *
+import json
+import numpy as np
+import os
+import tempfile
+
+class CropCacheSourceTestCase(unittest.TestCase):
+    def runTest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            crops = np.arange(2*2*4*4, dtype=np.uint8).reshape(2, 2, 4, 4)
+            np.save(os.path.join(tmp_dir, "crops.npy"), crops)
+            np.save(os.path.join(tmp_dir, "synapse_ids.npy"), np.array([1, 2]))
+            np.save(os.path.join(tmp_dir, "locations.npy"), np.zeros((2, 3), dtype=np.int64))
+            np.save(os.path.join(tmp_dir, "labels.npy"), np.array([0, 1]))
+            with open(os.path.join(tmp_dir, "attrs.json"), "w") as f:
+                json.dump({"input_shape": [2, 4, 4],
+                           "margin": [0, 0, 0],
+                           "voxel_size": [2, 1, 1],
+                           "synapse_types": ["gaba", "acetylcholine"],
+                           "complete": True}, f)
+
+            raw = ArrayKey('RAW')
+            synapse_type = ArrayKey('SYNAPSE_TYPE')
+
+            # caches built for other voxel sizes or synapse types are refused
+            with self.assertRaises(ValueError):
+                CropCacheSource(tmp_dir, raw, (1, 1, 1)).setup()
+            with self.assertRaises(ValueError):
+                CropCacheSource(tmp_dir, raw, (2, 1, 1), label=1,
+                                synapse_types=["acetylcholine", "gaba"]).setup()
+
+            source = CropCacheSource(tmp_dir, raw, (2, 1, 1), label=1, synapse_type=synapse_type,
+                                     synapse_types=["gaba", "acetylcholine"])
+            source.setup()
+
+            # crops are centered on the synapse
+            self.assertTrue(source.spec[raw].roi == Roi((-2, -2, -2), (4, 4, 4)))
+
+            request = BatchRequest()
+            request[raw] = ArraySpec(roi=Roi((-2, -2, -2), (4, 4, 4)))
+            request[synapse_type] = ArraySpec(nonspatial=True)
+            batch = source.provide(request)
+            self.assertTrue(np.all(batch[raw].data == crops[1]))
+            self.assertTrue(int(batch[synapse_type].data) == 1)
+
+            # parts outside of the crop are zero
+            request[raw] = ArraySpec(roi=Roi((0, 0, 0), (4, 4, 4)))
+            batch = source.provide(request)
+            data = batch[raw].data
+            self.assertTrue(data.shape == (2, 4, 4))
+            self.assertTrue(batch[raw].spec.roi == Roi((0, 0, 0), (4, 4, 4)))
+            self.assertTrue(np.all(data[0:1, 0:2, 0:2] == crops[1, 1:, 2:, 2:]))
+            self.assertTrue(np.sum(data[1:]) == 0)
+            self.assertTrue(np.sum(data[:, 2:]) == 0)
+            self.assertTrue(np.sum(data[:, :, 2:]) == 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+from funlib.learn.torch.models import Vgg3D
+from synister.dense import DenseVgg3D, predict_dense
+from synister.utils import predict, to_model_input
+import numpy as np
+import torch
+
+class UnpaddedVgg3D(torch.nn.Module):
+    def __init__(self):
+        super(UnpaddedVgg3D, self).__init__()
+        self.features = torch.nn.Sequential(
+            torch.nn.Conv3d(1, 4, kernel_size=(1, 3, 3)),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.MaxPool3d((1, 2, 2)),
+            torch.nn.Conv3d(4, 8, kernel_size=3),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.MaxPool3d(2))
+        self.classifier = torch.nn.Sequential(
+            torch.nn.Linear(8*2*3*3, 16),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.Dropout(),
+            torch.nn.Linear(16, 3))
+
+    def forward(self, raw):
+        f = self.features(raw)
+        return self.classifier(f.view(f.size(0), -1))
+
+class DenseVgg3DTestCase(unittest.TestCase):
+    def runTest(self):
+        torch.manual_seed(0)
+        input_shape = (4, 16, 16)
+        model = Vgg3D(input_size=input_shape,
+                      fmaps=4,
+                      downsample_factors=[(1,2,2), (2,2,2)],
+                      fmap_inc=(2,2),
+                      n_convolutions=(2,2),
+                      output_classes=3)
+        model.eval()
+
+        # Vgg3D pads its convolutions
+        with self.assertRaises(ValueError):
+            DenseVgg3D(model, input_shape)
+
+        dense_model = DenseVgg3D(model, input_shape, approximate=True)
+        self.assertTrue(dense_model.stride == (2, 4, 4))
+        self.assertFalse(dense_model.exact)
+
+        raw = np.random.randint(0, 256, size=input_shape, dtype=np.uint8)
+        raw_tensor = to_model_input(raw[np.newaxis], torch.device("cpu"))
+
+        # on a single crop, both see the same zero padding
+        with torch.no_grad():
+            scores = model(raw_tensor)[0].numpy()
+            dense_scores = dense_model(raw_tensor)[0].numpy()
+        self.assertTrue(dense_scores.shape == (3, 1, 1, 1))
+        self.assertTrue(np.allclose(scores, dense_scores[:, 0, 0, 0], atol=1e-5))
+
+class DenseVgg3DExactTestCase(unittest.TestCase):
+    def runTest(self):
+        torch.manual_seed(0)
+        np.random.seed(0)
+        input_shape = (6, 18, 18)
+        model = UnpaddedVgg3D()
+        model.eval()
+        dense_model = DenseVgg3D(model, input_shape)
+        self.assertTrue(dense_model.exact)
+        self.assertTrue(dense_model.stride == (2, 4, 4))
+        self.assertTrue(dense_model.feature_shape == (2, 3, 3))
+
+        raw = np.random.randint(0, 256, size=(10, 30, 34), dtype=np.uint8)
+        device = torch.device("cpu")
+
+        for step, chunk_shape in [((2, 4, 4), (4, 32, 32)),
+                                  ((2, 4, 4), (1, 2, 2)),
+                                  ((1, 2, 4), (2, 2, 3)),
+                                  ((4, 4, 8), (4, 32, 32))]:
+            probabilities = predict_dense(raw,
+                                          dense_model,
+                                          step=step,
+                                          chunk_shape=chunk_shape)
+            output_shape = tuple((np.array(raw.shape) - input_shape)//step + 1)
+            self.assertTrue(probabilities.shape == (3,) + output_shape)
+
+            # compare with single crops at all corners and a few inner locations
+            indices = list(np.ndindex(*[2]*3))
+            indices = [tuple(i*(s - 1) for i, s in zip(index, output_shape))
+                       for index in indices]
+            indices += [tuple(np.random.randint(0, s) for s in output_shape)
+                        for _ in range(4)]
+            crops = []
+            for index in indices:
+                offset = np.array(index)*step
+                crops.append(raw[offset[0]:offset[0] + input_shape[0],
+                                 offset[1]:offset[1] + input_shape[1],
+                                 offset[2]:offset[2] + input_shape[2]])
+
+            with torch.no_grad():
+                expected = predict(np.stack(crops), model, device=device).numpy()
+
+            for index, e in zip(indices, expected):
+                self.assertTrue(np.allclose(probabilities[(slice(None),) + index],
+                                            e,
+                                            atol=1e-5))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,11 @@
+import unittest
+import importlib
+
+class ImportTestCase(unittest.TestCase):
+    def runTest(self):
+        # fails if a node used by the training pipeline is missing
+        for module in ["synister.gp", "synister.train_pipeline"]:
+            importlib.import_module(module)
+
+if __name__ == "__main__":
+    unittest.main()
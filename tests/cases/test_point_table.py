@@ -0,0 +1,52 @@
+import unittest
+from synister.point_table import PointTable, sample_unknown_locations
+from scipy.spatial import cKDTree
+import numpy as np
+import os
+import tempfile
+
+class PointTableTestCase(unittest.TestCase):
+    def runTest(self):
+        table = PointTable([1, 2, 3, 4],
+                           [(10, 11, 12), (20, 21, 22), (30, 31, 32), (40, 41, 42)],
+                           ["train", "train", "test", "train"],
+                           ["gaba", "acetylcholine,gaba", "gaba", ""],
+                           split_name="skeleton")
+
+        self.assertTrue(list(table.get_synapse_ids(("gaba",), "train")) == [1])
+        self.assertTrue(list(table.get_synapse_ids(("gaba", "acetylcholine"))) == [2])
+        self.assertTrue(np.all(table.get_locations(("gaba",)) == [[10, 11, 12], [30, 31, 32]]))
+        self.assertTrue(len(table.get_locations(split_part="train")) == 3)
+        self.assertTrue(len(table.get_locations(("dopamine",), "train")) == 0)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_file = os.path.join(tmp_dir, "point_table.npz")
+            table.save(snapshot_file)
+            loaded = PointTable.load(snapshot_file)
+
+        self.assertTrue(loaded.split_name == "skeleton")
+        self.assertTrue(np.all(loaded.locations == table.locations))
+        self.assertTrue(list(loaded.get_synapse_ids(("gaba",), "train")) == [1])
+
+class UnknownLocationsTestCase(unittest.TestCase):
+    def runTest(self):
+        rng = np.random.RandomState(0)
+        locations = rng.randint(0, 20000, size=(200, 3))
+        table = PointTable(np.arange(200),
+                           locations,
+                           ["train"]*200,
+                           ["gaba"]*100 + ["glutamate"]*100)
+
+        samples = sample_unknown_locations(table,
+                                           neurotransmitters=("gaba", "glutamate"),
+                                           n_per_type=50,
+                                           min_distance=500,
+                                           seed=1)
+
+        self.assertTrue(samples.shape[1] == 3)
+        self.assertTrue(0 < len(samples) <= 100)
+        distances, _ = cKDTree(locations).query(samples)
+        self.assertTrue(np.all(distances >= 500))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+from synister.dense import DenseVgg3D
+from synister.scripts import predict_in_roi
+from synister.utils import open_raw_dataset
+import numpy as np
+import os
+import tempfile
+import torch
+import zarr
+
+class TinyVgg3D(torch.nn.Module):
+    def __init__(self):
+        super(TinyVgg3D, self).__init__()
+        self.features = torch.nn.Sequential(
+            torch.nn.Conv3d(1, 2, kernel_size=(1, 3, 3)),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.MaxPool3d((1, 2, 2)))
+        self.classifier = torch.nn.Sequential(
+            torch.nn.Linear(2*2*2*2, 3))
+
+    def forward(self, raw):
+        f = self.features(raw)
+        return self.classifier(f.view(f.size(0), -1))
+
+class PredictInRoiBlockwiseTestCase(unittest.TestCase):
+    def runTest(self):
+        torch.manual_seed(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            container = os.path.join(tmp_dir, "raw.zarr")
+            f = zarr.open(container, mode="w")
+            f["raw"] = np.random.randint(0, 256, size=(12, 40, 40), dtype=np.uint8)
+            f["raw"].attrs["resolution"] = [10, 2, 2]
+            f["raw"].attrs["offset"] = [0, 0, 0]
+
+            voxel_size = (10, 2, 2)
+            model = TinyVgg3D()
+            model.eval()
+            dense_model = (DenseVgg3D(model, (2, 6, 6)),
+                           torch.device("cpu"),
+                           open_raw_dataset(container, "raw", voxel_size),
+                           voxel_size)
+
+            out = os.path.join(tmp_dir, "prediction.zarr")
+            begin = np.array((30, 20, 20))
+            end = np.array((80, 52, 52))
+            step = np.array((10, 4, 4))
+
+            blocks, block_size = predict_in_roi.prepare_blockwise(
+                out, begin, end, step, (2, 4, 4), 3)
+            self.assertTrue(len(blocks) == 3*2*2)
+
+            # a worker as set up by init_block_worker
+            predict_in_roi._worker.update({
+                'prediction': zarr.open(out, mode='a')['prediction'],
+                'done': zarr.open(out, mode='a')['prediction_done'],
+                'begin': begin,
+                'end': end,
+                'step': step,
+                'block_size': np.array(block_size),
+                'dense_model': dense_model
+            })
+
+            # an interrupted run
+            for block in blocks[:5]:
+                predict_in_roi.predict_block(block)
+
+            # resuming skips finished blocks
+            remaining, _ = predict_in_roi.prepare_blockwise(
+                out, begin, end, step, (2, 4, 4), 3)
+            self.assertTrue(remaining == blocks[5:])
+
+            for block in remaining:
+                predict_in_roi.predict_block(block)
+            remaining, _ = predict_in_roi.prepare_blockwise(
+                out, begin, end, step, (2, 4, 4), 3)
+            self.assertTrue(remaining == [])
+
+            # blocks add up to the prediction of the whole ROI
+            expected = predict_in_roi.predict_in_roi_dense(begin, end, step,
+                                                           dense_model=dense_model)
+            prediction = zarr.open(out, mode='r')['prediction'][:]
+            self.assertTrue(prediction.shape == (3, 5, 8, 8))
+            self.assertTrue(np.allclose(prediction, expected, atol=1e-5))
+
+            # resuming with another block size is refused
+            with self.assertRaises(ValueError):
+                predict_in_roi.prepare_blockwise(out, begin, end, step, (1, 4, 4), 3)
+
+            predict_in_roi._worker.clear()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+from synister.predict_server import ModelBatcher, PredictionServer, request_predictions
+import numpy as np
+import threading
+import time
+import torch
+
+class MeanModel(torch.nn.Module):
+    '''Scores each crop by its mean intensity, records the batch sizes.'''
+
+    def __init__(self):
+        super(MeanModel, self).__init__()
+        self.batch_sizes = []
+
+    def forward(self, raw):
+        self.batch_sizes.append(raw.shape[0])
+        mean = raw.reshape(raw.shape[0], -1).mean(dim=1)
+        return torch.stack([mean, -mean], dim=1)
+
+def read_crops(locations):
+    # crop intensity given by the z coordinate of the location
+    return np.stack([np.full((1, 2, 2), loc[0], dtype=np.uint8) for loc in locations])
+
+def get_results(request, n):
+    results = {}
+    while len(results) < n:
+        start, probabilities = request.results.get(timeout=10)
+        for k, p in enumerate(probabilities):
+            results[start + k] = p
+    return [results[i] for i in range(n)]
+
+class ModelBatcherTestCase(unittest.TestCase):
+    def runTest(self):
+        model = MeanModel()
+        batcher = ModelBatcher("test",
+                               model,
+                               torch.device("cpu"),
+                               read_crops,
+                               max_batch_size=4,
+                               max_latency=0.5)
+
+        # requests arriving within the latency share batches, the second one
+        # is split over two batches
+        first = batcher.submit([(10, 0, 0), (20, 0, 0), (30, 0, 0)])
+        second = batcher.submit([(40, 0, 0), (50, 0, 0), (60, 0, 0)])
+        first_results = get_results(first, 3)
+        second_results = get_results(second, 3)
+        self.assertTrue(model.batch_sizes == [4, 2])
+
+        # results are assigned to the right request and location
+        scores = [p[0] for p in first_results + second_results]
+        self.assertTrue(scores == sorted(scores))
+        for p in first_results + second_results:
+            self.assertAlmostEqual(float(np.sum(p)), 1.0, places=5)
+
+        # a batch that does not fill up is predicted at the deadline
+        start = time.time()
+        get_results(batcher.submit([(70, 0, 0)]), 1)
+        self.assertTrue(time.time() - start >= 0.4)
+        self.assertTrue(model.batch_sizes[-1] == 1)
+
+class PredictionServerTestCase(unittest.TestCase):
+    def runTest(self):
+        model = MeanModel()
+        server = PredictionServer(("127.0.0.1", 0),
+                                  {"test": (model, torch.device("cpu"))},
+                                  read_crops,
+                                  max_batch_size=2,
+                                  max_latency=0.01)
+        port = server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            locations = [(z, 1, 2) for z in range(10, 60, 10)]
+            results = list(request_predictions(locations, port=port))
+
+            # one json line per location, streamed in batches of two
+            self.assertTrue(sorted(r[0] for r in results) == list(range(5)))
+            for index, location, probabilities in results:
+                self.assertTrue(location == locations[index])
+                self.assertTrue(len(probabilities) == 2)
+                self.assertAlmostEqual(sum(probabilities), 1.0, places=5)
+            self.assertTrue(max(model.batch_sizes) <= 2)
+
+            with self.assertRaises(RuntimeError):
+                list(request_predictions(locations, model="unknown", port=port))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+from synister.prediction_store import PredictionStoreWriter, load_predictions
+import numpy as np
+import os
+import tempfile
+
+class PredictionStoreTestCase(unittest.TestCase):
+    def runTest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = PredictionStoreWriter(tmp_dir, "test_run")
+            writer.write([3, 1], [(30, 31, 32), (10, 11, 12)], [[0.1, 0.9], [0.8, 0.2]])
+            writer.write([2, 3], [(20, 21, 22), (30, 31, 32)], [[0.5, 0.5], [0.1, 0.9]])
+            writer.write([], [], [])
+
+            run = load_predictions(os.path.join(tmp_dir, "test_run"))
+            self.assertTrue(list(run["synapse_ids"]) == [1, 2, 3])
+            self.assertTrue(np.all(run["locations"][0] == [10, 11, 12]))
+            self.assertTrue(np.all(run["locations"][2] == [30, 31, 32]))
+            self.assertTrue(run["predictions"].shape == (3, 2))
+            self.assertAlmostEqual(float(run["predictions"][1, 0]), 0.5)
+
+            # parts written after consolidation, the newest prediction wins
+            resumed = PredictionStoreWriter(tmp_dir, "test_run")
+            resumed.prefix = "part_resumed"
+            resumed.write([4, 1], [(40, 41, 42), (10, 11, 12)], [[0.3, 0.7], [0.6, 0.4]])
+            attrs_time = os.stat(os.path.join(tmp_dir, "test_run", "attrs.json")).st_mtime
+            part_file = os.path.join(tmp_dir, "test_run", "parts", "part_resumed_000000.npz")
+            os.utime(part_file, (attrs_time + 1, attrs_time + 1))
+
+            run = load_predictions(os.path.join(tmp_dir, "test_run"))
+            self.assertTrue(list(run["synapse_ids"]) == [1, 2, 3, 4])
+            self.assertAlmostEqual(float(run["predictions"][0, 0]), 0.6)
+            self.assertAlmostEqual(float(run["predictions"][3, 1]), 0.7)
+
+if __name__ == "__main__":
+    unittest.main()
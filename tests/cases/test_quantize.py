@@ -0,0 +1,45 @@
+import unittest
+from funlib.learn.torch.models import Vgg3D
+from synister.quantize import quantize_vgg
+from synister.utils import predict
+import copy
+import numpy as np
+import torch
+
+class QuantizeTestCase(unittest.TestCase):
+    def runTest(self):
+        if "fbgemm" not in torch.backends.quantized.supported_engines:
+            self.skipTest("fbgemm is not available")
+
+        torch.manual_seed(0)
+        np.random.seed(0)
+        input_shape = (4, 16, 16)
+        model = Vgg3D(input_size=input_shape,
+                      fmaps=4,
+                      downsample_factors=[(1,2,2), (2,2,2)],
+                      fmap_inc=(2,2),
+                      n_convolutions=(2,2),
+                      output_classes=3)
+        model.eval()
+
+        raw = np.random.randint(0, 256, size=(32,) + input_shape, dtype=np.uint8)
+        calibration = [raw[i:i + 8] for i in range(0, len(raw), 8)]
+
+        quantized = quantize_vgg(copy.deepcopy(model), calibration)
+
+        # convs, max pooling and the flattening of the features are quantized
+        self.assertTrue(isinstance(quantized.model.features[0],
+                                   torch.nn.intrinsic.quantized.ConvReLU3d))
+
+        device = torch.device("cpu")
+        with torch.no_grad():
+            expected = predict(raw, model, device=device).numpy()
+            probabilities = predict(raw, quantized, device=device).numpy()
+
+        self.assertTrue(probabilities.shape == (32, 3))
+        self.assertTrue(np.allclose(probabilities.sum(axis=1), 1.0, atol=1e-5))
+        agreement = np.mean(np.argmax(probabilities, axis=1) == np.argmax(expected, axis=1))
+        self.assertTrue(agreement >= 0.8, "agreement {}".format(agreement))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from synister.gp import RandomSynapseLocation
+from gunpowder import *
+import numpy as np
+
+class PointSourceStub(object):
+    # provides the points read by a SynapseSourceMongo
+    synapse_type = ("gaba",)
+    data = np.array([[400, 800, 1200]])
+
+class RandomSynapseLocationTestCase(unittest.TestCase):
+    def runTest(self):
+        raw = ArrayKey('RAW')
+        synapses = PointsKey('SYNAPSES')
+        voxel_size = Coordinate((40, 4, 4))
+
+        node = RandomSynapseLocation(PointSourceStub(), voxel_size)
+        node.setup()
+
+        roi = Roi((0, 0, 0), (160, 80, 80))
+        request = BatchRequest()
+        request[raw] = ArraySpec(roi=roi)
+        request[synapses] = PointsSpec(roi=Roi((40, 20, 20), (80, 40, 40)))
+        node.prepare(request)
+
+        # the request is centered on the synapse
+        self.assertTrue(request[raw].roi.get_center() == Coordinate((400, 800, 1200)))
+        self.assertTrue(request[synapses].roi.get_center() == Coordinate((400, 800, 1200)))
+        shift = request[raw].roi.get_begin() - roi.get_begin()
+        self.assertTrue(shift == node.shift)
+        self.assertTrue(all(s % v == 0 for s, v in zip(shift, voxel_size)))
+
+        # and shifted back in process
+        batch = Batch()
+        batch.arrays[raw] = Array(
+            np.zeros((4, 20, 20), dtype=np.float32),
+            ArraySpec(roi=request[raw].roi, voxel_size=voxel_size))
+        batch.points[synapses] = Points(
+            {1: Point(Coordinate((400, 800, 1200)))},
+            PointsSpec(roi=request[synapses].roi))
+        node.process(batch, request)
+
+        self.assertTrue(batch[raw].spec.roi == roi)
+        self.assertTrue(batch[synapses].spec.roi == Roi((40, 20, 20), (80, 40, 40)))
+        self.assertTrue(Coordinate(batch[synapses].data[1].location) == Coordinate((80, 40, 40)))
+
+if __name__ == "__main__":
+    unittest.main()
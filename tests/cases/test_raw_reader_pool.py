@@ -0,0 +1,53 @@
+import unittest
+from synister.utils import RawReaderPool, close_raw_reader_pools, get_raw, get_raw_parallel
+import numpy as np
+import os
+import tempfile
+import zarr
+
+class RawReaderPoolTestCase(unittest.TestCase):
+    def runTest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            container = os.path.join(tmp_dir, "raw.zarr")
+            f = zarr.open(container, mode="w")
+            data = np.random.randint(1, 256, size=(20, 40, 40), dtype=np.uint8)
+            f["raw"] = data
+            f["raw"].attrs["resolution"] = [40, 4, 4]
+            f["raw"].attrs["offset"] = [0, 0, 0]
+
+            size = (4, 8, 8)
+            voxel_size = (40, 4, 4)
+            locs = [
+                (400, 80, 80),    # inside
+                (80, 16, 16),     # touching the lower boundary
+                (0, 0, 0),        # partially outside
+                (760, 156, 156),  # partially outside
+                (2000, 400, 400)  # outside
+            ]
+
+            serial = get_raw(locs, size, voxel_size, container, "raw")
+
+            # fewer crops per read than locations, reads are split
+            with RawReaderPool(size, voxel_size, container, "raw",
+                               num_workers=2, max_batch_size=2) as pool:
+                pooled = pool.read(locs)
+
+            self.assertTrue(pooled.shape == (len(locs),) + size)
+            self.assertTrue(np.array_equal(pooled, serial))
+
+            # crops are centered on their location, padded with zeros
+            self.assertTrue(np.array_equal(pooled[0], data[8:12, 16:24, 16:24]))
+            self.assertTrue(np.array_equal(pooled[1], data[0:4, 0:8, 0:8]))
+            self.assertTrue(np.array_equal(pooled[2][2:, 4:, 4:], data[0:2, 0:4, 0:4]))
+            self.assertTrue(np.sum(pooled[2][:2]) == 0)
+            self.assertTrue(np.sum(pooled[4]) == 0)
+
+            # shared pools, no pool is needed for empty reads
+            empty = get_raw_parallel([], size, voxel_size, container, "raw")
+            self.assertTrue(empty.shape == (0,) + size)
+            pooled = get_raw_parallel(locs, size, voxel_size, container, "raw")
+            self.assertTrue(np.array_equal(pooled, serial))
+            close_raw_reader_pools()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -188,6 +188,51 @@ class CountPredictionsTestCase(DbSetupTestCase):
         self.assertTrue(done == 1)
         self.assertTrue(total == 1 + len(n_not_updated))
 
+class ClaimPredictionsTestCase(DbSetupTestCase):
+    def runTest(self):
+        self.db.initialize_prediction(split_name="neuron",
+                                      experiment="test",
+                                      train_number=0,
+                                      predict_number=0,
+                                      overwrite=True)
+
+        done, total = self.db.count_predictions(split_name="neuron",
+                                                experiment="test",
+                                                train_number=0,
+                                                predict_number=0)
+
+        # two owners never get the same synapse
+        claimed_a = self.db.claim_predictions("neuron", "test", 0, 0,
+                                              chunk_size=max(1, total//2),
+                                              lease_time=600)
+        claimed_b = self.db.claim_predictions("neuron", "test", 0, 0,
+                                              chunk_size=total,
+                                              lease_time=600)
+        self.assertTrue(len(claimed_a) > 0)
+        self.assertTrue(len(set(claimed_a) & set(claimed_b)) == 0)
+        self.assertTrue(len(claimed_a) + len(claimed_b) == total)
+
+        # nothing left while the leases are valid
+        self.assertTrue(self.db.claim_predictions("neuron", "test", 0, 0,
+                                                  chunk_size=total) == [])
+
+        # expired leases can be claimed again
+        test_client = MongoClient(self.db.auth_string)
+        db = test_client[self.db.db_name + "_predictions"]
+        predict_collection = db["neuron_test_t0_p0"]
+        predict_collection.update_many({"synapse_id": {"$in": claimed_a}},
+                                       {"$set": {"lease": 0}})
+
+        reclaimed = self.db.claim_predictions("neuron", "test", 0, 0,
+                                              chunk_size=total)
+        self.assertTrue(sorted(reclaimed) == sorted(claimed_a))
+
+        self.db.initialize_prediction(split_name="neuron",
+                                      experiment="test",
+                                      train_number=0,
+                                      predict_number=0,
+                                      overwrite=True)
+
 class MakeSplitTestCase(DbSetupTestCase):
     def runTest(self):
         train_synapse_ids = [999188, 97954] 
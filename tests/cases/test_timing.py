@@ -0,0 +1,34 @@
+import unittest
+from synister.timing import StageTimer
+import json
+import os
+import tempfile
+
+class StageTimerTestCase(unittest.TestCase):
+    def runTest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_file = os.path.join(tmp_dir, "timing", "timing.jsonl")
+            timer = StageTimer("test", log_file=log_file, emit_interval=1000)
+
+            for seconds in [0.001, 0.002, 0.004, 1.0]:
+                timer.add("read", seconds)
+            with timer.time("inference"):
+                pass
+
+            summary = timer.summary()
+            self.assertTrue(summary["read"]["count"] == 4)
+            self.assertAlmostEqual(summary["read"]["total"], 1.007)
+            self.assertTrue(summary["read"]["max"] == 1.0)
+            self.assertTrue(sum(summary["read"]["histogram"]) == 4)
+            self.assertTrue(summary["read"]["p50"] <= summary["read"]["p99"])
+            self.assertTrue(summary["inference"]["count"] == 1)
+
+            timer.close()
+            with open(log_file) as f:
+                records = [json.loads(line) for line in f]
+            self.assertTrue(len(records) == 1)
+            self.assertTrue(records[0]["kind"] == "summary")
+            self.assertTrue(set(records[0]["stages"].keys()) == {"read", "inference"})
+
+if __name__ == "__main__":
+    unittest.main()